@@ -0,0 +1,420 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import concurrent.futures
+import configparser
+import datetime as dt
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+import settings
+import cleanup
+import mp4_convert
+import emailer
+import log_listener
+import metrics_collector
+import pir
+import record
+import segment_writer
+import fake_camera
+import smtp_sink
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Version of the results file layout
+RESULTS_VERSION = 1
+
+# Record writes a segment a minute, these are the limits each component has to stay within to keep up
+# Each is (benchmark name prefix, metric, 'max' or 'min', limit, reason)
+BUDGETS = (
+    ('cleanup_', 'full_pass_seconds', 'max', 60, "Cleanup is sent a segment a minute and cannot take it while a pass runs"),
+    ('cleanup_', 'incremental_pass_seconds', 'max', 60, "Cleanup is sent a segment a minute and cannot take it while a pass runs"),
+    ('cleanup_', 'index_seconds', 'max', 60, "Cleanup is sent a segment a minute and cannot take it while the index is built"),
+    ('mp4_convert', 'segments_per_minute', 'min', 1, "Record writes a segment a minute"),
+    ('emailer', 'emails_per_minute', 'min', 1, "the PIR triggers at most once a minute with the default min_trigger_seconds"),
+    ('log_listener', 'records_per_second', 'min', 1000, "a burst of logging, such as a pass deleting files, must not back up the log queue"),
+    ('idle', 'cpu_percent', 'max', 5, "the idle units must leave the CPU to Record"),
+    ('segment_writer_', 'worst_stall_ms', 'max', 40, "the encoder must not wait longer than a frame at 25fps for a write buffer"),
+)
+
+# The measured metrics compared with the baseline and whether higher or lower is better, the rest describe the run
+BETTER = {
+    'index_seconds': 'lower',
+    'full_pass_seconds': 'lower',
+    'incremental_pass_seconds': 'lower',
+    'segments_per_minute': 'higher',
+    'emails_per_minute': 'higher',
+    'records_per_second': 'higher',
+    'cpu_percent': 'lower',
+    'writes_per_minute': 'lower',
+    'worst_write_ms': 'lower',
+    'worst_fsync_ms': 'lower',
+    'worst_stall_ms': 'lower',
+}
+
+
+def bench_config(work_path, overrides=None):
+    """
+    Return Settings for a benchmark with every path in work_path and the units run as threads
+
+    Keyword arguments:
+    work_path -- The directory the benchmark writes to
+
+    overrides -- A dictionary of section to a dictionary of key to config string
+    """
+    sections = {
+        'SECURITY': {'runtime': 'thread'},
+        'LOGGING': {'log_filename': os.path.join(work_path, 'security.log')},
+        'RECORD': {'video_out_path': os.path.join(work_path, 'video'), 'notification_out_path': os.path.join(work_path, 'notify')},
+        'EMAILER': {'outbox_path': os.path.join(work_path, 'outbox')},
+        'METRICS': {'port': '0'},
+        'PIR': {'disable': os.path.join(work_path, 'pir_disable')},
+        'SIMULATION': {'gpio': 'fake'},
+    }
+    for section, options in (overrides or {}).items():
+        sections.setdefault(section, {}).update(options)
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_dict(sections)
+    return settings.parse(parser)
+
+
+def make_tree(top, days, end_time):
+    """ Make a YYYY-MM-DD/HH/MM tree of empty segments and key frame indexes for the days up to end_time, returns the file count """
+    files = 0
+    day = dt.datetime.fromtimestamp(end_time).replace(hour=0, minute=0, second=0, microsecond=0)
+    for i in range(days):
+        for hour in range(24):
+            full_hour = os.path.join(top, (day - dt.timedelta(days=i)).strftime('%Y-%m-%d'), f"{hour:02d}")
+            os.makedirs(full_hour)
+            for minute in range(60):
+                for extension in ('.mp4', '.idx'):
+                    open(os.path.join(full_hour, f"{minute:02d}{extension}"), 'wb').close()
+                    files += 1
+    return files
+
+
+def bench_cleanup(work_path, days):
+    """
+    Time the Cleanup passes on a tree of days of segments, the tree is in the page cache so it is the best case
+
+    The full pass removes the hours of the oldest day that have expired, the incremental pass one minute
+    and the index is what the capacity limits build at startup
+    """
+    config = bench_config(work_path, {'CLEANUP': {'days_to_keep': str(days - 1)}})
+    top = config['RECORD']['video_out_path']
+    files = make_tree(top, days, time.time())
+    unit = cleanup.Cleanup(config=config, log_queue=queue.Queue())
+    unit.timeline = None
+    unit.removed = 0
+    time_limit = time.time() - config['CLEANUP']['days_to_keep']*60*60*24
+
+    start = time.perf_counter()
+    unit.build_index(top)
+    index_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unit.full_pass(top, time_limit)
+    full_pass_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unit.incremental_pass(top, time_limit, time_limit + 60)
+    incremental_pass_seconds = time.perf_counter() - start
+    return {'days': days, 'files': files, 'removed': unit.removed, 'index_seconds': index_seconds,
+            'full_pass_seconds': full_pass_seconds, 'incremental_pass_seconds': incremental_pass_seconds}
+
+
+def bench_mp4_convert(work_path, segments, segment_seconds):
+    """
+    Time Mp4_convert converting synthetic 1640x1232 h264 segments with its worker processes
+
+    segments_per_minute is in minutes of video so it is the same whatever segment_seconds is
+    """
+    config = bench_config(work_path)
+    framerate = config['RECORD']['framerate']
+    intra_period = config['RECORD']['intra_period']
+    data = b''.join(fake_camera.h264_frame(1640, 1232, i, i % intra_period == 0, i % intra_period == 0) for i in range(segment_seconds * framerate))
+    # Outside video_out_path so Mp4_convert does not find the corpus as a backlog when it starts
+    top = os.path.join(work_path, 'corpus')
+    os.makedirs(top)
+    paths = []
+    for i in range(segments):
+        paths.append(os.path.join(top, f"{i:02d}.h264"))
+        with open(paths[-1], 'wb') as fp:
+            fp.write(data)
+
+    input_queue = queue.Queue()
+    output_queue = queue.Queue()
+    unit = mp4_convert.Mp4_convert(config=config, log_queue=queue.Queue(), input_queue=input_queue, output_queue=output_queue)
+    unit.start()
+    start = time.perf_counter()
+    for path in paths:
+        input_queue.put(path)
+    converted = 0
+    try:
+        while converted < segments:
+            # A failed conversion is never output so do not wait for ever
+            output_queue.get(timeout=max(60, segment_seconds * 10))
+            converted += 1
+    except queue.Empty:
+        raise RuntimeError(f"Only {converted} of {segments} segments converted, see the Mp4_convert log")
+    finally:
+        elapsed = time.perf_counter() - start
+        unit.join()
+    return {'segments': segments, 'segment_seconds': segment_seconds, 'segment_mb': len(data) / 1024 / 1024,
+            'workers': config['MP4_CONVERT']['workers'] or max(1, (os.cpu_count() or 1) - 1),
+            'seconds': elapsed, 'segments_per_minute': segments * segment_seconds / elapsed}
+
+
+def bench_emailer(work_path, emails):
+    """ Time the Emailer senders sending emails with one RENDER target_kb image to a loopback SMTP server """
+    sink = smtp_sink.Smtp_sink()
+    sink.start()
+    config = bench_config(work_path, {'EMAILER': {'server': '127.0.0.1', 'port': str(sink.port), 'starttls': 'False',
+                                                  'from': 'bench@localhost', 'to': 'bench@localhost'}})
+    image = os.path.join(work_path, 'image.jpg')
+    with open(image, 'wb') as fp:
+        fp.write(os.urandom(config['RENDER']['target_kb']*1024))
+    max_in_flight = config['EMAILER']['max_in_flight']
+    unit = emailer.Emailer(config=config, log_queue=queue.Queue(), input_queue=queue.Queue())
+    unit.sessions = queue.Queue()
+    for i in range(max_in_flight):
+        unit.sessions.put(emailer.Smtp_session(config, unit.queue_logger))
+    try:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            errors = [error for error, permanent in executor.map(unit.send, [[image]] * emails) if error is not None]
+        elapsed = time.perf_counter() - start
+    finally:
+        while not unit.sessions.empty():
+            unit.sessions.get().close()
+        sink.stop()
+    if errors:
+        raise RuntimeError(f"{len(errors)} emails failed {errors[0]}")
+    return {'emails': emails, 'attachment_kb': config['RENDER']['target_kb'], 'senders': max_in_flight,
+            'seconds': elapsed, 'emails_per_minute': emails / elapsed * 60}
+
+
+def bench_log_listener(work_path, records):
+    """ Time the log listener process writing DEBUG records sent through the log queue as the units send them """
+    config = bench_config(work_path, {'SECURITY': {'runtime': 'process'}})
+    log_queue = multiprocessing.Queue()
+    listener = log_listener.Log_listener(config=config, log_queue=log_queue)
+    listener.start()
+    logger = logging.getLogger(name='Bench')
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    logger.setLevel('DEBUG')
+    start = time.perf_counter()
+    for i in range(records):
+        logger.debug(f"Benchmark record {i} of {records} with about as much text as a unit's debug message")
+    # The listener exits once it has written everything before the sentinel
+    log_queue.put(None)
+    listener.join()
+    elapsed = time.perf_counter() - start
+    return {'records': records, 'seconds': elapsed, 'records_per_second': records / elapsed}
+
+
+def bench_idle(work_path, seconds):
+    """
+    Measure the CPU used by the units while there is nothing for them to do
+
+    Pir, Mp4_convert, Emailer, Cleanup and Metrics_collector run as threads of this process so their
+    wakeups are all in its CPU time, Record is left out as it is never idle
+    """
+    config = bench_config(work_path, {'METRICS': {'enabled': 'True'}})
+    log_queue = queue.Queue()
+    metrics_queue = queue.Queue()
+    units = [
+        pir.Pir(config=config, log_queue=log_queue, output_queue=queue.Queue(), metrics_queue=metrics_queue),
+        mp4_convert.Mp4_convert(config=config, log_queue=log_queue, input_queue=queue.Queue(), metrics_queue=metrics_queue),
+        emailer.Emailer(config=config, log_queue=log_queue, input_queue=queue.Queue(), metrics_queue=metrics_queue),
+        cleanup.Cleanup(config=config, log_queue=log_queue, input_queue=queue.Queue(), metrics_queue=metrics_queue),
+        metrics_collector.Metrics_collector(config=config, log_queue=log_queue, metrics_queue=metrics_queue),
+    ]
+    for running_unit in units:
+        running_unit.start()
+    # Let the startup work, such as the first cleanup pass, finish first
+    time.sleep(2)
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    cpu = time.process_time() - start_cpu
+    elapsed = time.perf_counter() - start
+    for running_unit in units:
+        running_unit.stop()
+    for running_unit in units:
+        running_unit.join()
+    return {'units': len(units), 'seconds': elapsed, 'cpu_seconds': cpu, 'cpu_percent': cpu / elapsed * 100}
+
+
+def bench_segment_writer(work_path, fsync, seconds):
+    """
+    Write synthetic 1640x1232 h264 through Segment_output at the framerate with an fsync policy
+
+    Run it with --work on the storage the segments go to, it shows the write syscalls and stalls each
+    fsync policy costs so SD card wear can be weighed against what a power cut loses
+    """
+    config = bench_config(work_path, {'STORAGE': {'fsync': fsync}})
+    framerate = config['RECORD']['framerate']
+    intra_period = config['RECORD']['intra_period']
+    pool = segment_writer.Buffer_pool(config['STORAGE']['write_buffers'], config['STORAGE']['write_block_kb']*1024)
+    output = record.Segment_output(os.path.join(work_path, 'segment.h264'), None, None, pool, config)
+    start = time.perf_counter()
+    for i in range(int(seconds * framerate)):
+        # Keep to the framerate as the encoder does
+        time.sleep(max(0, start + i / framerate - time.perf_counter()))
+        output.write(fake_camera.h264_frame(1640, 1232, i, i % intra_period == 0, i % intra_period == 0))
+    output.close()
+    stats = output.file.stats()
+    stats['writes_per_minute'] = stats['writes'] * 60 / seconds
+    return dict({'fsync': fsync, 'seconds': seconds}, **stats)
+
+
+def check_budgets(results):
+    """ Return a list of (benchmark, metric, value, 'max' or 'min', limit, reason, passed) for the results with a budget """
+    checks = []
+    for name, result in sorted(results.items()):
+        for prefix, metric, kind, limit, reason in BUDGETS:
+            if name.startswith(prefix) and metric in result:
+                value = result[metric]
+                passed = value <= limit if kind == 'max' else value >= limit
+                checks.append((name, metric, value, kind, limit, reason, passed))
+    return checks
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of (benchmark, metric, value, baseline value, change, regressed) for the metrics in both
+
+    Keyword arguments:
+    results, baseline -- Dictionaries of benchmark name to its metrics
+
+    tolerance -- The fraction a metric can get worse by before it is a regression
+    """
+    comparisons = []
+    for name, result in sorted(results.items()):
+        for metric, value in result.items():
+            base = baseline.get(name, {}).get(metric)
+            if metric not in BETTER or not isinstance(base, (int, float)) or not base:
+                continue
+            worse = (base - value) / base if BETTER[metric] == 'higher' else (value - base) / base
+            comparisons.append((name, metric, value, base, (value - base) / base, worse > tolerance))
+    return comparisons
+
+
+if __name__ == '__main__':
+    # Run the benchmarks, write the results as JSON and check them against the budgets and a baseline
+    parser = argparse.ArgumentParser(description="Benchmark the units against the one segment a minute budget")
+    parser.add_argument('benchmarks', nargs='*', default=['cleanup', 'mp4_convert', 'emailer', 'log_listener', 'idle', 'segment_writer'],
+                        help="cleanup, mp4_convert, emailer, log_listener, idle or segment_writer (default all)")
+    parser.add_argument('--days', default='7,30,90', help="Days of segments in each cleanup tree (default 7,30,90)")
+    parser.add_argument('--segments', type=int, default=5, help="Number of segments to convert (default 5)")
+    parser.add_argument('--segment-seconds', type=int, default=60, help="Length of each segment (default 60)")
+    parser.add_argument('--emails', type=int, default=200, help="Number of emails to send (default 200)")
+    parser.add_argument('--records', type=int, default=100000, help="Number of log records to write (default 100000)")
+    parser.add_argument('--idle-seconds', type=float, default=30, help="Seconds to measure the idle units for (default 30)")
+    parser.add_argument('--writer-seconds', type=float, default=10, help="Seconds of video to write with each fsync policy (default 10)")
+    parser.add_argument('--work', help="Directory to make the test data in, on the storage to be measured (default a temporary directory)")
+    parser.add_argument('--output', help="File to write the results to as JSON")
+    parser.add_argument('--baseline', help="Results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction a metric can get worse than the baseline by (default 0.2)")
+    args = parser.parse_args()
+
+    runs = []
+    for benchmark in args.benchmarks:
+        if benchmark == 'cleanup':
+            runs += [(f"cleanup_{days}d", bench_cleanup, (int(days),)) for days in args.days.split(',')]
+        elif benchmark == 'mp4_convert':
+            runs.append((benchmark, bench_mp4_convert, (args.segments, args.segment_seconds)))
+        elif benchmark == 'emailer':
+            runs.append((benchmark, bench_emailer, (args.emails,)))
+        elif benchmark == 'log_listener':
+            runs.append((benchmark, bench_log_listener, (args.records,)))
+        elif benchmark == 'idle':
+            runs.append((benchmark, bench_idle, (args.idle_seconds,)))
+        elif benchmark == 'segment_writer':
+            runs += [(f"segment_writer_{fsync}", bench_segment_writer, (fsync, args.writer_seconds)) for fsync in segment_writer.FSYNC_POLICIES]
+        else:
+            sys.exit(f"Unknown benchmark {benchmark}")
+
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r') as fp:
+                baseline = json.load(fp)['results']
+        except (OSError, ValueError, KeyError) as e:
+            sys.exit(f"Cannot read baseline {args.baseline} {e}")
+
+    if args.work:
+        os.makedirs(args.work, exist_ok=True)
+    results = {}
+    for name, function, function_args in runs:
+        work_path = tempfile.mkdtemp(prefix=f"bench-{name}-", dir=args.work)
+        print(f"Running {name}")
+        try:
+            results[name] = function(work_path, *function_args)
+        except (OSError, RuntimeError) as e:
+            print(f"{name} failed {e}")
+            results[name] = {'error': f"{e}"}
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+        print('  ' + ' '.join(f"{metric}={value:.3f}" if isinstance(value, float) else f"{metric}={value}" for metric, value in results[name].items()))
+
+    failed = any('error' in result for result in results.values())
+    print("\nBudgets")
+    budgets = check_budgets(results)
+    for name, metric, value, kind, limit, reason, passed in budgets:
+        print(f"  {'PASS' if passed else 'FAIL'} {name} {metric}={value:.3f} {kind} {limit}, {reason}")
+        failed = failed or not passed
+
+    comparisons = []
+    if baseline is not None:
+        print(f"\nCompared with {args.baseline}, a regression is more than {args.tolerance:.0%} worse")
+        comparisons = compare(results, baseline, args.tolerance)
+        for name, metric, value, base, change, regressed in comparisons:
+            print(f"  {'REGRESSED' if regressed else 'ok'} {name} {metric}={value:.3f} baseline={base:.3f} {change:+.1%}")
+            failed = failed or regressed
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'version': RESULTS_VERSION,
+                       'time': dt.datetime.now().isoformat(timespec='seconds'),
+                       'host': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(),
+                       'results': results,
+                       'budgets': [{'benchmark': name, 'metric': metric, 'value': value, kind: limit, 'passed': passed}
+                                   for name, metric, value, kind, limit, reason, passed in budgets],
+                       'baseline': args.baseline,
+                       'regressions': [{'benchmark': name, 'metric': metric, 'value': value, 'baseline': base, 'change': change}
+                                       for name, metric, value, base, change, regressed in comparisons if regressed]},
+                      fp, indent=2)
+    sys.exit(1 if failed else 0)
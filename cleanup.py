@@ -17,12 +17,16 @@ __version__ = "0.1"
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import multiprocessing
-import queue
 import time
+import datetime as dt
 import os
-import logging
-import logging.handlers
+import shutil
+import heapq
+
+import unit
+import timeline
+import migrate
+import mp4_mux
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -30,94 +34,471 @@ import logging.handlers
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Cleanup(multiprocessing.Process):
+# File extensions that are cleaned up
+VIDEO_EXTENSIONS = (".h264", ".mp4", ".idx")
+NOTIFICATION_EXTENSIONS = (".jpg", ".h264", ".mp4", ".idx")
+
+def parse_time(name, time_format):
+    """ Return the local time in seconds since the epoch encoded in name or None if name does not match time_format """
+    try:
+        return dt.datetime.strptime(name, time_format).timestamp()
+    except ValueError:
+        return None
+
+
+class Capacity_index:
+    """ A class to keep the files under a path in age order with their total size
+        so the oldest files can be found and the space used is known without walking the tree
+    """
+    def __init__(self):
+        # Heap of (file time, path) so adding and removing the oldest are O(log n)
+        self.entries = []
+        self.sizes = {}
+        self.total = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, file_time, path, size):
+        if path in self.sizes:
+            self.total -= self.sizes[path]
+        else:
+            heapq.heappush(self.entries, (file_time, path))
+        self.sizes[path] = size
+        self.total += size
+
+    def oldest(self):
+        """ Return the time of the oldest file or None if the index is empty """
+        return self.entries[0][0] if self.entries else None
+
+    def pop_oldest(self):
+        """ Remove the oldest file from the index and return its path """
+        file_time, path = heapq.heappop(self.entries)
+        self.total -= self.sizes.pop(path)
+        return path
+
+    def expire(self, time_limit):
+        """ Drop files older than time_limit that no longer exist as they have been deleted by age """
+        kept = []
+        while self.entries and self.entries[0][0] < time_limit:
+            file_time, path = heapq.heappop(self.entries)
+            if os.path.exists(path):
+                kept.append((file_time, path))
+            else:
+                self.total -= self.sizes.pop(path)
+        for entry in kept:
+            heapq.heappush(self.entries, entry)
+
+
+def parse_still_time(name):
+    """ Return the time encoded in a notification name, which may have _ and milliseconds added, or None if it is not one """
+    stamp, separator, millis = name.partition('_')
+    if separator and not (len(millis) == 3 and millis.isdigit()):
+        return None
+    file_time = parse_time(stamp, '%Y-%m-%d-%H-%M-%S')
+    if file_time is None or not separator:
+        return file_time
+    return file_time + int(millis) / 1000
+
+
+def file_time_from_path(path):
+    """ Return the time encoded in a Record video or notification path or None if it is not in the Record layout """
+    name = os.path.splitext(path)[0]
+    file_time = parse_still_time(os.path.basename(name))
+    if file_time is None:
+        file_time = parse_time('/'.join(name.split(os.sep)[-3:]), '%Y-%m-%d/%H/%M')
+    return file_time
+
+
+class Cleanup(unit.Unit):
     """ A class to handle deleting old video and images
+
+        The age of video comes from the YYYY-MM-DD/HH/MM path Record writes it to, so
+        whole expired day and hour directories are removed without looking at the files in them
+        A cursor holding the time limit of the last pass is kept in video_out_path so each pass only
+        removes what expired since the last one
+        A full pass, which falls back to the modification time for anything not in the Record layout,
+        is done at startup and every full_scan_hours
+
+        If a free space watermark or maximum size is set the oldest files are also deleted to keep
+        within them, the sizes of the files are kept in a Capacity_index so the tree is only summed at startup
+        When video_out_path and notification_out_path share a file system the oldest file of either is deleted first
+        Paths of new files sent to the input queue are added to the index and checked straight away,
+        notification stills are added to the index as each pass lists notification_out_path
+
+        With a staging path the staging tier is cleaned by age too, its size is kept in bounds by Migrate
     """
-    def __init__(self, *, config, log_queue):
+    def __init__(self, *, config, log_queue, input_queue=None, metrics_queue=None):
         """
         Initialise the cleanup class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object to send log messages to
+
+        input_queue -- A queue object containing the full path of each new video file or event clip
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
         """
-        super(Cleanup, self).__init__()
-        self.config = config
-        self.log_queue = log_queue
-
-        self.stoprequest = multiprocessing.Event()
-
-        # Setup logging
-        h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
-        self.queue_logger = logging.getLogger(name='Cleanup')
-        self.queue_logger.addHandler(h)
-        # apply this unit's logging level
-        log_level = {'CRITICAL': logging.CRITICAL, 'ERROR': logging.ERROR, 'WARNING': logging.WARNING, 'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
-        self.queue_logger.setLevel(log_level[self.config['CLEANUP']['log_level']])
+        super(Cleanup, self).__init__(config=config, log_queue=log_queue, unit_name='Cleanup', config_section='CLEANUP', input_queue=input_queue, metrics_queue=metrics_queue)
     
     def run(self):
         self.queue_logger.info("Cleanup started")
         print("Cleanup started\n")
 
+        cursor_path = os.path.join(self.config['RECORD']['video_out_path'], '.cleanup_cursor')
+        # Index of the segments and events, None if not enabled
+        self.timeline = timeline.open_timeline(self.config, self.queue_logger)
+        # A full pass is always done first
+        next_full_scan = 0
+
+        self.indexes = None
+        self.set_capacity_limits()
+
+        next_pass = 0
         # Loop while not asked to exit
         while not self.stoprequest.is_set():
-            notification_out_path = self.config['RECORD']['notification_out_path']
-            video_out_path = self.config['RECORD']['video_out_path']
-            # Calculate time limit for files
-            time_limit = time.time() - (int(self.config['CLEANUP']['days_to_keep'])*60*60*24)
-            self.queue_logger.debug(f"time_limit={time_limit}")
-            # Check notification_out_path for images that are too old
-            oldfiles = [f for f in os.listdir(notification_out_path) if os.path.isfile(os.path.join(notification_out_path, f)) and os.path.splitext(f)[1] == ".jpg" and os.path.getmtime(os.path.join(notification_out_path, f)) < time_limit]
-            self.queue_logger.debug(f"oldfiles={oldfiles}")
-            # Delete old files
-            for f in oldfiles:
-                full_f = os.path.join(notification_out_path, f)
-                self.queue_logger.info(f"Deleting file={full_f}")
+            if time.monotonic() >= next_pass:
+                notification_out_path = self.config['RECORD']['notification_out_path']
+                video_out_path = self.config['RECORD']['video_out_path']
+                # Calculate time limit for files
+                time_limit = time.time() - (self.config['CLEANUP']['days_to_keep']*60*60*24)
+                self.queue_logger.debug(f"time_limit={time_limit}")
+                pass_start = time.monotonic()
+                self.removed = 0
+
+                # Check notification_out_path for images and event clips that are too old
+                self.clean_notifications(notification_out_path, time_limit)
+
+                # Check video_out_path for video that are too old
+                cursor = self.read_cursor(cursor_path)
+                if cursor is None or time.monotonic() >= next_full_scan:
+                    self.full_pass(video_out_path, time_limit)
+                    next_full_scan = time.monotonic() + self.config['CLEANUP']['full_scan_hours']*60*60
+                    pass_type = "Full"
+                elif cursor < time_limit:
+                    self.incremental_pass(video_out_path, cursor, time_limit)
+                    pass_type = "Incremental"
+                else:
+                    pass_type = "Empty"
+                if cursor is None or cursor < time_limit:
+                    self.write_cursor(cursor_path, time_limit)
+
+                # Segments are normally migrated out of staging within a minute so anything this old was left behind
+                if migrate.staging_path(self.config) is not None:
+                    self.full_pass(migrate.staging_path(self.config), time_limit)
+
+                if self.indexes is not None:
+                    for index in self.indexes.values():
+                        index.expire(time_limit)
+                    self.check_capacity()
+
+                self.queue_logger.info(f"{pass_type} cleanup pass took {time.monotonic() - pass_start:.3f}s removed={self.removed}")
+                self.metrics.inc('cleanup_passes')
+                self.metrics.observe('cleanup_pass_seconds', time.monotonic() - pass_start)
+                if self.indexes is not None:
+                    self.metrics.set('video_bytes', self.indexes[video_out_path].total)
+                    self.metrics.set('notification_bytes', self.indexes[notification_out_path].total)
+                self.metrics.set('free_bytes', self.free_space(video_out_path))
+                next_pass = time.monotonic() + 30
+
+            # Wait for a new file or the next pass, this returns straight away if asked to exit
+            input_queue_message = self.get_message(timeout=max(0, next_pass - time.monotonic()))
+            if input_queue_message is not None and self.indexes is not None:
+                self.index_file(input_queue_message)
+                # A converted clip has a key frame index next to it that is only found here
+                if os.path.splitext(input_queue_message)[1] == '.mp4':
+                    self.index_file(mp4_mux.index_path(input_queue_message))
+                self.removed = 0
+                self.check_capacity()
+
+        if self.timeline is not None:
+            self.timeline.close()
+
+    def set_capacity_limits(self):
+        """ Set the capacity limits in bytes from the config, 0 is no limit, the indexes are built when a limit is first set """
+        self.free_space_low = self.config['CLEANUP']['free_space_low_mb']*1024*1024
+        self.free_space_high = max(self.free_space_low, self.config['CLEANUP']['free_space_high_mb']*1024*1024)
+        self.max_bytes = {self.config['RECORD']['video_out_path']: self.config['CLEANUP']['video_max_mb']*1024*1024,
+                          self.config['RECORD']['notification_out_path']: self.config['CLEANUP']['notification_max_mb']*1024*1024}
+        if self.indexes is None and (self.free_space_low or any(self.max_bytes.values())):
+            self.indexes = {top: self.build_index(top) for top in self.max_bytes}
+
+    def reload(self, config):
+        super(Cleanup, self).reload(config)
+        self.set_capacity_limits()
+
+    def build_index(self, top):
+        """ Return a Capacity_index of the files under top, this is the only time the tree is summed """
+        start = time.monotonic()
+        index = Capacity_index()
+        for root, dirs, files in os.walk(top):
+            # A large tree takes a while so let the supervisor know the unit is still working
+            self.beat()
+            for f in files:
+                if os.path.splitext(f)[1] in VIDEO_EXTENSIONS + NOTIFICATION_EXTENSIONS:
+                    self.index_file(os.path.join(root, f), index)
+        self.queue_logger.info(f"Indexed {len(index)} files {index.total} bytes in {top} in {time.monotonic() - start:.3f}s")
+        return index
+
+    def index_file(self, full_f, index=None):
+        """ Add a new file to the capacity index of the path it is under """
+        if index is None:
+            index = next((index for top, index in self.indexes.items() if full_f.startswith(os.path.join(top, ''))), None)
+            if index is None:
+                return
+        try:
+            stat = os.stat(full_f)
+        except OSError:
+            return
+        file_time = file_time_from_path(full_f)
+        index.add(file_time if file_time is not None else stat.st_mtime, full_f, stat.st_size)
+
+    def check_capacity(self):
+        """ Delete the oldest files until each path is within its maximum size and free space watermark """
+        for top, index in self.indexes.items():
+            max_bytes = self.max_bytes[top]
+            while max_bytes and index.total > max_bytes and index:
+                self.remove_oldest(top, index, f"{top} is over {max_bytes} bytes")
+
+        if not self.free_space_low:
+            return
+        # Paths on the same file system share its free space so the oldest file of any of them is deleted first
+        file_systems = {}
+        for top in self.indexes:
+            try:
+                file_systems.setdefault(os.stat(top).st_dev, []).append(top)
+            except OSError:
+                continue
+        for tops in file_systems.values():
+            if self.free_space(tops[0]) >= self.free_space_low:
+                continue
+            # Delete down to the high watermark so this is not triggered again by the next file
+            while self.free_space(tops[0]) < self.free_space_high:
+                top = min((top for top in tops if self.indexes[top]), key=lambda top: self.indexes[top].oldest(), default=None)
+                if top is None:
+                    break
+                self.remove_oldest(top, self.indexes[top], f"{top} has less than {self.free_space_high} bytes free")
+
+    def free_space(self, top):
+        try:
+            stat = os.statvfs(top)
+        except OSError:
+            return self.free_space_high
+        return stat.f_bavail * stat.f_frsize
+
+    def remove_oldest(self, top, index, reason):
+        """ Delete the oldest file in the index and any directories it leaves empty """
+        full_f = index.pop_oldest()
+        self.queue_logger.warning(f"Deleting file={full_f} as {reason}")
+        self.metrics.inc('capacity_removals')
+        self.remove_file(full_f, missing_ok=True)
+        parent = os.path.dirname(full_f)
+        while parent.startswith(os.path.join(top, '')):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def read_cursor(self, cursor_path):
+        """ Return the time limit of the last pass or None if there is no cursor """
+        try:
+            with open(cursor_path, 'r') as fp:
+                return float(fp.read())
+        except (OSError, ValueError):
+            return None
+
+    def write_cursor(self, cursor_path, time_limit):
+        try:
+            with open(cursor_path + '.tmp', 'w') as fp:
+                fp.write(f"{time_limit}")
+            os.replace(cursor_path + '.tmp', cursor_path)
+        except OSError:
+            self.queue_logger.warning(f"Cannot write cursor={cursor_path}")
+
+    def clean_notifications(self, notification_out_path, time_limit):
+        """ Delete notification files whose name, or modification time if the name is not a time, is older than time_limit """
+        try:
+            names = os.listdir(notification_out_path)
+        except OSError:
+            self.queue_logger.warning(f"Cannot list Directory={notification_out_path}")
+            return
+        index = self.indexes.get(notification_out_path) if self.indexes is not None else None
+        for f in names:
+            if os.path.splitext(f)[1] not in NOTIFICATION_EXTENSIONS:
+                continue
+            full_f = os.path.join(notification_out_path, f)
+            file_time = parse_still_time(os.path.splitext(f)[0])
+            if file_time is None:
+                try:
+                    file_time = os.path.getmtime(full_f)
+                except OSError:
+                    continue
+            if file_time < time_limit:
+                self.remove_file(full_f)
+            elif index is not None and full_f not in index.sizes:
+                # Stills go to the Emailer rather than the input queue so they are picked up here
+                self.index_file(full_f, index)
+
+    def full_pass(self, video_out_path, time_limit):
+        """ Delete all the video older than time_limit """
+        try:
+            days = os.listdir(video_out_path)
+        except OSError:
+            self.queue_logger.warning(f"Cannot list Directory={video_out_path}")
+            return
+        for day in days:
+            self.beat()
+            full_day = os.path.join(video_out_path, day)
+            if not os.path.isdir(full_day):
+                continue
+            day_start = parse_time(day, '%Y-%m-%d')
+            if day_start is None:
+                # Not in the Record layout
+                self.clean_by_mtime(full_day, time_limit)
+                continue
+            day_end = (dt.datetime.fromtimestamp(day_start) + dt.timedelta(days=1)).timestamp()
+            if day_end <= time_limit:
+                self.remove_tree(full_day)
+            elif day_start < time_limit:
+                self.clean_day(full_day, day_start, time_limit)
+            else:
+                # Newer than the limit so only files not named by time can have expired
+                self.clean_by_mtime(full_day, time_limit, unparsed_only=True)
+
+    def clean_day(self, full_day, day_start, time_limit):
+        """ Delete the hours and minutes of a day directory that are older than time_limit """
+        for hour in os.listdir(full_day):
+            full_hour = os.path.join(full_day, hour)
+            hour_start = parse_time(f"{os.path.basename(full_day)} {hour}", '%Y-%m-%d %H')
+            if hour_start is None or not os.path.isdir(full_hour):
+                self.clean_by_mtime(full_hour, time_limit)
+            elif hour_start + 3600 <= time_limit:
+                self.remove_tree(full_hour)
+            elif hour_start < time_limit:
+                for f in os.listdir(full_hour):
+                    full_f = os.path.join(full_hour, f)
+                    name, extension = os.path.splitext(f)
+                    if extension not in VIDEO_EXTENSIONS:
+                        continue
+                    minute_start = parse_time(f"{os.path.basename(full_day)} {hour} {name}", '%Y-%m-%d %H %M')
+                    if minute_start is None:
+                        self.clean_by_mtime(full_f, time_limit)
+                    elif minute_start + 60 <= time_limit:
+                        self.remove_file(full_f)
+
+    def incremental_pass(self, video_out_path, cursor, time_limit):
+        """
+        Delete the video that expired between cursor and time_limit
+        The paths are worked out from the times so no directories are listed
+
+        Keyword arguments:
+        video_out_path -- The top of the video directory tree
+
+        cursor -- The time limit of the last pass, everything older than it is already deleted
+
+        time_limit -- The time limit of this pass
+        """
+        # Step through each day, hour and minute boundary between the cursor and the limit
+        day = dt.datetime.fromtimestamp(cursor).replace(hour=0, minute=0, second=0, microsecond=0)
+        while day.timestamp() < time_limit:
+            next_day = day + dt.timedelta(days=1)
+            full_day = os.path.join(video_out_path, day.strftime('%Y-%m-%d'))
+            if next_day.timestamp() <= time_limit:
+                self.remove_tree(full_day)
+            else:
+                hour = max(day, dt.datetime.fromtimestamp(cursor).replace(minute=0, second=0, microsecond=0))
+                while hour.timestamp() < time_limit:
+                    next_hour = hour + dt.timedelta(hours=1)
+                    full_hour = os.path.join(full_day, hour.strftime('%H'))
+                    if next_hour.timestamp() <= time_limit:
+                        self.remove_tree(full_hour)
+                    else:
+                        minute = max(hour, dt.datetime.fromtimestamp(cursor).replace(second=0, microsecond=0))
+                        while (minute + dt.timedelta(minutes=1)).timestamp() <= time_limit:
+                            for extension in VIDEO_EXTENSIONS:
+                                self.remove_file(os.path.join(full_hour, minute.strftime('%M') + extension), missing_ok=True)
+                            minute += dt.timedelta(minutes=1)
+                    hour = next_hour
+            day = next_day
+
+    def clean_by_mtime(self, top, time_limit, unparsed_only=False):
+        """
+        Delete video files under top older than time_limit by their modification time, then any empty directories
+
+        Keyword arguments:
+        top -- The file or directory to clean
+
+        time_limit -- The time in seconds since the epoch files older than are deleted
+
+        unparsed_only -- If True files whose time is in their path are skipped without a stat
+        """
+        if os.path.isfile(top):
+            if os.path.splitext(top)[1] in VIDEO_EXTENSIONS:
                 try:
-                    os.remove(full_f)
+                    if os.path.getmtime(top) < time_limit:
+                        self.remove_file(top)
                 except OSError:
-                    self.queue_logger.warning(f"Cannot Delete={full_f}")
-
-            # Check video_out_path for video that are too old
-            for root, dirs, files in os.walk(video_out_path, topdown=False):
-                # Process the files in the directory
-                for f in files:
-                    if os.path.splitext(f)[1] == ".h264" or os.path.splitext(f)[1] == ".mp4":
-                        # check the age
-                        full_f = os.path.join(root, f)
-                        try:
-                            file_time = os.path.getmtime(full_f)
-                        except OSError:
-                            self.queue_logger.warning(f"Cannot get modification time of File={full_f}")
-                            continue
-
-                        if file_time < time_limit:
-                            self.queue_logger.info(f"Deleting file={full_f}")
-                            try:
-                                os.remove(full_f)
-                            except OSError:
-                                self.queue_logger.warning(f"Cannot Delete File={full_f}")
-
-                # Process the directories to see if any are empty
-                for d in dirs:
-                    full_d = os.path.join(root, d)
-                    if len(os.listdir(full_d)) == 0:
-                        # Directory is empty try to delete it
-                        self.queue_logger.info(f"Deleting directory={full_d}")
-                        try:
-                            os.rmdir(full_d)
-                        except OSError:
-                            self.queue_logger.warning(f"Cannot Delete Directory={full_d}")
-
-
-            # Go to sleep for a bit so not a tight loop
-            # As the record might take up to 1 minute to finish looping every 30 seconds should not delay exit much.
-            time.sleep(30)
-
-
-
-    def join(self, timeout=None):
-        self.queue_logger.info("Cleanup asked to exit")
-        self.stoprequest.set()
-        super(Cleanup, self).join(timeout)
\ No newline at end of file
+                    self.queue_logger.warning(f"Cannot get modification time of File={top}")
+            return
+
+        for root, dirs, files in os.walk(top, topdown=False):
+            self.beat()
+            # Process the files in the directory
+            for f in files:
+                if os.path.splitext(f)[1] in VIDEO_EXTENSIONS:
+                    # check the age
+                    full_f = os.path.join(root, f)
+                    if unparsed_only and file_time_from_path(full_f) is not None:
+                        continue
+                    try:
+                        file_time = os.path.getmtime(full_f)
+                    except OSError:
+                        self.queue_logger.warning(f"Cannot get modification time of File={full_f}")
+                        continue
+
+                    if file_time < time_limit:
+                        self.remove_file(full_f)
+
+            # Process the directories to see if any are empty
+            for d in dirs:
+                full_d = os.path.join(root, d)
+                if len(os.listdir(full_d)) == 0:
+                    # Directory is empty try to delete it
+                    self.queue_logger.info(f"Deleting directory={full_d}")
+                    try:
+                        os.rmdir(full_d)
+                    except OSError:
+                        self.queue_logger.warning(f"Cannot Delete Directory={full_d}")
+
+    def remove_file(self, full_f, missing_ok=False):
+        try:
+            os.remove(full_f)
+        except FileNotFoundError:
+            if not missing_ok:
+                self.queue_logger.warning(f"Cannot Delete File={full_f}")
+            return
+        except OSError:
+            self.queue_logger.warning(f"Cannot Delete File={full_f}")
+            return
+        self.queue_logger.info(f"Deleting file={full_f}")
+        self.removed += 1
+        self.metrics.inc('files_removed')
+        if self.timeline is not None:
+            self.timeline.remove(full_f)
+
+    def remove_tree(self, full_d):
+        if not os.path.isdir(full_d):
+            return
+        self.queue_logger.info(f"Deleting directory={full_d}")
+        try:
+            shutil.rmtree(full_d)
+        except OSError:
+            self.queue_logger.warning(f"Cannot Delete Directory={full_d}")
+            return
+        self.removed += 1
+        self.metrics.inc('directories_removed')
+        if self.timeline is not None:
+            self.timeline.remove_tree(full_d)
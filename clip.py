@@ -0,0 +1,149 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import datetime as dt
+import argparse
+
+import mp4_mux
+import timeline
+import settings
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+def find_segments(config, start, end):
+    """
+    Return the full paths of the MP4 segments that could hold footage from start to end
+
+    The timeline is used if it is enabled, otherwise the paths are worked out from the Record layout
+
+    Keyword arguments:
+    config -- A settings.Settings object
+
+    start -- The time in seconds since the epoch the clip starts
+
+    end -- The time in seconds since the epoch the clip ends
+    """
+    path = timeline.timeline_path(config)
+    if path is not None and os.path.isfile(path):
+        index = timeline.Timeline(path)
+        try:
+            return [segment[0] for segment in index.segments(start, end) if segment[0].endswith('.mp4')]
+        finally:
+            index.close()
+
+    # The segment before the start minute can run on past the minute boundary
+    paths = []
+    minute = dt.datetime.fromtimestamp(start).replace(second=0, microsecond=0) - dt.timedelta(minutes=1)
+    while minute.timestamp() <= end:
+        segment_path = os.path.join(config['RECORD']['video_out_path'], minute.strftime('%Y-%m-%d/%H/%M') + '.mp4')
+        if os.path.isfile(segment_path):
+            paths.append(segment_path)
+        minute += dt.timedelta(minutes=1)
+    return paths
+
+
+def extract(segment_paths, start, end, output_path):
+    """
+    Write the footage from start to end in the segments to one MP4 file without re-encoding
+    Whole GOPs are copied so the clip starts at the key frame before start and ends at the end of the GOP holding end
+    Returns the number of frames written
+
+    Keyword arguments:
+    segment_paths -- The full paths of the MP4 segments, each needs its key frame index
+
+    start -- The time in seconds since the epoch the clip starts
+
+    end -- The time in seconds since the epoch the clip ends
+
+    output_path -- The full path of the MP4 file to write
+    """
+    indexes = []
+    for segment_path in segment_paths:
+        try:
+            indexes.append((mp4_mux.load_index(mp4_mux.index_path(segment_path)), segment_path))
+        except (OSError, ValueError) as e:
+            print(f"Skipping {segment_path}, cannot read its key frame index {e}", file=sys.stderr)
+    indexes.sort(key=lambda index: index[0]['start'])
+
+    frames = 0
+    sps = None
+    with open(output_path, 'wb') as output_fp:
+        writer = None
+        for index, segment_path in indexes:
+            framerate = index['framerate']
+            if sps is None:
+                sps = bytes.fromhex(index['sps'])
+                pps = bytes.fromhex(index['pps'])
+                writer = mp4_mux.Mp4_writer(output_fp, framerate)
+            elif bytes.fromhex(index['sps']) != sps or bytes.fromhex(index['pps']) != pps or framerate != writer_framerate:
+                raise ValueError(f"{segment_path} was recorded with different encoder settings")
+            writer_framerate = framerate
+
+            with open(segment_path, 'rb') as segment_fp:
+                for first_sample, offset, sizes in index['gops']:
+                    gop_start = index['start'] + first_sample / framerate
+                    gop_end = gop_start + len(sizes) / framerate
+                    if gop_end <= start or gop_start > end:
+                        continue
+                    # A GOP is one sequential read
+                    segment_fp.seek(offset)
+                    data = segment_fp.read(sum(sizes))
+                    if len(data) < sum(sizes):
+                        print(f"{segment_path} is shorter than its key frame index", file=sys.stderr)
+                        break
+                    position = 0
+                    for size in sizes:
+                        writer.add_sample(data[position:position + size], position == 0)
+                        position += size
+                    frames += len(sizes)
+        if writer is None or not frames:
+            raise ValueError("No indexed footage found between the start and end")
+        writer.close(sps, pps)
+    return frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the recorded footage between two times to one MP4 file")
+    parser.add_argument('--config', default='security.ini', help="The config file (default security.ini)")
+    parser.add_argument('start', help="Local start time e.g 2019-01-01T14:31:50")
+    parser.add_argument('end', help="Local end time e.g 2019-01-01T14:32:30")
+    parser.add_argument('output', help="The MP4 file to write")
+    args = parser.parse_args()
+
+    try:
+        config = settings.load(args.config)
+    except settings.Settings_error as e:
+        sys.exit(f"{e}")
+    start = timeline.parse_cli_time(args.start)
+    end = timeline.parse_cli_time(args.end)
+    start_time = time.monotonic()
+    segment_paths = find_segments(config, start, end)
+    try:
+        frames = extract(segment_paths, start, end, args.output)
+    except ValueError as e:
+        os.remove(args.output)
+        sys.exit(f"{e}")
+    print(f"Wrote {frames} frames from {len(segment_paths)} segments to {args.output} in {time.monotonic() - start_time:.2f}s")
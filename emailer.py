@@ -17,15 +17,17 @@ __version__ = "0.1"
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import multiprocessing
-import queue
-import time
 import smtplib
 import ssl
 from email.message import EmailMessage
-import logging
-import logging.handlers
 import os
+import time
+import json
+import queue
+import concurrent.futures
+
+import unit
+import migrate
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -33,90 +35,374 @@ import os
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Emailer(multiprocessing.Process):
+# A change to any of these in a reloaded config closes the open connections so the next email reconnects
+SERVER_SETTINGS = ('server', 'port', 'user', 'password', 'starttls', 'timeout')
+
+class Smtp_session:
+    """ A class to keep one authenticated SMTP connection open between emails
+        so each email does not need a new connection, TLS handshake and login
+
+        The connection is opened when the first email is sent, kept alive with NOOP while idle,
+        closed after idle_timeout seconds with nothing to send and reopened if the server drops it
+    """
+    def __init__(self, config, queue_logger):
+        """
+        Initialise the SMTP session class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        queue_logger -- The logger of the unit using the session
+        """
+        self.config = config
+        self.queue_logger = queue_logger
+        self.server = None
+        # Time the connection was last used to send and last used at all
+        self.last_used = 0
+        self.last_activity = 0
+
+    def connect(self):
+        start_time = time.monotonic()
+        server = smtplib.SMTP(self.config['EMAILER']['server'], self.config['EMAILER']['port'], timeout=self.config['EMAILER']['timeout'])
+        try:
+            server.ehlo()
+            if self.config['EMAILER']['starttls']:
+                # Create a secure SSL context
+                context = ssl.create_default_context()
+                server.starttls(context=context)
+                server.ehlo()
+            if self.config['EMAILER']['user']:
+                server.login(self.config['EMAILER']['user'], self.config['EMAILER']['password'])
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.last_used = self.last_activity = time.monotonic()
+        self.queue_logger.debug(f"SMTP connected in {time.monotonic() - start_time:.2f}s")
+
+    def set_config(self, config):
+        """ Use a reloaded config, an open connection is closed if the server settings have changed """
+        if any(config['EMAILER'][key] != self.config['EMAILER'][key] for key in SERVER_SETTINGS):
+            self.close()
+        self.config = config
+
+    def send(self, msg):
+        """ Send a message, reconnecting once if the server has dropped the connection """
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.queue_logger.info("SMTP connection dropped, reconnecting")
+            self.close()
+            self.connect()
+            self.server.send_message(msg)
+        self.last_used = self.last_activity = time.monotonic()
+
+    def keepalive(self):
+        """ Keep an idle connection open with NOOP or close it once it has been idle for idle_timeout """
+        if self.server is None:
+            return
+        now = time.monotonic()
+        if now - self.last_used >= self.config['EMAILER']['idle_timeout']:
+            self.queue_logger.debug("SMTP connection idle, closing")
+            self.close()
+        elif now - self.last_activity >= self.config['EMAILER']['keepalive_seconds']:
+            try:
+                code, message = self.server.noop()
+            except (smtplib.SMTPException, OSError):
+                code = 0
+            if code != 250:
+                # The next send will reconnect
+                self.close()
+            self.last_activity = now
+
+    def next_keepalive(self):
+        """ Return the seconds until keepalive needs calling or None if there is no connection """
+        if self.server is None:
+            return None
+        return max(0, min(self.last_activity + self.config['EMAILER']['keepalive_seconds'], self.last_used + self.config['EMAILER']['idle_timeout']) - time.monotonic())
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+
+class Outbox:
+    """ A class to keep the emails waiting to be sent on disk so they survive network outages and restarts
+
+        Each email is a JSON file named by the time it was queued, holding the images to attach,
+        the number of failed attempts and the time of the next attempt
+    """
+    def __init__(self, path):
+        """
+        Initialise the outbox class
+
+        Keyword arguments:
+        path -- The directory to keep the emails in
+        """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def load(self):
+        """ Return a dictionary of name to email for the emails in the outbox """
+        emails = {}
+        for name in sorted(os.listdir(self.path)):
+            if os.path.splitext(name)[1] != '.json':
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'r') as fp:
+                    emails[name] = json.load(fp)
+            except (OSError, ValueError):
+                continue
+        return emails
+
+    def new(self, images):
+        """ Return the name and email for the images without saving it """
+        email = {'images': images, 'created': time.time(), 'attempts': 0, 'next_attempt': 0}
+        name = f"{time.time_ns()}.json"
+        return name, email
+
+    def save(self, name, email):
+        temp_path = os.path.join(self.path, name + '.tmp')
+        with open(temp_path, 'w') as fp:
+            json.dump(email, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, os.path.join(self.path, name))
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+
+class Emailer(unit.Unit):
     """ A class to Email the image captured when the pir is triggered
+
+        Images arriving within coalesce_seconds of the first are sent together as one email
+        and the SMTP connection is kept open between emails
+
+        Each email is put in an Outbox on disk before it is sent by a pool of max_in_flight sender threads
+        A failed email is retried with exponential backoff, oldest first, until it is max_age_hours old
+        While the server is unreachable only one email is tried at a time, once it gets through the
+        rest of the outbox is sent by all the senders
     """
-    def __init__(self, *, config, log_queue, input_queue):
+    def __init__(self, *, config, log_queue, input_queue, metrics_queue=None):
         """
         Initialise the Emailer class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object to send log messages to
 
-        input_queue -- A queue object containing the location of an image to email
+        input_queue -- A queue object containing the location of an image to email or a list of them
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
         """
-        super(Emailer, self).__init__()
-        self.config = config
-        self.log_queue = log_queue
-        self.input_queue = input_queue
-
-        self.stoprequest = multiprocessing.Event()
-
-        # Setup logging
-        h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
-        self.queue_logger = logging.getLogger(name='Emailer')
-        self.queue_logger.addHandler(h)
-        # apply this unit's logging level
-        log_level = {'CRITICAL': logging.CRITICAL, 'ERROR': logging.ERROR, 'WARNING': logging.WARNING, 'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
-        self.queue_logger.setLevel(log_level[self.config['EMAILER']['log_level']])
+        super(Emailer, self).__init__(config=config, log_queue=log_queue, unit_name='Emailer', config_section='EMAILER', input_queue=input_queue, metrics_queue=metrics_queue)
     
     def run(self):
         self.queue_logger.info("Emailer started")
         print("Emailer started\n")
-        input_queue_message = ""
+        max_in_flight = self.config['EMAILER']['max_in_flight']
+
+        # A SMTP session for each sender, a sender takes one from the pool while it sends
+        self.sessions = queue.Queue()
+        for i in range(max_in_flight):
+            self.sessions.put(Smtp_session(self.config, self.queue_logger))
+        # The outbox is on persistent local storage so emails can be queued while network storage is unreachable
+        outbox = Outbox(self.config['EMAILER']['outbox_path'] or os.path.join(migrate.state_path(self.config), '.outbox'))
+        # Emails waiting to be sent, in the order they were queued
+        emails = outbox.load()
+        if emails:
+            self.queue_logger.info(f"{len(emails)} emails waiting in the outbox")
+        in_flight = set()
+        # Set when the last send failed
+        failing = False
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+        # Images waiting for the coalesce window to end
+        images = []
+        coalesce_end = None
 
         # Loop while not asked to exit
         while not self.stoprequest.is_set():
-            # Handle if a video conversion is requested
-            try:
-                input_queue_message = self.input_queue.get(block=False)
-            except queue.Empty:
-                pass
-
-            if input_queue_message != "":
-                self.queue_logger.info(f"Emailing {input_queue_message}")
-                # Create the container email message.
-                msg = EmailMessage()
-                msg['Subject'] = 'PIR Image'
-                msg['From'] = self.config['EMAILER']['From']
-                msg['To'] = self.config['EMAILER']['To']
-                msg.preamble = 'PIR Image'
-
-                # Add image as attachment
-                with open(input_queue_message, 'rb') as fp:
-                    img_data = fp.read()
-                    filename = os.path.basename(input_queue_message)
-                    msg.add_attachment(img_data, maintype='image', subtype='jpg', filename=filename)
-
-                # Send the email via SMTP server.
-                try:
-                # Create a secure SSL context
-                    context = ssl.create_default_context()
+            now = time.monotonic()
+            # Put the images in the outbox once the coalesce window ends, a message holding a list of images
+            # can take them over max_attachments so they are split into emails of at most max_attachments
+            max_attachments = self.config['EMAILER']['max_attachments']
+            while images and (now >= coalesce_end or len(images) >= max_attachments):
+                name, email = outbox.new(images[:max_attachments])
+                self.save_email(outbox, name, email)
+                emails[name] = email
+                images = images[max_attachments:]
+            if not images:
+                coalesce_end = None
+
+            # Give the senders the oldest emails that are due
+            # While failing only the oldest email is tried until one gets through
+            next_attempt = None
+            for name, email in (list(emails.items())[:1] if failing else emails.items()):
+                if len(in_flight) >= max_in_flight:
+                    break
+                if name in in_flight:
+                    continue
+                if email['next_attempt'] > time.time():
+                    next_attempt = email['next_attempt'] if next_attempt is None else min(next_attempt, email['next_attempt'])
+                    continue
+                in_flight.add(name)
+                self.queue_logger.info(f"Emailing {email['images']}")
+                future = executor.submit(self.send, email['images'])
+                # The result is passed back through the input queue so it wakes up the loop
+                future.add_done_callback(lambda future, name=name: self.input_queue.put(('sent', name) + future.result()))
+
+            # Block until an image arrives, a send finishes, an email is due or a connection needs keeping alive
+            timeouts = [self.keepalive_sessions()]
+            if coalesce_end is not None:
+                timeouts.append(coalesce_end - time.monotonic())
+            if next_attempt is not None:
+                timeouts.append(next_attempt - time.time())
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            self.metrics.set('outbox_emails', len(emails))
+            input_queue_message = self.get_message(timeout=max(0, min(timeouts)) if timeouts else None)
 
-                    server = smtplib.SMTP(self.config['EMAILER']['Server'],int(self.config['EMAILER']['Port']))
-                    server.ehlo()
-                    server.starttls(context=context)
-                    server.ehlo()
-                    server.login(self.config['EMAILER']['User'], self.config['EMAILER']['Password'])
-                    server.send_message(msg)
-                except Exception as e:
-                    # Log any Exception
-                    self.queue_logger.error(f"{e}")
-                finally:
-                    server.quit() 
+            if isinstance(input_queue_message, tuple):
+                name, error, permanent = input_queue_message[1:]
+                in_flight.discard(name)
+                email = emails[name]
+                if error is None:
+                    self.queue_logger.info(f"Emailed {len(email['images'])} images {time.time() - email['created']:.2f}s after they were queued")
+                    self.metrics.inc('emails_sent')
+                    self.metrics.inc('images_sent', len(email['images']))
+                    self.metrics.observe('email_latency_seconds', time.time() - email['created'])
+                    del emails[name]
+                    outbox.remove(name)
+                    failing = False
+                else:
+                    self.queue_logger.error(f"{error}")
+                    self.metrics.inc('email_failures')
+                    email['attempts'] += 1
+                    if permanent or time.time() - email['created'] > self.config['EMAILER']['max_age_hours']*60*60:
+                        self.queue_logger.error(f"Giving up emailing {email['images']} after {email['attempts']} attempts")
+                        self.metrics.inc('emails_abandoned')
+                        del emails[name]
+                        outbox.remove(name)
+                    else:
+                        email['next_attempt'] = time.time() + min(self.config['EMAILER']['max_backoff_seconds'], self.config['EMAILER']['backoff_seconds'] * 2 ** (email['attempts'] - 1))
+                        self.save_email(outbox, name, email)
+                        failing = True
+            elif isinstance(input_queue_message, list):
+                images.extend(input_queue_message)
+                if coalesce_end is None:
+                    coalesce_end = time.monotonic() + self.config['EMAILER']['coalesce_seconds']
+            elif input_queue_message is not None:
+                images.append(input_queue_message)
+                if coalesce_end is None:
+                    coalesce_end = time.monotonic() + self.config['EMAILER']['coalesce_seconds']
 
-                # Clear the message
-                input_queue_message = ""
+        executor.shutdown(wait=True)
+        # Take the emails that were sent while shutting down out of the outbox and keep any images that arrived
+        while not self.input_queue.empty():
+            input_queue_message = self.input_queue.get()
+            if isinstance(input_queue_message, tuple):
+                name, error = input_queue_message[1:3]
+                if error is None:
+                    outbox.remove(name)
+            elif isinstance(input_queue_message, list):
+                images.extend(input_queue_message)
+            elif isinstance(input_queue_message, str):
+                images.append(input_queue_message)
+        # Anything not sent yet is left in the outbox for the next start
+        max_attachments = self.config['EMAILER']['max_attachments']
+        for first in range(0, len(images), max_attachments):
+            name, email = outbox.new(images[first:first + max_attachments])
+            self.save_email(outbox, name, email)
+        while not self.sessions.empty():
+            self.sessions.get().close()
+
+    def save_email(self, outbox, name, email):
+        """ Save an email to the outbox, if it cannot be saved it is only kept in memory until it is sent """
+        try:
+            outbox.save(name, email)
+        except OSError as e:
+            self.queue_logger.error(f"Cannot save email {name} to the outbox {outbox.path} {e}")
+            self.metrics.inc('outbox_errors')
+
+    def send(self, images):
+        """
+        Send an email with the images attached, run in a sender thread
+        Returns (None, False) if it was sent or (error message, True if retrying will not help)
 
+        Keyword arguments:
+        images -- A list of the full paths of the images to attach
+        """
+        try:
+            msg = self.build_message(images)
+        except OSError as e:
+            return (f"{e}", True)
+        session = self.sessions.get()
+        session.set_config(self.config)
+        start_time = time.monotonic()
+        try:
+            session.send(msg)
+        except Exception as e:
+            session.close()
+            return (f"{e}", False)
+        finally:
+            self.sessions.put(session)
+        self.metrics.observe('email_send_seconds', time.monotonic() - start_time)
+        return (None, False)
 
-            # Go to sleep for a bit so not a tight loop
-            time.sleep(0.1)
+    def keepalive_sessions(self):
+        """ Keep alive the sessions not in use, returns the seconds until this needs calling again or None """
+        timeouts = []
+        sessions = []
+        while True:
+            try:
+                sessions.append(self.sessions.get(block=False))
+            except queue.Empty:
+                break
+        for session in sessions:
+            session.set_config(self.config)
+            session.keepalive()
+            timeout = session.next_keepalive()
+            if timeout is not None:
+                timeouts.append(timeout)
+            self.sessions.put(session)
+        return min(timeouts) if timeouts else None
 
+    def build_message(self, images):
+        """
+        Return an EmailMessage with the images attached
+        An image that cannot be read, such as one Cleanup has already deleted, is left out, OSError is raised if none can be read
+        """
+        # Read the images first so the subject counts the ones attached
+        attachments = []
+        for image in images:
+            try:
+                with open(image, 'rb') as fp:
+                    attachments.append((fp.read(), os.path.basename(image)))
+            except OSError as e:
+                self.queue_logger.warning(f"Not attaching {image} {e}")
+        if not attachments:
+            raise OSError(f"None of the images {images} can be read")
 
+        # Create the container email message.
+        msg = EmailMessage()
+        msg['Subject'] = 'PIR Image' if len(attachments) == 1 else f'PIR Images ({len(attachments)})'
+        msg['From'] = self.config['EMAILER']['from']
+        msg['To'] = self.config['EMAILER']['to']
+        msg.preamble = 'PIR Image'
 
-    def join(self, timeout=None):
-        self.queue_logger.info("Emailer asked to exit")
-        self.stoprequest.set()
-        super(Emailer, self).join(timeout)
\ No newline at end of file
+        # Add images as attachments
+        for img_data, filename in attachments:
+            msg.add_attachment(img_data, maintype='image', subtype='jpg', filename=filename)
+        return msg
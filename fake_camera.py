@@ -0,0 +1,397 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+
+import settings
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Annex-B start code put before each NAL unit
+START_CODE = b'\x00\x00\x00\x01'
+# A picture parameter set that goes with every SPS made by sps()
+PPS = b'\x68\xce\x38\x80'
+# Sizes of the synthetic frames in bytes per pixel, about what the encoder makes of a quiet scene at quality 25
+IDR_BYTES_PER_PIXEL = 1 / 20
+P_BYTES_PER_PIXEL = 1 / 200
+# Pixel levels of the JPEG background and the square moving across it
+BACKGROUND_LEVEL = 64
+SQUARE_LEVEL = 192
+
+
+class Bit_writer:
+    """ A class to build the bit fields of a H.264 parameter set """
+    def __init__(self):
+        self.bits = []
+
+    def u(self, bits, value):
+        """ Add value as an unsigned number of bits """
+        for i in range(bits - 1, -1, -1):
+            self.bits.append((value >> i) & 1)
+
+    def ue(self, value):
+        """ Add value as an unsigned Exp-Golomb code """
+        value += 1
+        length = value.bit_length()
+        self.u(length - 1, 0)
+        self.u(length, value)
+
+    def rbsp(self):
+        """ Return the bytes with the stop bit and padding added """
+        bits = self.bits + [1]
+        bits += [0] * (-len(bits) % 8)
+        return bytes(int(''.join(str(bit) for bit in bits[i:i + 8]), 2) for i in range(0, len(bits), 8))
+
+
+def sps(width, height):
+    """ Return a High profile sequence parameter set NAL unit for a resolution, cropped as the camera does """
+    writer = Bit_writer()
+    # profile_idc, constraint flags, level_idc and seq_parameter_set_id
+    writer.u(8, 100)
+    writer.u(8, 0)
+    writer.u(8, 40)
+    writer.ue(0)
+    # 4:2:0 8 bit with no scaling matrices
+    writer.ue(1)
+    writer.ue(0)
+    writer.ue(0)
+    writer.u(1, 0)
+    writer.u(1, 0)
+    # log2_max_frame_num, pic_order_cnt_type, max_num_ref_frames and gaps_in_frame_num_allowed
+    writer.ue(0)
+    writer.ue(2)
+    writer.ue(1)
+    writer.u(1, 0)
+    columns = (width + 15) // 16
+    rows = (height + 15) // 16
+    writer.ue(columns - 1)
+    writer.ue(rows - 1)
+    # frame_mbs_only and direct_8x8_inference
+    writer.u(1, 1)
+    writer.u(1, 1)
+    crop_right = columns * 16 - width
+    crop_bottom = rows * 16 - height
+    if crop_right or crop_bottom:
+        writer.u(1, 1)
+        writer.ue(0)
+        writer.ue(crop_right // 2)
+        writer.ue(0)
+        writer.ue(crop_bottom // 2)
+    else:
+        writer.u(1, 0)
+    # No VUI
+    writer.u(1, 0)
+    return b'\x67' + writer.rbsp()
+
+
+def h264_frame(width, height, index, key_frame, headers):
+    """
+    Return one encoded frame of a synthetic H.264 stream, the slices hold filler rather than a picture
+
+    Keyword arguments:
+    width, height -- The resolution of the stream
+
+    index -- The frame number, it varies the filler
+
+    key_frame -- True for an IDR frame, False for a P frame
+
+    headers -- True to put the SPS and PPS before the frame as inline_headers does
+    """
+    data = b''
+    if headers:
+        data = START_CODE + sps(width, height) + START_CODE + PPS
+    size = max(16, int(width * height * (IDR_BYTES_PER_PIXEL if key_frame else P_BYTES_PER_PIXEL)))
+    # first_mb_in_slice is 0 so every frame is one slice, the filler never holds a start code
+    return data + START_CODE + (b'\x65' if key_frame else b'\x41') + b'\x88' + bytes([index % 200 + 1]) * size
+
+
+def jpeg_segment(marker, payload):
+    return bytes([0xff, marker]) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+
+def jpeg(width, height, position):
+    """
+    Return a greyscale JPEG of a bright square on a dark background
+
+    Only the DC value of each 8x8 block is coded so the image is made quickly at any resolution
+
+    Keyword arguments:
+    width, height -- The resolution of the image
+
+    position -- Moves the square along, the square crosses the image every 100
+    """
+    columns = (width + 7) // 8
+    rows = (height + 7) // 8
+    side = max(1, rows // 4)
+    left = int((columns - side) * (position % 100) / 100)
+    top = (rows - side) // 2
+    # DC is the block mean less 128, a quantiser of 8 leaves it as the level less 128
+    header = b'\xff\xd8'
+    header += jpeg_segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    header += jpeg_segment(0xdb, b'\x00' + bytes([8] * 64))
+    header += jpeg_segment(0xc0, b'\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + b'\x01\x01\x11\x00')
+    # DC codes 0 for no change, 10 for category 7 and 110 for category 8, AC has only end of block as 0
+    header += jpeg_segment(0xc4, b'\x00' + bytes([1, 1, 1] + [0] * 13) + bytes([0, 7, 8]))
+    header += jpeg_segment(0xc4, b'\x10' + bytes([1] + [0] * 15) + b'\x00')
+    header += jpeg_segment(0xda, b'\x01\x01\x00\x00\x3f\x00')
+
+    bits = []
+    previous = 0
+    for row in range(rows):
+        for column in range(columns):
+            inside = top <= row < top + side and left <= column < left + side
+            dc = (SQUARE_LEVEL if inside else BACKGROUND_LEVEL) - 128
+            difference = dc - previous
+            previous = dc
+            if difference == 0:
+                bits.append('0')
+            else:
+                category = abs(difference).bit_length()
+                value = difference if difference > 0 else difference + (1 << category) - 1
+                bits.append(('10' if category == 7 else '110') + format(value, f'0{category}b'))
+            bits.append('0')
+    bits = ''.join(bits)
+    bits += '1' * (-len(bits) % 8)
+    scan = int(bits, 2).to_bytes(len(bits) // 8, 'big').replace(b'\xff', b'\xff\x00')
+    return header + scan + b'\xff\xd9'
+
+
+class PiVideoFrameType:
+    """ The frame types of picamera.PiVideoFrameType """
+    frame = 0
+    key_frame = 1
+    sps_header = 2
+    motion_data = 3
+
+
+PiVideoFrame = collections.namedtuple('PiVideoFrame', ('index', 'frame_type', 'frame_size', 'video_size', 'split_size', 'timestamp', 'complete'))
+
+
+class Color:
+    """ Stands in for picamera.Color, only the name is kept """
+    def __init__(self, name):
+        self.name = name
+
+
+class PiCameraError(Exception):
+    pass
+
+
+class Encoder:
+    """ A class to write synthetic frames to an output from a thread at the camera framerate, one per splitter port """
+    def __init__(self, camera, output, format, resize, options):
+        self.camera = camera
+        self.output = self.open(output)
+        self.format = format
+        self.resolution = settings.resolution(resize) if isinstance(resize, str) else tuple(resize or camera.resolution)
+        self.intra_period = options.get('intra_period') or 60
+        self.inline_headers = options.get('inline_headers', True)
+        self.motion_output = options.get('motion_output')
+        # Motion data is a (x, y, sad) record of 4 bytes for each macroblock and the extra column
+        self.motion_size = ((self.resolution[0] + 15) // 16 + 1) * ((self.resolution[1] + 15) // 16) * 4
+        self.frame = None
+        self.error = None
+        self.key_frame_requested = False
+        self.split_output = None
+        self.split_done = threading.Event()
+        self.stoprequest = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def open(output):
+        """ Return a file for a path or the output itself """
+        return open(output, 'wb') if isinstance(output, str) else output
+
+    def run(self):
+        interval = 1 / self.camera.framerate
+        next_frame = time.monotonic()
+        index = 0
+        since_key_frame = None
+        try:
+            while not self.stoprequest.is_set():
+                # Frames keep to the framerate however long the outputs took, late frames are dropped like the camera does
+                now = time.monotonic()
+                if now < next_frame:
+                    self.stoprequest.wait(next_frame - now)
+                    continue
+                skipped = int((now - next_frame) / interval)
+                index += skipped
+                next_frame += (skipped + 1) * interval
+                timestamp = int((now - self.camera.start_time) * 1000000)
+                if self.format == 'h264':
+                    # The headers start the stream and, with inline_headers, every key frame
+                    headers = since_key_frame is None
+                    key_frame = headers or since_key_frame + 1 >= self.intra_period or self.key_frame_requested
+                    if key_frame:
+                        headers = headers or self.inline_headers
+                        self.key_frame_requested = False
+                        since_key_frame = 0
+                        # A split happens on a key frame so the new output starts with the headers
+                        if self.split_output is not None:
+                            self.output = self.open(self.split_output)
+                            self.split_output = None
+                            self.split_done.set()
+                    else:
+                        since_key_frame += 1
+                    data = h264_frame(*self.resolution, index, key_frame, headers)
+                    self.output.write(data)
+                    frame_type = PiVideoFrameType.key_frame if key_frame else PiVideoFrameType.frame
+                    if self.motion_output is not None:
+                        self.motion_output.write(bytes(self.motion_size))
+                else:
+                    data = jpeg(*self.resolution, index)
+                    frame_type = PiVideoFrameType.frame
+                    self.output.write(data)
+                self.frame = PiVideoFrame(index, frame_type, len(data), None, None, timestamp, True)
+                index += 1
+        except Exception as e:
+            # Raised from wait_recording as picamera does
+            self.error = e
+        self.split_done.set()
+
+    def split(self, output, timeout):
+        self.split_done.clear()
+        self.split_output = output
+        if not self.split_done.wait(timeout) or self.error is not None:
+            raise PiCameraError("Timed out waiting for a split point")
+
+    def stop(self):
+        self.stoprequest.set()
+        self.thread.join()
+        if hasattr(self.output, 'flush'):
+            self.output.flush()
+
+
+class PiCamera:
+    """ Stands in for the part of picamera.PiCamera that Record uses so the recording can run without a camera
+
+        Each recording is a thread writing synthetic H.264 or MJPEG frames to its output at the framerate,
+        the files written are real and go through the rest of the pipeline as recordings do
+    """
+    def __init__(self, sensor_mode=0, resolution=(1640, 1232), framerate=25):
+        """
+        Initialise the fake camera class
+
+        Keyword arguments:
+        sensor_mode -- Ignored, it is there so the fake is called as the camera is
+
+        resolution -- A (width, height) tuple or WIDTHxHEIGHT string
+
+        framerate -- The frames per second of every recording
+        """
+        self.resolution = settings.resolution(resolution) if isinstance(resolution, str) else tuple(resolution)
+        self.framerate = framerate
+        self.hflip = False
+        self.vflip = False
+        self.annotate_background = None
+        self.annotate_text = ''
+        self.start_time = time.monotonic()
+        # Encoder of each splitter port
+        self.encoders = {}
+
+    @property
+    def frame(self):
+        """ The last frame written on splitter port 1 """
+        encoder = self.encoders.get(1)
+        return encoder.frame if encoder is not None else None
+
+    def encoder(self, splitter_port):
+        try:
+            return self.encoders[splitter_port]
+        except KeyError:
+            raise PiCameraError(f"There is no recording on port {splitter_port}")
+
+    def start_recording(self, output, format=None, splitter_port=1, resize=None, **options):
+        if splitter_port in self.encoders:
+            raise PiCameraError(f"The camera is already recording on port {splitter_port}")
+        if format not in ('h264', 'mjpeg'):
+            raise PiCameraError(f"Format {format} is not supported")
+        self.encoders[splitter_port] = Encoder(self, output, format, resize, options)
+
+    def split_recording(self, output, splitter_port=1):
+        self.encoder(splitter_port).split(output, timeout=max(2, 2 * self.encoder(splitter_port).intra_period / self.framerate))
+
+    def request_key_frame(self, splitter_port=1):
+        self.encoder(splitter_port).key_frame_requested = True
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        encoder = self.encoder(splitter_port)
+        if encoder.error is not None:
+            raise encoder.error
+        if timeout:
+            time.sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        self.encoder(splitter_port).stop()
+        del self.encoders[splitter_port]
+
+    def capture(self, output, format='jpeg', use_video_port=False, resize=None, quality=85):
+        resolution = settings.resolution(resize) if isinstance(resize, str) else tuple(resize or self.resolution)
+        data = jpeg(*resolution, int((time.monotonic() - self.start_time) * self.framerate))
+        if isinstance(output, str):
+            with open(output, 'wb') as fp:
+                fp.write(data)
+        else:
+            output.write(data)
+
+    def close(self):
+        for splitter_port in list(self.encoders):
+            self.stop_recording(splitter_port)
+
+
+class PiCameraCircularIO:
+    """ Stands in for picamera.PiCameraCircularIO, keeps the most recent size bytes of the frames written to it
+
+        Every write from a fake Encoder is one whole frame, with its headers if it has them
+    """
+    def __init__(self, camera, size, splitter_port=1):
+        self.camera = camera
+        self.size = size
+        self.splitter_port = splitter_port
+        # (monotonic time, starts with a SPS, frame bytes) oldest first
+        self.frames = collections.deque()
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.frames.append((time.monotonic(), data[4:5] == b'\x67', bytes(data)))
+            self.length += len(data)
+            while self.length > self.size:
+                self.length -= len(self.frames.popleft()[2])
+        return len(data)
+
+    def copy_to(self, output, seconds=None, first_frame=PiVideoFrameType.sps_header):
+        """ Write the last seconds of frames to output, starting at the first SPS header if first_frame asks for one """
+        with self.lock:
+            frames = list(self.frames)
+        if seconds is not None and frames:
+            frames = [frame for frame in frames if frame[0] >= frames[-1][0] - seconds]
+        if first_frame == PiVideoFrameType.sps_header:
+            while frames and not frames[0][1]:
+                frames.pop(0)
+        for frame in frames:
+            output.write(frame[2])
@@ -0,0 +1,172 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+
+def parse_time(text):
+    """ Return the seconds of a number of seconds or a HH:MM:SS time of day """
+    if ':' in text:
+        hours, minutes, seconds = text.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return float(text)
+
+
+def load_trace(path):
+    """
+    Return the (seconds, level) edges of a PIR trace file, oldest first and relative to the first line
+
+    Each line is a time and the level the PIR output changed to, 1 or 0, blank lines and lines starting with # are skipped
+    The time is seconds or a HH:MM:SS time of day so a trace can be scripted or taken from a log of a real day
+
+    Keyword arguments:
+    path -- The full path of the trace file
+    """
+    edges = []
+    with open(path, 'r') as fp:
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                seconds, level = line.split()
+                edges.append((parse_time(seconds), int(level)))
+            except ValueError:
+                raise ValueError(f"{path} line {number} is not a time and a level")
+            if edges[-1][1] not in (0, 1):
+                raise ValueError(f"{path} line {number} level is not 1 or 0")
+    edges.sort(key=lambda edge: edge[0])
+    return [(seconds - edges[0][0], level) for seconds, level in edges]
+
+
+class Fake_gpio:
+    """ Stands in for the part of RPi.GPIO that Pir uses, the input level is played back from a trace
+
+        The trace is played from the time the pin is set up, speed times faster than it was recorded
+        The bouncetime of the edge detection is taken in trace time so the same edges get through at any speed
+        Callbacks are run in the playback thread as RPi.GPIO runs them in a thread of its own
+
+        If there is an edge log the wall clock time and the trace time of each callback is written to it,
+        this is what replay.py measures latency from
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, edges, *, speed=1, edge_log=None):
+        """
+        Initialise the fake GPIO class
+
+        Keyword arguments:
+        edges -- A list of (seconds, level) from load_trace, an empty list leaves the input low
+
+        speed -- How many times faster than real time to play the trace
+
+        edge_log -- The full path of a file to append the callback times to or None
+        """
+        self.edges = edges
+        self.speed = speed
+        self.edge_log = edge_log
+        self.channel = None
+        self.level = self.LOW
+        # Edge detection as (edge, callback, bouncetime in seconds) and the trace time of the last callback
+        self.detect = None
+        self.last_callback = None
+        self.changed = threading.Condition()
+        self.stoprequest = threading.Event()
+        self.thread = None
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None):
+        self.channel = channel
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.play, daemon=True)
+            self.thread.start()
+
+    def input(self, channel):
+        return self.level
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """ Wait for an edge, returns the channel or None after timeout milliseconds """
+        end = None if timeout is None else time.monotonic() + timeout / 1000
+        with self.changed:
+            level = self.level
+            while True:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+                if self.level != level:
+                    if edge == self.BOTH or (edge == self.RISING) == (self.level == self.HIGH):
+                        return channel
+                    level = self.level
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=0):
+        self.detect = (edge, callback, bouncetime / 1000)
+
+    def remove_event_detect(self, channel):
+        self.detect = None
+
+    def cleanup(self):
+        self.stoprequest.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.detect = None
+
+    def play(self):
+        start = time.monotonic()
+        for seconds, level in self.edges:
+            if self.stoprequest.wait(max(0, start + seconds / self.speed - time.monotonic())):
+                return
+            if level == self.level:
+                continue
+            with self.changed:
+                self.level = level
+                self.changed.notify_all()
+            detect = self.detect
+            if detect is None or detect[1] is None:
+                continue
+            edge, callback, bouncetime = detect
+            if edge != self.BOTH and (edge == self.RISING) != (level == self.HIGH):
+                continue
+            if self.last_callback is not None and seconds - self.last_callback < bouncetime:
+                continue
+            self.last_callback = seconds
+            if self.edge_log is not None:
+                with open(self.edge_log, 'a') as fp:
+                    fp.write(f"{time.time():.6f} {seconds:.3f}\n")
+            callback(self.channel)
@@ -0,0 +1,147 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+class Frame_ring:
+    """ A file like output for a MJPEG splitter port that keeps the last N frames
+        Each frame is stored in a preallocated buffer so no memory is allocated per frame
+
+        As every frame is already a JPEG a still can be written to disk without encoding
+        The JPEG size is used as the measure of the best frame, blurred or featureless
+        frames compress to smaller files than sharp frames with detail in them
+
+        While share_latest is set the newest frame is also kept as one bytes object that
+        any number of readers can wait for with wait_frame, this is what the live view serves
+    """
+    def __init__(self, frames, frame_size):
+        """
+        Initialise the frame ring class
+
+        Keyword arguments:
+        frames -- The number of frames to keep
+
+        frame_size -- The size in bytes of each frame buffer, larger frames are dropped
+        """
+        self.buffers = [bytearray(frame_size) for i in range(frames)]
+        self.lengths = [0] * frames
+        # None marks a buffer that does not hold a complete frame
+        self.timestamps = [None] * frames
+        self.lock = threading.Lock()
+        # Frames dropped because they did not fit in a buffer
+        self.dropped = 0
+        self.slot = 0
+        self.length = 0
+        self.overflow = False
+        # Count of complete frames and the (sequence, timestamp, jpeg bytes) of the newest one if shared
+        self.sequence = 0
+        self.share_latest = False
+        self.latest = None
+        self.new_frame = threading.Condition(self.lock)
+
+    def write(self, data):
+        # Each frame starts with a JPEG SOI marker
+        if data[:2] == b'\xff\xd8':
+            # Move on to the oldest buffer and mark it as not holding a complete frame
+            with self.lock:
+                self.slot = (self.slot + 1) % len(self.buffers)
+                self.timestamps[self.slot] = None
+            self.length = 0
+            self.overflow = False
+
+        if not self.overflow:
+            end = self.length + len(data)
+            if end > len(self.buffers[self.slot]):
+                self.overflow = True
+                self.dropped += 1
+            else:
+                self.buffers[self.slot][self.length:end] = data
+                self.length = end
+
+        # Each frame ends with a JPEG EOI marker
+        if not self.overflow and data[-2:] == b'\xff\xd9':
+            with self.lock:
+                self.lengths[self.slot] = self.length
+                self.timestamps[self.slot] = time.monotonic()
+                self.sequence += 1
+                if self.share_latest:
+                    # One copy however many readers there are, readers never hold up the encoder
+                    self.latest = (self.sequence, self.timestamps[self.slot], bytes(self.buffers[self.slot][:self.length]))
+                    self.new_frame.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def wait_frame(self, sequence, timeout=None):
+        """
+        Return (sequence, timestamp, jpeg bytes) of the newest frame once it is newer than sequence or None on timeout
+        A reader that is slower than the camera gets the newest frame and skips the ones in between
+
+        Keyword arguments:
+        sequence -- The sequence of the last frame the reader had, 0 for the first
+
+        timeout -- The maximum number of seconds to wait
+        """
+        with self.new_frame:
+            if self.new_frame.wait_for(lambda: self.latest is not None and self.latest[0] > sequence, timeout):
+                return self.latest
+            return None
+
+    def best_frame(self, start, end):
+        """
+        Return (jpeg bytes, timestamp) of the best frame between start and end or None if there are no frames
+
+        Keyword arguments:
+        start -- The earliest time.monotonic() timestamp of the window
+
+        end -- The latest time.monotonic() timestamp of the window
+        """
+        with self.lock:
+            best = None
+            for i, timestamp in enumerate(self.timestamps):
+                if timestamp is not None and start <= timestamp <= end:
+                    if best is None or self.lengths[i] > self.lengths[best]:
+                        best = i
+            if best is None:
+                return None
+            return bytes(self.buffers[best][:self.lengths[best]]), self.timestamps[best]
+
+    def frames(self, start, end, count):
+        """
+        Return a list of up to count jpeg bytes from between start and end, the best frame first
+        and the rest spread evenly over the window in time order
+
+        Keyword arguments:
+        start -- The earliest time.monotonic() timestamp of the window
+
+        end -- The latest time.monotonic() timestamp of the window
+
+        count -- The maximum number of frames to return
+        """
+        with self.lock:
+            window = sorted((timestamp, i) for i, timestamp in enumerate(self.timestamps) if timestamp is not None and start <= timestamp <= end)
+            if not window:
+                return []
+            best = max(window, key=lambda frame: self.lengths[frame[1]])
+            window.remove(best)
+            step = len(window) / (count - 1) if count > 1 and window else 0
+            others = [window[int(n * step)] for n in range(min(count - 1, len(window)))]
+            return [bytes(self.buffers[i][:self.lengths[i]]) for timestamp, i in [best] + others]
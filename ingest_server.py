@@ -0,0 +1,185 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import hashlib
+import argparse
+import threading
+import socketserver
+import http.server
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Upload paths are /upload/<camera>/<path of the file under the camera>
+UPLOAD_PATH = re.compile(r'^/upload/([A-Za-z0-9._-]+)/([A-Za-z0-9._/-]+)$')
+# Extension of a file still being received
+PART_EXTENSION = '.part'
+# Largest chunk accepted in one request
+MAX_CHUNK = 64*1024*1024
+
+
+def file_sha256(path, chunk_size=1024*1024):
+    """ Return the hex SHA-256 of a file """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class Ingest_handler(http.server.BaseHTTPRequestHandler):
+    """ Receive resumable uploads from the Shipper units
+
+        HEAD returns the Upload-Offset already received, with Upload-Complete and Upload-Sha256 once the file is finished
+        PUT appends the body at Upload-Offset, a wrong offset gets 409 with the offset the server has
+        POST checks the received file against Upload-Length and Upload-Sha256 and moves it into place
+    """
+    # Keep alive so a shipper can send many chunks on one connection
+    protocol_version = 'HTTP/1.1'
+
+    def parse_path(self):
+        """ Return the full path of the upload on disk or None after sending an error """
+        if self.server.token and self.headers.get('Authorization') != f"Bearer {self.server.token}":
+            self.send_reply(401)
+            return None
+        match = UPLOAD_PATH.match(self.path)
+        if match is None or '..' in match.group(2).split('/'):
+            self.send_reply(404)
+            return None
+        return os.path.join(self.server.root, match.group(1), *match.group(2).split('/'))
+
+    def send_reply(self, code, headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self.parse_path()
+        if path is None:
+            return
+        with self.server.path_lock(path):
+            if os.path.isfile(path):
+                self.send_reply(200, {'Upload-Offset': str(os.path.getsize(path)), 'Upload-Complete': '1', 'Upload-Sha256': file_sha256(path)})
+            elif os.path.isfile(path + PART_EXTENSION):
+                self.send_reply(200, {'Upload-Offset': str(os.path.getsize(path + PART_EXTENSION))})
+            else:
+                self.send_reply(404)
+
+    def do_PUT(self):
+        path = self.parse_path()
+        if path is None:
+            return
+        try:
+            offset = int(self.headers['Upload-Offset'])
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_reply(400)
+            return
+        if length > MAX_CHUNK:
+            self.send_reply(413)
+            return
+        # Read the body before anything else so the connection can be kept alive
+        data = self.rfile.read(length)
+        if len(data) < length:
+            self.close_connection = True
+            return
+        part_path = path + PART_EXTENSION
+        with self.server.path_lock(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            size = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if offset != size:
+                self.send_reply(409, {'Upload-Offset': str(size)})
+                return
+            with open(part_path, 'ab') as fp:
+                fp.write(data)
+            self.send_reply(204, {'Upload-Offset': str(size + length)})
+
+    def do_POST(self):
+        path = self.parse_path()
+        if path is None:
+            return
+        part_path = path + PART_EXTENSION
+        with self.server.path_lock(path):
+            if not os.path.isfile(part_path):
+                self.send_reply(404)
+                return
+            size = os.path.getsize(part_path)
+            sha256 = file_sha256(part_path)
+            if str(size) != self.headers.get('Upload-Length') or sha256 != self.headers.get('Upload-Sha256'):
+                # Start again rather than keep a corrupt file
+                os.remove(part_path)
+                self.send_reply(422, {'Upload-Offset': '0'})
+                return
+            with open(part_path, 'rb') as fp:
+                os.fsync(fp.fileno())
+            os.replace(part_path, path)
+            self.send_reply(201, {'Upload-Sha256': sha256})
+        # The file is finished so its lock is not needed again
+        self.server.release_path(path)
+        self.log_message("Received %s %d bytes", path, size)
+
+
+class Ingest_server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ A threaded server so many cameras can upload at once, each file has a lock so only one request changes it at a time """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root, token=''):
+        super(Ingest_server, self).__init__(address, Ingest_handler)
+        self.root = root
+        self.token = token
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def path_lock(self, path):
+        with self.locks_lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def release_path(self, path):
+        with self.locks_lock:
+            self.locks.pop(path, None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Receive segments uploaded by the Shipper unit of one or more cameras")
+    parser.add_argument('--root', required=True, help="The directory to store the footage in, a sub directory is made for each camera")
+    parser.add_argument('--bind', default='0.0.0.0', help="The address to listen on (default 0.0.0.0)")
+    parser.add_argument('--port', type=int, default=8080, help="The port to listen on (default 8080)")
+    parser.add_argument('--token', default='', help="A shared token the shippers must send")
+    args = parser.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    server = Ingest_server((args.bind, args.port), args.root, args.token)
+    print(f"Ingest server on {args.bind}:{args.port} storing in {args.root}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
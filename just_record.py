@@ -22,10 +22,6 @@ __version__ = "0.1"
 import multiprocessing
 import signal
 import sys
-import configparser
-import logging
-import logging.handlers
-import time
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -33,26 +29,25 @@ import time
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
+import logging
+import logging.handlers
+
 import record
 import log_listener
 import mp4_convert
+import settings
+import supervisor
 
 def signal_handler(sig, frame):
-    # Wait for the recording and logging units to complete
-    record_unit.join()
-    # Give mp4_unit time to convert last video
-    time.sleep(5)
-    mp4_unit.join()
-    # Send a None message to logger as this has a different method to shutdown
-    log_queue.put_nowait(None)
-    logging_unit.join()
-    print("Exited cleanly")
-    sys.exit(0)
+    # The supervisor stops the units once this returns
+    unit_supervisor.stop_requested = True
 
 if __name__ == '__main__':
     # Read the config file
-    config = configparser.ConfigParser()
-    config.read('security.ini')
+    try:
+        config = settings.load('security.ini')
+    except settings.Settings_error as e:
+        sys.exit(f"{e}")
 
     # Set SIGINT to be ignored before child units are created
     signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -63,23 +58,36 @@ if __name__ == '__main__':
     logging_unit = log_listener.Log_listener(config=config, log_queue=log_queue)
     # Start this early to capture all logs
     logging_unit.start()
+    queue_logger = logging.getLogger(name='Just_record')
+    queue_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    queue_logger.setLevel(config['SECURITY']['log_level'])
 
     # Create input and output queues to communicate to record unit
     record_input = multiprocessing.Queue()
     record_notification_output = multiprocessing.Queue()
-    record_video_output = multiprocessing.Queue()
-
-    # Create record unit
-    record_unit = record.Record(config=config, log_queue=log_queue, input_queue=record_input, notification_output_queue=record_notification_output, video_output_queue=record_video_output)
-
-    # Create the Mp4_convert unit
-    mp4_unit = mp4_convert.Mp4_convert(config=config, log_queue=log_queue, input_queue=record_video_output)
+    # Fragmented MP4 recordings need no conversion so there is no mp4 unit to read the video output
+    if config['RECORD']['container'] == 'mp4':
+        record_video_output = None
+    else:
+        record_video_output = multiprocessing.Queue()
+
+    # The supervisor restarts a unit that fails, the record unit is stopped before the mp4 unit so its last segment is converted
+    unit_supervisor = supervisor.Supervisor(config, queue_logger)
+    unit_supervisor.add('Record', lambda config: record.Record(config=config, log_queue=log_queue, input_queue=record_input, notification_output_queue=record_notification_output, video_output_queue=record_video_output), 0)
+    # Create the Mp4_convert unit if there is anything to convert
+    if record_video_output is not None:
+        unit_supervisor.add('Mp4_convert', lambda config: mp4_convert.Mp4_convert(config=config, log_queue=log_queue, input_queue=record_video_output), 1)
 
     # Start all units
-    record_unit.start()
-    mp4_unit.start()
+    unit_supervisor.start()
 
     # Add signal handler back
     signal.signal(signal.SIGINT, signal_handler)
-    print("Press Ctrl+C to cleanly exit (this could take up to a minute to happen)")
-    signal.pause()
+    print("Press Ctrl+C to cleanly exit")
+    # Watch the units until asked to exit, then stop them
+    unit_supervisor.run()
+
+    # Send a None message to logger as this has a different method to shutdown
+    log_queue.put_nowait(None)
+    logging_unit.join()
+    print("Exited cleanly")
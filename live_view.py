@@ -0,0 +1,195 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import json
+import threading
+import socketserver
+import http.server
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+PAGE = b"""<html>
+<head><title>PIR Security live view</title></head>
+<body style="margin:0;background:black">
+<img src="/stream.mjpg" style="width:100%">
+</body>
+</html>
+"""
+
+BOUNDARY = 'FRAME'
+
+
+class Client_stats:
+    """ The frames sent and dropped and the lag of one live view client """
+    def __init__(self, address):
+        self.address = address
+        self.connected = time.monotonic()
+        self.frames = 0
+        self.dropped = 0
+        # Seconds from the frame being captured to it being sent
+        self.lag = 0
+        self.worst_lag = 0
+
+    def as_dict(self):
+        return {'address': self.address, 'seconds': round(time.monotonic() - self.connected, 1), 'frames': self.frames,
+                'dropped': self.dropped, 'lag_ms': round(self.lag * 1000, 1), 'worst_lag_ms': round(self.worst_lag * 1000, 1)}
+
+
+class Live_view_handler(http.server.BaseHTTPRequestHandler):
+    """ Serve the page, the MJPEG stream and the client stats """
+    def do_GET(self):
+        if self.path == '/':
+            self.send_body(PAGE, 'text/html')
+        elif self.path == '/stream.mjpg':
+            self.stream()
+        elif self.path == '/stats':
+            self.send_body(json.dumps(self.server.live_view.client_stats()).encode(), 'application/json')
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self):
+        live_view = self.server.live_view
+        stats = live_view.add_client(self.client_address[0])
+        if stats is None:
+            self.send_error(503, "Too many live view clients")
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+            self.end_headers()
+            sequence = 0
+            next_frame = 0
+            while not live_view.stopping:
+                frame = live_view.ring.wait_frame(sequence, timeout=1)
+                if frame is None:
+                    continue
+                if sequence:
+                    # Frames that arrived while this client was sending are skipped
+                    stats.dropped += frame[0] - sequence - 1
+                sequence, timestamp, jpeg = frame
+                if time.monotonic() < next_frame:
+                    continue
+                next_frame = time.monotonic() + live_view.frame_interval
+                self.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'.encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+                stats.frames += 1
+                stats.lag = time.monotonic() - timestamp
+                stats.worst_lag = max(stats.worst_lag, stats.lag)
+        except OSError:
+            # The client went away or was too slow to take a frame within the socket timeout
+            pass
+        finally:
+            live_view.remove_client(stats)
+
+    def log_message(self, format, *args):
+        # Requests are logged by Live_view
+        pass
+
+
+class Live_view_server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Live_view:
+    """ A class to serve the frames of a Frame_ring as a MJPEG stream to web browsers
+
+        It runs in threads of the process holding the camera and reads the newest frame of the ring,
+        every client gets the same frame object so there is a single copy of each frame however many
+        clients there are. A client that cannot keep up gets the newest frame each time and skips
+        the rest, so a slow client only gets a lower frame rate and never holds up the camera
+    """
+    def __init__(self, ring, queue_logger, *, bind='0.0.0.0', port=8000, max_clients=4, max_fps=0, client_timeout=10):
+        """
+        Initialise the live view class
+
+        Keyword arguments:
+        ring -- The Frame_ring on the MJPEG splitter port
+
+        queue_logger -- The logger of the unit holding the camera
+
+        bind, port -- The address and port to serve on
+
+        max_clients -- The maximum number of clients streaming at once
+
+        max_fps -- The maximum frames per second sent to a client, 0 is the camera framerate
+
+        client_timeout -- Seconds a client can take to accept a frame before it is disconnected
+        """
+        self.ring = ring
+        self.queue_logger = queue_logger
+        self.max_clients = max_clients
+        self.frame_interval = 1 / max_fps if max_fps else 0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.server = Live_view_server((bind, port), Live_view_handler)
+        self.server.live_view = self
+        self.server.timeout = client_timeout
+        Live_view_handler.timeout = client_timeout
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.queue_logger.info(f"Live view on http://{self.server.server_address[0]}:{self.server.server_address[1]}/")
+
+    def add_client(self, address):
+        """ Return the Client_stats of a new client or None if there are too many clients """
+        with self.lock:
+            if len(self.clients) >= self.max_clients:
+                self.queue_logger.warning(f"Live view client {address} refused, {len(self.clients)} clients already")
+                return None
+            stats = Client_stats(address)
+            self.clients.append(stats)
+            # Only share the frames while someone is watching
+            self.ring.share_latest = True
+        self.queue_logger.info(f"Live view client {address} connected")
+        return stats
+
+    def remove_client(self, stats):
+        with self.lock:
+            self.clients.remove(stats)
+            if not self.clients:
+                self.ring.share_latest = False
+                self.ring.latest = None
+        self.queue_logger.info(f"Live view client {stats.address} disconnected {stats.as_dict()}")
+
+    def client_stats(self):
+        """ Return a list of the stats of each client as dictionaries """
+        with self.lock:
+            return [stats.as_dict() for stats in self.clients]
+
+    def stop(self):
+        self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
@@ -18,7 +18,7 @@ __version__ = "0.1"
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import multiprocessing
-import time
+import threading
 import logging
 import logging.handlers
 import os
@@ -29,21 +29,31 @@ import os
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Log_listener(multiprocessing.Process):
+class Log_listener:
     """ A class to recieve the log messages from other units
+        It runs in its own process, or as a thread of security.py with runtime=thread
     """
     def __init__(self, *, config, log_queue):
         """
         Initialise the log_listener class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object containing a log messages from other units
         """
-        super(Log_listener, self).__init__()
         self.config = config
         self.log_queue = log_queue
+        if self.config['SECURITY']['runtime'] == 'process':
+            self.worker = multiprocessing.Process(target=self.run, name='Log_listener')
+        else:
+            self.worker = threading.Thread(target=self.run, name='Log_listener')
+
+    def start(self):
+        self.worker.start()
+
+    def join(self, timeout=None):
+        self.worker.join(timeout)
     
     def run(self):
         print("Logging started\n")
@@ -56,8 +66,9 @@ class Log_listener(multiprocessing.Process):
 
         # Configure the log listener
         root = logging.getLogger()
-        h = logging.handlers.TimedRotatingFileHandler(self.config['LOGGING']['log_filename'], when='midnight', backupCount=int(self.config['LOGGING']['backup_count']))
-        f = logging.Formatter('%(asctime)s %(process)d %(processName)-14s %(levelname)-8s %(message)s')
+        h = logging.handlers.TimedRotatingFileHandler(self.config['LOGGING']['log_filename'], when='midnight', backupCount=self.config['LOGGING']['backup_count'])
+        # The logger name is the unit name, the process name is the same for all the units run as threads
+        f = logging.Formatter('%(asctime)s %(process)d %(name)-17s %(levelname)-8s %(message)s')
         h.setFormatter(f)
         root.addHandler(h)
 
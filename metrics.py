@@ -0,0 +1,145 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Prefix of every exported metric name
+PREFIX = 'pir_security'
+# Default histogram bucket upper bounds in seconds
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Metrics:
+    """ A class holding one unit's counters, gauges and histograms
+
+        Updates only change local dictionaries so they cost next to nothing in the unit's loop
+        A snapshot of everything is sent to the metrics queue at most every flush_seconds,
+        as each snapshot holds the running totals a lost or late snapshot does no harm
+        With no metrics queue the updates are kept but never sent
+    """
+    def __init__(self, metrics_queue, unit_name, flush_seconds=5):
+        """
+        Initialise the metrics class
+
+        Keyword arguments:
+        metrics_queue -- A queue object to send snapshots to or None
+
+        unit_name -- The name of the unit the metrics belong to, exported as the unit label
+
+        flush_seconds -- The minimum number of seconds between snapshots
+        """
+        self.metrics_queue = metrics_queue
+        self.unit_name = unit_name
+        self.flush_seconds = flush_seconds
+        self.counters = {}
+        self.gauges = {}
+        # Histograms are name -> [bucket bounds, bucket counts, sum, count]
+        self.histograms = {}
+        self.dirty = False
+        self.last_flush = 0
+        # Units update metrics from their helper threads too
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        """ Add value to the counter name """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.dirty = True
+
+    def set(self, name, value):
+        """ Set the gauge name to value """
+        with self.lock:
+            self.gauges[name] = value
+            self.dirty = True
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS):
+        """ Add value to the histogram name, buckets is only used the first time name is seen """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [buckets, [0] * len(buckets), 0, 0]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+            self.dirty = True
+
+    def flush(self, force=False):
+        """
+        Send a snapshot to the metrics queue if anything changed and flush_seconds has passed
+
+        Keyword arguments:
+        force -- Send any changes now, used before a unit blocks waiting for a message
+        """
+        if not self.dirty or self.metrics_queue is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_seconds:
+            return
+        with self.lock:
+            snapshot = (self.unit_name, dict(self.counters), dict(self.gauges),
+                        {name: (h[0], list(h[1]), h[2], h[3]) for name, h in self.histograms.items()})
+            self.dirty = False
+        self.last_flush = now
+        self.metrics_queue.put(snapshot)
+
+
+def format_metrics(snapshots, queue_depths):
+    """
+    Return the metrics in the Prometheus text exposition format
+
+    Keyword arguments:
+    snapshots -- A dictionary of unit name to (counters, gauges, histograms) from Metrics.flush
+
+    queue_depths -- A dictionary of queue name to the number of messages waiting
+    """
+    # Group the samples by metric name as each name gets one TYPE line
+    families = {}
+    for unit_name, (counters, gauges, histograms) in sorted(snapshots.items()):
+        label = f'unit="{unit_name}"'
+        for name, value in counters.items():
+            families.setdefault((f"{PREFIX}_{name}_total", 'counter'), []).append(f"{PREFIX}_{name}_total{{{label}}} {value}")
+        for name, value in gauges.items():
+            families.setdefault((f"{PREFIX}_{name}", 'gauge'), []).append(f"{PREFIX}_{name}{{{label}}} {value}")
+        for name, (buckets, counts, total, count) in histograms.items():
+            samples = families.setdefault((f"{PREFIX}_{name}", 'histogram'), [])
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                samples.append(f'{PREFIX}_{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            samples.append(f'{PREFIX}_{name}_bucket{{{label},le="+Inf"}} {count}')
+            samples.append(f"{PREFIX}_{name}_sum{{{label}}} {total}")
+            samples.append(f"{PREFIX}_{name}_count{{{label}}} {count}")
+    for queue_name, depth in sorted(queue_depths.items()):
+        families.setdefault((f"{PREFIX}_queue_depth", 'gauge'), []).append(f'{PREFIX}_queue_depth{{queue="{queue_name}"}} {depth}')
+
+    lines = []
+    for (name, metric_type), samples in families.items():
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
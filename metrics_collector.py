@@ -0,0 +1,131 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import threading
+import http.server
+
+import unit
+import metrics
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+class Metrics_handler(http.server.BaseHTTPRequestHandler):
+    """ Serve the metrics text on any GET request """
+    def do_GET(self):
+        body = self.server.collector.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+
+class Metrics_collector(unit.Unit):
+    """ A class to collect the metrics snapshots sent by the other units
+
+        The metrics are served in the Prometheus text format from a local HTTP endpoint
+        and written to a stats file every stats_seconds, in the same format so it can be read by
+        the node exporter textfile collector
+        The depth of the queues between units is read when the metrics are served or written
+    """
+    def __init__(self, *, config, log_queue, metrics_queue, queues=None):
+        """
+        Initialise the metrics collector class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        log_queue -- A queue object to send log messages to
+
+        metrics_queue -- A queue object containing the snapshots sent by Metrics.flush
+
+        queues -- A dictionary of name to the queues between units to report the depth of
+        """
+        super(Metrics_collector, self).__init__(config=config, log_queue=log_queue, unit_name='Metrics_collector', config_section='METRICS', input_queue=metrics_queue)
+        self.queues = queues if queues is not None else {}
+
+    def run(self):
+        self.queue_logger.info("Metrics collector started")
+        print("Metrics collector started\n")
+
+        bind = self.config['METRICS']['bind']
+        port = self.config['METRICS']['port']
+
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        server = None
+        if port:
+            try:
+                server = http.server.HTTPServer((bind, port), Metrics_handler)
+            except OSError as e:
+                self.queue_logger.error(f"Cannot serve metrics on {bind}:{port} {e}")
+            else:
+                server.collector = self
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                self.queue_logger.info(f"Serving metrics on http://{bind}:{port}/metrics")
+
+        next_stats = time.monotonic() + self.config['METRICS']['stats_seconds']
+        while not self.stoprequest.is_set():
+            snapshot = self.get_message(timeout=max(0, next_stats - time.monotonic()))
+            if snapshot is not None:
+                with self.lock:
+                    self.snapshots[snapshot[0]] = snapshot[1:]
+            if time.monotonic() >= next_stats:
+                # Moved on even with no stats file so the wait above does not become 0
+                if self.config['METRICS']['stats_file']:
+                    self.write_stats(self.config['METRICS']['stats_file'])
+                next_stats = time.monotonic() + self.config['METRICS']['stats_seconds']
+
+        if self.config['METRICS']['stats_file']:
+            self.write_stats(self.config['METRICS']['stats_file'])
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    def exposition(self):
+        """ Return the current metrics in the Prometheus text format """
+        queue_depths = {}
+        for name, q in self.queues.items():
+            try:
+                queue_depths[name] = q.qsize()
+            except NotImplementedError:
+                # qsize is not available on every platform
+                pass
+        with self.lock:
+            return metrics.format_metrics(self.snapshots, queue_depths)
+
+    def write_stats(self, stats_file):
+        """ Replace the stats file with the current metrics """
+        temp_path = stats_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as fp:
+                fp.write(self.exposition())
+            os.replace(temp_path, stats_file)
+        except OSError as e:
+            self.queue_logger.error(f"Cannot write stats file {stats_file} {e}")
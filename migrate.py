@@ -0,0 +1,299 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import hashlib
+import concurrent.futures
+
+import unit
+import mp4_mux
+import timeline
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+def staging_path(config):
+    """ Return the staging directory Record writes segments to or None if segments are written straight to video_out_path """
+    return config['STORAGE']['staging_path']
+
+
+def local_path(config):
+    """ Return the directory segments are first written to """
+    return staging_path(config) or config['RECORD']['video_out_path']
+
+
+def state_path(config):
+    """
+    Return the directory for the journals, outbox and timeline, they must survive a reboot and not wait on
+    network storage so the default is the directory of the config file rather than staging which can be a tmpfs
+    """
+    if config['STORAGE']['state_path']:
+        return config['STORAGE']['state_path']
+    if config.path is not None:
+        return os.path.dirname(os.path.abspath(config.path))
+    return config['RECORD']['video_out_path']
+
+
+def copy_file(source, destination, chunk_size, verify):
+    """
+    Copy a file to a temporary name next to destination, check it and move it into place, run in a worker thread
+    Returns the number of bytes copied, raises OSError if the copy failed or did not verify
+
+    Keyword arguments:
+    source -- The full path of the file to copy
+
+    destination -- The full path to copy it to
+
+    chunk_size -- The number of bytes read and written at a time
+
+    verify -- Read the copy back and compare its SHA-256 with the source
+    """
+    temp_path = destination + '.part'
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    source_digest = hashlib.sha256()
+    size = 0
+    with open(source, 'rb') as source_fp, open(temp_path, 'wb') as destination_fp:
+        while True:
+            data = source_fp.read(chunk_size)
+            if not data:
+                break
+            source_digest.update(data)
+            destination_fp.write(data)
+            size += len(data)
+        destination_fp.flush()
+        os.fsync(destination_fp.fileno())
+
+    if verify:
+        destination_digest = hashlib.sha256()
+        with open(temp_path, 'rb') as fp:
+            # Drop the cached pages so the copy is read back from the storage, not from memory
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while True:
+                data = fp.read(chunk_size)
+                if not data:
+                    break
+                destination_digest.update(data)
+        if destination_digest.digest() != source_digest.digest():
+            os.remove(temp_path)
+            raise OSError(f"Copy of {source} to {destination} did not verify")
+    os.replace(temp_path, destination)
+    return size
+
+
+def copy_segment(source, destination, chunk_size, verify):
+    """ Copy a segment and then its key frame index if it has one, so the segment is never in place without its index, returns the bytes copied """
+    size = 0
+    index_source = mp4_mux.index_path(source)
+    if index_source != source and os.path.isfile(index_source):
+        size += copy_file(index_source, mp4_mux.index_path(destination), chunk_size, verify)
+    return size + copy_file(source, destination, chunk_size, verify)
+
+
+def migration_result(future):
+    """ Return (bytes, None, False) for a successful copy future or (None, error message, True if it is worth retrying) """
+    try:
+        return (future.result(), None, False)
+    except FileNotFoundError as err:
+        return (None, f"{err}", False)
+    except OSError as err:
+        # Storage errors such as an unreachable NFS server are expected to clear
+        return (None, f"{err}", True)
+    except Exception as err:
+        return (None, f"{err}", False)
+
+
+class Migrate(unit.Unit):
+    """ A class to move closed segments from the fast staging directory to video_out_path
+
+        Record writes to staging_path (tmpfs or the SD card) so the encoder never waits on network storage,
+        the segments are then copied one at a time with large sequential writes, checked and only then
+        deleted from staging
+        If video_out_path is unreachable copies are retried with an increasing delay, if staging grows over
+        staging_max_mb meanwhile the oldest staged segments are dropped so recording can carry on
+        At startup any closed segment left in staging is migrated, a half copied file is just copied again
+        The size of the waiting segments is only summed at startup, after that it is kept up to date as
+        segments arrive, are migrated and are dropped
+    """
+    def __init__(self, *, config, log_queue, input_queue, output_queue=None, metrics_queue=None):
+        """
+        Initialise the migrate class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        log_queue -- A queue object to send log messages to
+
+        input_queue -- A queue object containing the full path of each closed segment
+
+        output_queue -- A queue object to send the full path of each segment after it is migrated to or None
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
+        """
+        super(Migrate, self).__init__(config=config, log_queue=log_queue, unit_name='Migrate', config_section='STORAGE', input_queue=input_queue, metrics_queue=metrics_queue)
+        self.output_queue = output_queue
+
+    def run(self):
+        self.queue_logger.info("Migrate started")
+        print("Migrate started\n")
+
+        self.staging_path = staging_path(self.config)
+        self.video_out_path = self.config['RECORD']['video_out_path']
+        self.timeline = timeline.open_timeline(self.config, self.queue_logger)
+        os.makedirs(self.staging_path, exist_ok=True)
+
+        # Segments waiting to be migrated, oldest first
+        pending = self.find_staged()
+        # The bytes of each segment, with its index, waiting to be migrated and their total
+        self.staged_sizes = {path: self.segment_size(path) for path in pending}
+        self.staged_bytes = sum(self.staged_sizes.values())
+        if pending:
+            self.queue_logger.info(f"Migrating {len(pending)} segments left in staging")
+        in_flight = None
+        failures = 0
+        next_attempt = 0
+
+        # One copy at a time keeps the writes to the slow tier sequential
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        while not self.stoprequest.is_set():
+            timeout = None
+            if in_flight is None and pending:
+                if time.monotonic() >= next_attempt:
+                    in_flight = pending.pop(0)
+                    future = executor.submit(copy_segment, in_flight, self.destination(in_flight), self.config['STORAGE']['copy_chunk_mb']*1024*1024, self.config['STORAGE']['verify'])
+                    # The result is passed back through the input queue so it wakes up the loop
+                    future.add_done_callback(lambda future, source=in_flight: self.input_queue.put(('migrated', source) + migration_result(future)))
+                else:
+                    timeout = next_attempt - time.monotonic()
+            self.metrics.set('migrate_backlog', len(pending) + (in_flight is not None))
+
+            input_queue_message = self.get_message(timeout=timeout)
+            if isinstance(input_queue_message, tuple):
+                source, size, error, transient = input_queue_message[1:]
+                in_flight = None
+                if error is None:
+                    failures = 0
+                    self.migrated(source, size)
+                elif not os.path.isfile(source):
+                    # Deleted by Cleanup or by hand, there is nothing left to migrate
+                    self.queue_logger.warning(f"Not migrating {source} as it no longer exists")
+                    self.staged_bytes -= self.staged_sizes.pop(source, 0)
+                elif transient:
+                    failures += 1
+                    delay = min(self.config['STORAGE']['max_retry_seconds'], self.config['STORAGE']['retry_seconds'] * 2 ** (failures - 1))
+                    self.queue_logger.error(f"Cannot migrate {source} error:{error}, retrying in {delay:.0f}s")
+                    self.metrics.inc('migrate_failures')
+                    next_attempt = time.monotonic() + delay
+                    pending.insert(0, source)
+                else:
+                    # Left in staging to be tried again at the next start rather than holding up the rest
+                    self.queue_logger.error(f"Cannot migrate {source} error:{error}, skipping it")
+                    self.metrics.inc('migrate_failures')
+                    self.staged_bytes -= self.staged_sizes.pop(source, 0)
+            elif input_queue_message is not None:
+                if self.staging_path is not None and input_queue_message.startswith(os.path.join(self.staging_path, '')):
+                    # After a restart a segment can be both found in staging and still on the queue
+                    if input_queue_message not in self.staged_sizes:
+                        self.staged_sizes[input_queue_message] = self.segment_size(input_queue_message)
+                        self.staged_bytes += self.staged_sizes[input_queue_message]
+                        pending.append(input_queue_message)
+                elif self.output_queue is not None:
+                    # Event clips and anything else not in staging pass straight through
+                    self.output_queue.put(input_queue_message)
+
+            if self.config['STORAGE']['spill'] == 'drop_oldest':
+                self.spill(pending, self.config['STORAGE']['staging_max_mb']*1024*1024)
+
+        # Anything left is migrated at the next start
+        executor.shutdown(wait=True)
+        if self.timeline is not None:
+            self.timeline.close()
+
+    def destination(self, source):
+        """ Return the path in video_out_path of a staged file """
+        return os.path.join(self.video_out_path, os.path.relpath(source, self.staging_path))
+
+    def find_staged(self):
+        """ Return the closed segments in staging, oldest first """
+        # A file touched in the last few seconds may still be being written
+        cutoff = time.time() - 5
+        staged = []
+        for root, dirs, files in os.walk(self.staging_path):
+            for f in files:
+                if os.path.splitext(f)[1] != '.mp4' or f.endswith('.part.mp4'):
+                    continue
+                full_f = os.path.join(root, f)
+                try:
+                    mtime = os.path.getmtime(full_f)
+                except OSError:
+                    continue
+                if mtime < cutoff:
+                    staged.append((mtime, full_f))
+        return [full_f for mtime, full_f in sorted(staged)]
+
+    def segment_size(self, path):
+        """ Return the bytes of a staged segment and its index """
+        size = 0
+        for full_f in {path, mp4_mux.index_path(path)}:
+            try:
+                size += os.path.getsize(full_f)
+            except OSError:
+                pass
+        return size
+
+    def migrated(self, source, size):
+        """ Delete a staged segment and its index once the copies are in place and pass the copy on """
+        destination = self.destination(source)
+        self.staged_bytes -= self.staged_sizes.pop(source, 0)
+        for path in (source, mp4_mux.index_path(source)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self.queue_logger.warning(f"Cannot Delete={path}")
+        self.queue_logger.info(f"Migrated {source} {size} bytes")
+        self.metrics.inc('files_migrated')
+        self.metrics.inc('bytes_migrated', size)
+        if self.timeline is not None:
+            self.timeline.segment_moved(source, destination)
+        if self.output_queue is not None:
+            self.output_queue.put(destination)
+
+    def spill(self, pending, staging_max):
+        """ Delete the oldest waiting segments while staging is over staging_max so recording can carry on """
+        # Only files that are waiting can be dropped, never the one being copied or recorded
+        while self.staged_bytes > staging_max and pending:
+            oldest = pending.pop(0)
+            for path in {oldest, mp4_mux.index_path(oldest)}:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    self.queue_logger.warning(f"Cannot Delete={path}")
+            self.staged_bytes -= self.staged_sizes.pop(oldest, 0)
+            self.queue_logger.error(f"Staging is over {staging_max} bytes, dropped {oldest}")
+            self.metrics.inc('segments_dropped')
+            if self.timeline is not None:
+                self.timeline.remove(oldest)
@@ -0,0 +1,295 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import math
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import settings
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Layout of one macroblock of the H.264 encoder motion data, as used by picamera and raspivid -x
+MOTION_DTYPE = [('x', 'i1'), ('y', 'i1'), ('sad', 'u2')]
+
+# Fusion policies for the PIR and motion triggers
+FUSION_POLICIES = ('pir', 'motion', 'either', 'both')
+
+
+def macroblocks(resolution):
+    """ Return the (columns, rows) of the motion data for a resolution, there is one extra column the encoder adds """
+    width, height = resolution
+    return ((width + 15) // 16 + 1, (height + 15) // 16)
+
+
+def parse_regions(text, columns, rows):
+    """
+    Return a boolean mask of the macroblocks inside the regions or None for the whole frame
+
+    Keyword arguments:
+    text -- Regions as x0,y0,x1,y1 fractions of the frame separated by ; e.g 0,0.5,1,1 is the bottom half
+
+    columns, rows -- The size of the motion data
+    """
+    if not text.strip():
+        return None
+    mask = np.zeros((rows, columns), dtype=bool)
+    for region in text.split(';'):
+        x0, y0, x1, y1 = (float(value) for value in region.split(','))
+        mask[int(y0 * rows):math.ceil(y1 * rows), int(x0 * columns):math.ceil(x1 * columns)] = True
+    return mask
+
+
+class Motion_detector:
+    """ A class to find movement in the H.264 encoder motion vectors of each frame
+
+        A macroblock is moving if its vector is longer than threshold and it is inside the region mask
+        Moving macroblocks with fewer than min_neighbours moving neighbours are dropped, this filters out
+        the scattered noise of leaves and sensor noise and keeps connected areas
+        Motion is reported when at least min_area macroblocks are left for min_frames frames in a row
+        All of this is whole array NumPy operations so a frame takes a fixed, small amount of time
+    """
+    def __init__(self, columns, rows, *, threshold=10, mask=None, min_neighbours=2, min_area=10, min_frames=3):
+        """
+        Initialise the motion detector class
+
+        Keyword arguments:
+        columns, rows -- The size of the motion data from macroblocks
+
+        threshold -- The vector length that counts as moving
+
+        mask -- A boolean array of the macroblocks to look at or None for all of them
+
+        min_neighbours -- The number of moving neighbours (of 8) a moving macroblock needs to count
+
+        min_area -- The number of counted macroblocks that is motion
+
+        min_frames -- The number of frames in a row that need motion
+        """
+        self.columns = columns
+        self.rows = rows
+        self.threshold_squared = threshold * threshold
+        # The extra column of the motion data is never motion
+        self.mask = np.ones((rows, columns), dtype=bool) if mask is None else mask.copy()
+        self.mask[:, -1] = False
+        self.min_neighbours = min_neighbours
+        self.min_area = min_area
+        self.min_frames = min_frames
+        self.frames_with_motion = 0
+        # Preallocated work arrays so a frame does not allocate
+        self.moving = np.zeros((rows + 2, columns + 2), dtype=np.uint8)
+        self.neighbours = np.zeros((rows, columns), dtype=np.uint8)
+
+    def analyse(self, vectors):
+        """
+        Add a frame of motion data, returns the number of counted macroblocks and True if there is motion
+
+        Keyword arguments:
+        vectors -- A (rows, columns) array of MOTION_DTYPE
+        """
+        x = vectors['x'].astype(np.int16)
+        y = vectors['y'].astype(np.int16)
+        # Compare squared lengths so there is no square root
+        moving = ((x * x + y * y) > self.threshold_squared) & self.mask
+
+        # Count the moving neighbours of each macroblock from the 8 shifted copies of a zero padded array
+        self.moving[1:-1, 1:-1] = moving
+        neighbours = self.neighbours
+        neighbours[:] = 0
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy != 1 or dx != 1:
+                    neighbours += self.moving[dy:dy + self.rows, dx:dx + self.columns]
+        area = int(np.count_nonzero(moving & (neighbours >= self.min_neighbours)))
+
+        if area >= self.min_area:
+            self.frames_with_motion += 1
+        else:
+            self.frames_with_motion = 0
+        return area, self.frames_with_motion >= self.min_frames
+
+
+class Motion_output:
+    """ A class to use as the picamera motion_output of the recording, it is called from the encoder thread
+
+        Each write is the motion data of one frame, it is passed to a Motion_detector unless the last
+        frame took longer than frame_budget, then frames are skipped to keep the average time within it
+        callback is called when motion starts, then not again for min_trigger_seconds
+    """
+    def __init__(self, detector, callback, *, frame_budget=0.01, min_trigger_seconds=10):
+        """
+        Initialise the motion output class
+
+        Keyword arguments:
+        detector -- The Motion_detector to use
+
+        callback -- Called with the counted area when motion starts
+
+        frame_budget -- The seconds of CPU a frame can use on average
+
+        min_trigger_seconds -- The minimum seconds between callbacks
+        """
+        self.detector = detector
+        self.callback = callback
+        self.frame_budget = frame_budget
+        self.min_trigger_seconds = min_trigger_seconds
+        self.last_trigger = None
+        self.skip = 0
+        # Stats for the log
+        self.frames = 0
+        self.skipped = 0
+        self.total_time = 0
+        self.worst_time = 0
+
+    def write(self, data):
+        if self.skip:
+            self.skip -= 1
+            self.skipped += 1
+            return len(data)
+        # Only the CPU of this thread, the encoder callbacks and writer threads share the process
+        start = time.thread_time()
+        vectors = np.frombuffer(data, dtype=MOTION_DTYPE).reshape((self.detector.rows, self.detector.columns))
+        area, motion = self.detector.analyse(vectors)
+        if motion and (self.last_trigger is None or time.monotonic() - self.last_trigger >= self.min_trigger_seconds):
+            self.last_trigger = time.monotonic()
+            self.callback(area)
+        elapsed = time.thread_time() - start
+        self.frames += 1
+        self.total_time += elapsed
+        self.worst_time = max(self.worst_time, elapsed)
+        # Skip enough frames to bring the time back within the budget
+        self.skip = int(elapsed // self.frame_budget) if self.frame_budget > 0 else 0
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        """ Return a string of the analysis times for the log """
+        average = self.total_time / self.frames * 1000 if self.frames else 0
+        return f"frames={self.frames} skipped={self.skipped} average_ms={average:.2f} worst_ms={self.worst_time*1000:.2f}"
+
+
+class Trigger_fusion:
+    """ A class to decide if a PIR or motion trigger generates a notification
+
+        pir and motion only use that source, either uses both and
+        both needs the two sources within window_seconds of each other
+        With either a trigger from the other source within window_seconds of a notification is
+        the same event so does not make another one
+    """
+    def __init__(self, policy, window_seconds=5):
+        """
+        Initialise the trigger fusion class
+
+        Keyword arguments:
+        policy -- One of FUSION_POLICIES
+
+        window_seconds -- How close together the two sources have to be for the both policy,
+                          or to be one event for the either policy
+        """
+        if policy not in FUSION_POLICIES:
+            raise ValueError(f"Unknown fusion policy {policy}")
+        self.policy = policy
+        self.window_seconds = window_seconds
+        self.last = {'pir': None, 'motion': None}
+        # The source and time of the last notification for the either policy
+        self.notified = (None, None)
+
+    def add(self, source):
+        """ Add a trigger from source (pir or motion), returns the sources of the notification or None if there is not one """
+        now = time.monotonic()
+        self.last[source] = now
+        if self.policy == 'either':
+            notified_source, notified_time = self.notified
+            if notified_source not in (None, source) and now - notified_time <= self.window_seconds:
+                return None
+            self.notified = (source, now)
+            return source
+        if self.policy == source:
+            return source
+        if self.policy == 'both':
+            other = 'motion' if source == 'pir' else 'pir'
+            if self.last[other] is not None and now - self.last[other] <= self.window_seconds:
+                # Both need to happen again for the next notification
+                self.last = {'pir': None, 'motion': None}
+                return 'pir+motion'
+        return None
+
+
+def detector_from_config(config, resolution):
+    """ Return a Motion_detector set up from the MOTION section of the config """
+    columns, rows = macroblocks(resolution)
+    return Motion_detector(columns, rows,
+                           threshold=config['MOTION']['threshold'],
+                           mask=parse_regions(config['MOTION']['regions'], columns, rows),
+                           min_neighbours=config['MOTION']['min_neighbours'],
+                           min_area=config['MOTION']['min_area'],
+                           min_frames=config['MOTION']['min_frames'])
+
+
+if __name__ == '__main__':
+    # Replay recorded motion data, as written by raspivid -x or a picamera motion_output file, or a .npy
+    # array of MOTION_DTYPE frames, through the detector so settings and speed can be compared
+    parser = argparse.ArgumentParser(description="Replay recorded motion vectors through the motion detector")
+    parser.add_argument('--config', default='security.ini', help="The config file with the MOTION settings (default security.ini)")
+    parser.add_argument('--resolution', default='1640x1232', help="The recording resolution (default 1640x1232)")
+    parser.add_argument('--framerate', type=float, default=25, help="The recording framerate (default 25)")
+    parser.add_argument('vectors', help="The motion data file")
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("NumPy is needed for motion detection")
+
+    try:
+        config = settings.load(args.config) if os.path.isfile(args.config) else settings.defaults()
+    except settings.Settings_error as e:
+        sys.exit(f"{e}")
+    resolution = tuple(int(x) for x in args.resolution.split('x'))
+    detector = detector_from_config(config, resolution)
+    if os.path.splitext(args.vectors)[1] == '.npy':
+        frames = np.load(args.vectors)
+    else:
+        frames = np.fromfile(args.vectors, dtype=MOTION_DTYPE).reshape((-1, detector.rows, detector.columns))
+
+    times = []
+    motion_frames = 0
+    for number, vectors in enumerate(frames):
+        start = time.perf_counter()
+        area, motion = detector.analyse(vectors)
+        times.append(time.perf_counter() - start)
+        if motion:
+            motion_frames += 1
+            # Only print where motion starts
+            if detector.frames_with_motion == detector.min_frames:
+                print(f"Motion at {number / args.framerate:.2f}s frame={number} area={area}")
+    if times:
+        times.sort()
+        print(f"frames={len(times)} motion_frames={motion_frames} average_ms={sum(times) / len(times) * 1000:.3f} "
+              f"p99_ms={times[int(len(times) * 0.99)] * 1000:.3f} worst_ms={times[-1] * 1000:.3f} fps={len(times) / sum(times):.0f}")
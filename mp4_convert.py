@@ -17,14 +17,21 @@ __version__ = "0.1"
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import multiprocessing
-import queue
-import time
-import re
 import subprocess
 import os
-import logging
-import logging.handlers
+import time
+import signal
+import datetime as dt
+import queue
+import collections
+import multiprocessing
+import concurrent.futures
+
+import unit
+import mp4_mux
+import timeline
+import migrate
+import settings
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -32,78 +39,336 @@ import logging.handlers
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Mp4_convert(multiprocessing.Process):
+class Convert_journal:
+    """ A class to keep an on disk record of the h264 files waiting to be converted
+        so they are not lost if the process dies or the service is restarted
+
+        Each line is +path when a file is queued, -path when it is done or !path if it failed
+        so it is not tried again
+    """
+    def __init__(self, path):
+        """
+        Initialise the convert journal class
+
+        Keyword arguments:
+        path -- The full path of the journal file
+        """
+        self.path = path
+
+    def load(self):
+        """ Return the list of paths still waiting in the journal, in the order they were added, and the set of paths that failed """
+        pending = {}
+        failed = set()
+        try:
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    line = line.rstrip('\n')
+                    if line.startswith('+'):
+                        pending[line[1:]] = True
+                    elif line.startswith('-'):
+                        pending.pop(line[1:], None)
+                    elif line.startswith('!'):
+                        pending.pop(line[1:], None)
+                        failed.add(line[1:])
+        except FileNotFoundError:
+            pass
+        return list(pending), failed
+
+    def rewrite(self, paths, failed=()):
+        """ Replace the journal with just the paths given and the paths that failed """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            for path in failed:
+                fp.write(f"!{path}\n")
+            for path in paths:
+                fp.write(f"+{path}\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.path)
+
+    def add(self, path):
+        self.append(f"+{path}\n")
+
+    def done(self, path):
+        self.append(f"-{path}\n")
+
+    def failed(self, path):
+        self.append(f"!{path}\n")
+
+    def append(self, line):
+        with open(self.path, 'a') as fp:
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+def start_worker(niceness, pid_queue):
+    """ Worker process initializer so conversions do not starve the recorder, the pid is sent back so the worker can be stopped """
+    os.nice(niceness)
+    pid_queue.put(os.getpid())
+
+
+def convert_file(h264_path, converter, framerate):
+    """
+    Convert a h264 file to mp4, run in a worker process
+    Returns the number of seconds the conversion took, raises an exception if it failed
+
+    Keyword arguments:
+    h264_path -- The full path of the h264 file to convert
+
+    converter -- builtin or mp4box
+
+    framerate -- The constant framerate of the video
+    """
+    start_time = time.monotonic()
+    # Work out the output file name by replacing the .h264 extension
+    output_file_name = os.path.splitext(h264_path)[0] + '.mp4'
+    # Write to a temporary name so a part converted file never replaces a finished one
+    temp_file_name = os.path.splitext(h264_path)[0] + '.part.mp4'
+
+    try:
+        if converter == 'mp4box':
+            # Call out to external utility to convert the h264 file to an MP4 file
+            command = ["MP4Box", "-quiet", "-noprog", "-add", h264_path, "-new", temp_file_name]
+            subprocess.check_output(command, stderr=subprocess.STDOUT)
+        else:
+            mp4_mux.convert(h264_path, temp_file_name, framerate, key_frame_index_path=mp4_mux.index_path(output_file_name))
+        os.replace(temp_file_name, output_file_name)
+    except Exception:
+        try:
+            os.remove(temp_file_name)
+        except OSError:
+            pass
+        raise
+    return time.monotonic() - start_time
+
+
+def conversion_result(future):
+    """ Return (seconds, None) for a successful conversion future or (None, error message) """
+    try:
+        return (future.result(), None)
+    except subprocess.CalledProcessError as err:
+        return (None, f"cmd:{err.cmd} output:{err.output}")
+    except Exception as err:
+        return (None, f"{err}")
+
+
+class Mp4_convert(unit.Unit):
     """ A class to handle the convertion of h264 files to mp4
         This makes them easier to view
         It removes the h264 files when done
+
+        The conversion is done by the built in mp4_mux module by default, MP4Box can still be used with converter=mp4box
+
+        Conversions run in a pool of worker processes and every queued file is kept in a journal on disk
+        At startup the journal is replayed and any h264 files left in staging, or the last two hours of video_out_path
+        without staging, are queued oldest first, except the segment being recorded and those whose conversion
+        failed which are kept as h264
+        When asked to exit the queued files are converted before the unit exits, up to drain_timeout seconds,
+        then any conversions still running are stopped and left in the journal for the next start
     """
-    def __init__(self, *, config, log_queue, input_queue):
+    def __init__(self, *, config, log_queue, input_queue, output_queue=None, metrics_queue=None):
         """
         Initialise the mp4_convert class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object to send log messages to
 
         input_queue -- A queue object containing a message from the record class to the location of a newly generated h264 file to convert
+
+        output_queue -- A queue object to send the full path of each converted mp4 file to or None
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
         """
-        super(Mp4_convert, self).__init__()
-        self.config = config
-        self.log_queue = log_queue
-        self.input_queue = input_queue
-
-        self.stoprequest = multiprocessing.Event()
-
-        # Setup logging
-        h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
-        self.queue_logger = logging.getLogger(name='Mp4_convert')
-        self.queue_logger.addHandler(h)
-        # apply this unit's logging level
-        log_level = {'CRITICAL': logging.CRITICAL, 'ERROR': logging.ERROR, 'WARNING': logging.WARNING, 'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
-        self.queue_logger.setLevel(log_level[self.config['MP4_CONVERT']['log_level']])
+        super(Mp4_convert, self).__init__(config=config, log_queue=log_queue, unit_name='Mp4_convert', config_section='MP4_CONVERT', input_queue=input_queue, metrics_queue=metrics_queue)
+        self.output_queue = output_queue
     
     def run(self):
         self.queue_logger.info("MP4 convert started")
         print("MP4 convert started\n")
-        input_queue_message = ""
 
-        # Loop while not asked to exit
-        while not self.stoprequest.is_set():
-            # Handle if a video conversion is requested
+        framerate = self.config['RECORD']['framerate']
+        # Leave a core for the recorder by default
+        workers = self.config['MP4_CONVERT']['workers'] or max(1, (os.cpu_count() or 1) - 1)
+        niceness = self.config['MP4_CONVERT']['worker_nice']
+        os.makedirs(migrate.state_path(self.config), exist_ok=True)
+        # Index of the segments and events, None if not enabled
+        self.timeline = timeline.open_timeline(self.config, self.queue_logger)
+        journal = Convert_journal(self.config['MP4_CONVERT']['journal_path'] or os.path.join(migrate.state_path(self.config), '.mp4_convert_journal'))
+
+        # Files waiting for a worker, oldest first
+        pending, self.failed = self.find_backlog(journal)
+        pending = collections.deque(pending)
+        journal.rewrite(pending, self.failed)
+        if pending:
+            self.queue_logger.info(f"Converting backlog of {len(pending)} files")
+        in_flight = set()
+
+        # The workers send their pids here so the ones still converting can be stopped if the drain times out
+        pid_queue = multiprocessing.Queue()
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(niceness, pid_queue))
+        drain_deadline = None
+        while True:
+            # Give the workers as many files as they can take
+            while pending and len(in_flight) < workers:
+                h264_path = pending.popleft()
+                self.queue_logger.info(f"Converting {h264_path}")
+                future = executor.submit(convert_file, h264_path, self.config['MP4_CONVERT']['converter'], framerate)
+                # Completion is passed back through the input queue so it wakes up the loop below
+                future.add_done_callback(lambda future, h264_path=h264_path: self.input_queue.put(('converted', h264_path) + conversion_result(future)))
+                in_flight.add(h264_path)
+
+            if self.stoprequest.is_set():
+                # Drain the queue and the backlog before exiting
+                if drain_deadline is None:
+                    drain_deadline = time.monotonic() + self.config['MP4_CONVERT']['drain_timeout']
+                    self.queue_logger.info(f"Draining {len(pending) + len(in_flight)} conversions")
+                timeout = drain_deadline - time.monotonic()
+                if timeout <= 0:
+                    self.queue_logger.warning(f"Drain timed out, {len(pending) + len(in_flight)} conversions left in the journal")
+                    break
+                if not pending and not in_flight:
+                    # Anything still in the queue now arrived after exit was asked for
+                    timeout = 0.1
+            else:
+                # Block until a video conversion is requested or finishes
+                timeout = None
+
+            self.metrics.set('convert_backlog', len(pending) + len(in_flight))
+            # Send any metrics now if this could block for a long time
+            self.metrics.flush(force=timeout is None)
+            self.beat()
             try:
-                input_queue_message = self.input_queue.get(block=False)
+                input_queue_message = self.input_queue.get(timeout=unit.HEARTBEAT_SECONDS if timeout is None else timeout)
             except queue.Empty:
-                pass
+                if self.stoprequest.is_set() and not pending and not in_flight:
+                    break
+                continue
 
-            if input_queue_message != "":
-                self.queue_logger.info(f"Converting {input_queue_message}")
-                # Work out the output file name by replacing the .h264 extension
-                output_file_name = re.sub("\.h264$","\.mp4", input_queue_message)
+            if isinstance(input_queue_message, settings.Settings):
+                self.reload(input_queue_message)
+            elif isinstance(input_queue_message, tuple):
+                # A result for a file this instance did not start is left from the workers stopped by a previous drain
+                if input_queue_message[1] not in in_flight:
+                    continue
+                self.converted(journal, *input_queue_message[1:])
+                in_flight.discard(input_queue_message[1])
+                if not pending and not in_flight:
+                    # Nothing waiting so start a fresh journal
+                    journal.rewrite([], self.failed)
+            elif input_queue_message is not None:
+                if not input_queue_message.endswith('.h264'):
+                    # Fragmented MP4 recordings need no conversion
+                    self.queue_logger.debug(f"Not converting {input_queue_message}")
+                    continue
+                if input_queue_message in in_flight or input_queue_message in pending:
+                    # Already found in the backlog at startup
+                    continue
+                journal.add(input_queue_message)
+                pending.append(input_queue_message)
 
-                # Call out to external utility to convert the h264 file to an MP4 file
-                command = "MP4Box -quiet -noprog -add {} {}".format(input_queue_message, output_file_name)
+        if in_flight:
+            # Shutting down joins the workers at exit so the ones still converting are stopped
+            executor.shutdown(wait=False, cancel_futures=True)
+            while True:
                 try:
-                     output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
-                except subprocess.CalledProcessError as err:
-                    self.queue_logger.error(f"cmd:{err.cmd} output:{err.output}")
-                else:
-                    # Remove original file as conversion was successful
-                    self.queue_logger.debug(f"Deleting {input_queue_message}")
-                    try:
-                        os.remove(input_queue_message)
-                    except OSError:
-                        self.queue_logger.warning(f"Cannot Delete={f}")
+                    pid = pid_queue.get(timeout=0.1)
+                except queue.Empty:
+                    break
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        executor.shutdown(wait=True)
+        if self.timeline is not None:
+            self.timeline.close()
 
-                # Clear the message
-                input_queue_message = ""
+    def find_backlog(self, journal):
+        """
+        Return the files left from before the unit started, oldest first, and the set of files that failed to convert
 
-            # Go to sleep for a bit so not a tight loop
-            time.sleep(0.1)
+        Keyword arguments:
+        journal -- The Convert_journal holding the files that were queued
+        """
+        journal_pending, journal_failed = journal.load()
+        backlog = set(path for path in journal_pending if os.path.isfile(path))
+        # Only the failures that are still on disk need remembering
+        failed = set(path for path in journal_failed if os.path.isfile(path))
+        # Everything queued is in the journal so the scan only looks for segments Record finished but did not queue,
+        # staging is small but without it only the last two hours are listed rather than walking all the footage
+        now = dt.datetime.now()
+        found = []
+        if migrate.staging_path(self.config) is not None:
+            for root, dirs, files in os.walk(migrate.staging_path(self.config)):
+                found.extend(os.path.join(root, f) for f in files)
+        else:
+            for hour in (now - dt.timedelta(hours=1), now):
+                hour_path = os.path.join(self.config['RECORD']['video_out_path'], hour.strftime('%Y-%m-%d/%H'))
+                try:
+                    found.extend(os.path.join(hour_path, f) for f in os.listdir(hour_path))
+                except OSError:
+                    pass
+        recording = self.recording_paths(now)
+        for full_f in found:
+            if os.path.splitext(full_f)[1] == ".h264" and full_f not in failed and full_f not in recording:
+                backlog.add(full_f)
+
+        def age(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0
+        return sorted(backlog, key=age), failed
+
+    def recording_paths(self, now):
+        """
+        Return the paths of the h264 segments Record could still be writing, the current minute's and just after
+        a new minute the last one as the split waits for a key frame and the last blocks to be written
+        The mtime cannot be used as the writes are buffered so the current segment can be untouched for seconds
+        """
+        minutes = [now] if now.second >= 10 else [now, now - dt.timedelta(minutes=1)]
+        return set(os.path.join(migrate.local_path(self.config), minute.strftime('%Y-%m-%d/%H/%M') + '.h264') for minute in minutes)
 
+    def converted(self, journal, h264_path, seconds, error):
+        """
+        Handle a finished conversion
+
+        Keyword arguments:
+        journal -- The Convert_journal to mark the file done in
+
+        h264_path -- The full path of the converted h264 file
 
+        seconds -- The time the conversion took
 
-    def join(self, timeout=None):
-        self.queue_logger.info("Mp4_convert asked to exit")
-        self.stoprequest.set()
-        super(Mp4_convert, self).join(timeout)
\ No newline at end of file
+        error -- None or the error message if the conversion failed
+        """
+        if error is not None:
+            self.queue_logger.error(f"Cannot convert {h264_path} error:{error}")
+            self.metrics.inc('conversion_failures')
+            if self.timeline is not None:
+                self.timeline.segment_status(h264_path, timeline.STATUS_FAILED)
+            # A failed file is kept as h264 and not tried again
+            self.failed.add(h264_path)
+            journal.failed(h264_path)
+        else:
+            self.queue_logger.debug(f"Converted {h264_path} in {seconds:.2f}s")
+            self.metrics.inc('conversions')
+            self.metrics.observe('conversion_seconds', seconds)
+            # Remove original file as conversion was successful
+            self.queue_logger.debug(f"Deleting {h264_path}")
+            try:
+                os.remove(h264_path)
+            except OSError:
+                self.queue_logger.warning(f"Cannot Delete={h264_path}")
+            mp4_path = os.path.splitext(h264_path)[0] + '.mp4'
+            if self.timeline is not None:
+                try:
+                    size = os.path.getsize(mp4_path)
+                except OSError:
+                    size = 0
+                self.timeline.segment_converted(h264_path, mp4_path, size)
+            if self.output_queue is not None:
+                self.output_queue.put(mp4_path)
+            journal.done(h264_path)
@@ -0,0 +1,607 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct
+import time
+import sys
+import os
+import json
+
+# NAL unit types used when muxing
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# Seconds between 1904-01-01 (MP4 epoch) and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+# Track timescale, 90kHz is the usual video clock
+TIMESCALE = 90000
+
+# Identity transformation matrix used by mvhd and tkhd
+MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+# Extension of the key frame index written next to a MP4 file
+INDEX_EXTENSION = '.idx'
+
+# Box types that contain other boxes, used by read_boxes
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'dinf', b'mvex', b'moof', b'traf', b'edts'}
+
+class Nal_reader:
+    """ A class to split an Annex-B H.264 byte stream into NAL units
+        Data can be fed in any sized pieces, only the current NAL unit is held in memory
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        # Position the search for the next start code continues from
+        self.search_from = 0
+        self.started = False
+
+    def feed(self, data):
+        """ Add data to the stream and return a list of the NAL units it completes """
+        self.buffer += data
+        nals = []
+        while True:
+            position = self.buffer.find(b'\x00\x00\x01', self.search_from)
+            if position == -1:
+                # Keep the last 2 bytes as they could be the start of a start code
+                self.search_from = max(0, len(self.buffer) - 2)
+                break
+            if self.started:
+                nal = bytes(self.buffer[:position]).rstrip(b'\x00')
+                if nal:
+                    nals.append(nal)
+            self.started = True
+            del self.buffer[:position + 3]
+            self.search_from = 0
+        return nals
+
+    def flush(self):
+        """ Return the last NAL unit at the end of the stream as a list """
+        nals = []
+        if self.started and self.buffer:
+            nal = bytes(self.buffer).rstrip(b'\x00')
+            if nal:
+                nals.append(nal)
+        self.buffer = bytearray()
+        self.search_from = 0
+        self.started = False
+        return nals
+
+
+class Access_unit_builder:
+    """ A class to group NAL units into access units (one per frame)
+        SPS and PPS are kept for the avcC box and are not added to the samples
+    """
+    def __init__(self):
+        self.sps = None
+        self.pps = None
+        self.nals = []
+        self.has_vcl = False
+        self.sync = False
+
+    def add(self, nal):
+        """ Add a NAL unit, returns a finished (sample, sync) tuple if this NAL unit starts a new access unit otherwise None """
+        nal_type = nal[0] & 0x1f
+        finished = None
+        if nal_type in (NAL_SPS, NAL_PPS, NAL_AUD, NAL_SEI):
+            # These always come before the slices of a new frame
+            if self.has_vcl:
+                finished = self.finish()
+            if nal_type == NAL_SPS:
+                self.sps = nal
+            elif nal_type == NAL_PPS:
+                self.pps = nal
+            elif nal_type == NAL_SEI:
+                self.nals.append(nal)
+        elif nal_type in (NAL_SLICE, NAL_IDR):
+            # first_mb_in_slice is 0 (a single 1 bit) for the first slice of a frame
+            if self.has_vcl and len(nal) > 1 and nal[1] & 0x80:
+                finished = self.finish()
+            self.nals.append(nal)
+            self.has_vcl = True
+            if nal_type == NAL_IDR:
+                self.sync = True
+        return finished
+
+    def finish(self):
+        """ Return the current access unit as a (sample, sync) tuple in AVCC format or None if it has no slices """
+        if not self.has_vcl:
+            return None
+        sample = b''.join(struct.pack('>I', len(nal)) + nal for nal in self.nals)
+        finished = (sample, self.sync)
+        self.nals = []
+        self.has_vcl = False
+        self.sync = False
+        return finished
+
+
+class Bit_reader:
+    """ A class to read the exp-Golomb coded fields of a SPS """
+    def __init__(self, data):
+        # Remove emulation prevention bytes
+        self.data = data.replace(b'\x00\x00\x03', b'\x00\x00')
+        self.position = 0
+
+    def u(self, bits):
+        value = 0
+        for i in range(bits):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def parse_sps(sps):
+    """
+    Return a dictionary of the SPS fields needed for the avc1 and avcC boxes
+
+    Keyword arguments:
+    sps -- The SPS NAL unit including its header byte
+    """
+    reader = Bit_reader(sps[1:])
+    fields = {'profile': reader.u(8), 'compatibility': reader.u(8), 'level': reader.u(8)}
+    reader.ue()  # seq_parameter_set_id
+    fields['chroma_format'] = 1
+    fields['bit_depth_luma'] = 8
+    fields['bit_depth_chroma'] = 8
+    separate_colour_plane = 0
+    if fields['profile'] in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        fields['chroma_format'] = reader.ue()
+        if fields['chroma_format'] == 3:
+            separate_colour_plane = reader.u(1)
+        fields['bit_depth_luma'] = reader.ue() + 8
+        fields['bit_depth_chroma'] = reader.ue() + 8
+        reader.u(1)  # qpprime_y_zero_transform_bypass_flag
+        if reader.u(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if fields['chroma_format'] != 3 else 12):
+                if reader.u(1):
+                    # Skip the scaling list
+                    last_scale = 8
+                    next_scale = 8
+                    for j in range(16 if i < 6 else 64):
+                        if next_scale != 0:
+                            next_scale = (last_scale + reader.se()) % 256
+                        last_scale = next_scale if next_scale != 0 else last_scale
+    reader.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        reader.u(1)  # delta_pic_order_always_zero_flag
+        reader.se()  # offset_for_non_ref_pic
+        reader.se()  # offset_for_top_to_bottom_field
+        for i in range(reader.ue()):
+            reader.se()  # offset_for_ref_frame
+    reader.ue()  # max_num_ref_frames
+    reader.u(1)  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.u(1)
+    if not frame_mbs_only:
+        reader.u(1)  # mb_adaptive_frame_field_flag
+    reader.u(1)  # direct_8x8_inference_flag
+    crop = (0, 0, 0, 0)
+    if reader.u(1):  # frame_cropping_flag
+        crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+    # Cropping is in chroma sample units
+    if separate_colour_plane or fields['chroma_format'] == 0:
+        crop_x, crop_y = 1, 2 - frame_mbs_only
+    else:
+        crop_x = 2 if fields['chroma_format'] in (1, 2) else 1
+        crop_y = (2 if fields['chroma_format'] == 1 else 1) * (2 - frame_mbs_only)
+    fields['width'] = width_in_mbs * 16 - crop_x * (crop[0] + crop[1])
+    fields['height'] = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop[2] + crop[3])
+    return fields
+
+
+def box(box_type, *payloads):
+    """ Return a box of box_type containing the payloads """
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def full_box(box_type, version, flags, *payloads):
+    """ Return a full box (one with a version and flags) of box_type containing the payloads """
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def ftyp():
+    return box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso2', b'avc1', b'mp41')
+
+
+def avc1(sps, pps):
+    """ Return the avc1 sample entry for the SPS and PPS """
+    fields = parse_sps(sps)
+    avcc = struct.pack('>BBBBBB', 1, fields['profile'], fields['compatibility'], fields['level'], 0xff, 0xe1)
+    avcc += struct.pack('>H', len(sps)) + sps + struct.pack('>BH', 1, len(pps)) + pps
+    if fields['profile'] in (100, 110, 122, 244):
+        avcc += struct.pack('>BBBB', 0xfc | fields['chroma_format'], 0xf8 | (fields['bit_depth_luma'] - 8), 0xf8 | (fields['bit_depth_chroma'] - 8), 0)
+    entry = struct.pack('>6xH16xHHIIIH32sHh', 1, fields['width'], fields['height'], 0x00480000, 0x00480000, 0, 1, b'', 0x18, -1)
+    return box(b'avc1', entry, box(b'avcC', avcc)), fields
+
+
+def track_boxes(sps, pps, duration, movie_duration, stbl_tables, creation_time):
+    """ Return the trak box for a single video track, shared by the plain and fragmented writers """
+    sample_entry, fields = avc1(sps, pps)
+    tkhd = full_box(b'tkhd', 0, 3, struct.pack('>IIIII', creation_time, creation_time, 1, 0, movie_duration), bytes(8), struct.pack('>hhhH', 0, 0, 0, 0), MATRIX, struct.pack('>II', fields['width'] << 16, fields['height'] << 16))
+    mdhd = full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', creation_time, creation_time, TIMESCALE, duration, 0x55c4, 0))
+    hdlr = full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'vide'), b'VideoHandler\x00')
+    vmhd = full_box(b'vmhd', 0, 1, bytes(8))
+    dinf = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1)))
+    stsd = full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry)
+    stbl = box(b'stbl', stsd, *stbl_tables)
+    return box(b'trak', tkhd, box(b'mdia', mdhd, hdlr, box(b'minf', vmhd, dinf, stbl)))
+
+
+def mvhd(creation_time, movie_duration):
+    return full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH10x', creation_time, creation_time, 1000, movie_duration, 0x00010000, 0x0100), MATRIX, bytes(24), struct.pack('>I', 2))
+
+
+class Keyframe_index:
+    """ A class to build the key frame table of a MP4 file as it is written
+
+        Each GOP is stored as the number of its first sample, the file offset of that sample and the
+        sizes of its samples, as the samples of a GOP are next to each other in the file a GOP can be
+        copied into another MP4 file with one read and without parsing the source file
+        It is saved as JSON next to the MP4 file with the SPS, PPS, framerate and start time
+    """
+    def __init__(self):
+        # List of [first sample number, file offset, [sample sizes]]
+        self.gops = []
+        self.sample_count = 0
+
+    def add_sample(self, offset, size, sync):
+        """ Add a sample written at offset in the MP4 file """
+        if sync:
+            self.gops.append([self.sample_count, offset, []])
+        if self.gops:
+            self.gops[-1][2].append(size)
+        # Samples before the first sync sample are counted for the timing but cannot be copied
+        self.sample_count += 1
+
+    def save(self, path, sps, pps, framerate, start_time):
+        """
+        Write the index to path
+
+        Keyword arguments:
+        path -- The full path of the index file
+
+        sps, pps -- The SPS and PPS of the stream
+
+        framerate -- The constant framerate of the video
+
+        start_time -- The time in seconds since the epoch of the first sample
+        """
+        index = {'framerate': framerate, 'start': start_time, 'samples': self.sample_count,
+                 'sps': sps.hex(), 'pps': pps.hex(), 'gops': self.gops}
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(index, fp, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+
+def load_index(path):
+    """ Return the dictionary saved by Keyframe_index.save """
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def index_path(mp4_path):
+    """ Return the path of the key frame index of a MP4 file """
+    return os.path.splitext(mp4_path)[0] + INDEX_EXTENSION
+
+
+class Mp4_writer:
+    """ A class to write an Annex-B H.264 stream as a MP4 file in one pass
+
+        The samples are written to the mdat box as they arrive and the moov box is written
+        at the end, so only the sample sizes and sync samples are held in memory
+        The output file needs to be seekable so the mdat size can be filled in
+    """
+    def __init__(self, fileobj, framerate=25, index=None):
+        """
+        Initialise the MP4 writer class
+
+        Keyword arguments:
+        fileobj -- A seekable file object opened for binary writing
+
+        framerate -- The constant framerate of the video
+
+        index -- A Keyframe_index to add the samples to or None
+        """
+        self.fileobj = fileobj
+        self.index = index
+        self.sample_delta = round(TIMESCALE / float(framerate))
+        self.nal_reader = Nal_reader()
+        self.access_units = Access_unit_builder()
+        self.sample_sizes = []
+        self.sync_samples = []
+        self.creation_time = int(time.time()) + MP4_EPOCH_OFFSET
+
+        self.fileobj.write(ftyp())
+        self.mdat_position = self.fileobj.tell()
+        # 64 bit mdat header, the size is filled in by close
+        self.fileobj.write(struct.pack('>I4sQ', 1, b'mdat', 0))
+        self.mdat_size = 16
+
+    def write(self, data):
+        """ Add Annex-B H.264 data """
+        for nal in self.nal_reader.feed(data):
+            finished = self.access_units.add(nal)
+            if finished is not None:
+                self.add_sample(*finished)
+        return len(data)
+
+    def add_sample(self, sample, sync):
+        """ Add a sample that is already in AVCC (length prefixed) format """
+        if self.index is not None:
+            self.index.add_sample(self.mdat_position + self.mdat_size, len(sample), sync)
+        self.fileobj.write(sample)
+        self.mdat_size += len(sample)
+        self.sample_sizes.append(len(sample))
+        if sync:
+            # Sample numbers start at 1
+            self.sync_samples.append(len(self.sample_sizes))
+
+    def close(self, sps=None, pps=None):
+        """
+        Finish the mdat box and write the moov box
+
+        Keyword arguments:
+        sps, pps -- The SPS and PPS to use if they are not in the stream
+        """
+        for nal in self.nal_reader.flush():
+            finished = self.access_units.add(nal)
+            if finished is not None:
+                self.add_sample(*finished)
+        finished = self.access_units.finish()
+        if finished is not None:
+            self.add_sample(*finished)
+        sps = self.access_units.sps or sps
+        pps = self.access_units.pps or pps
+        if sps is None or pps is None or not self.sample_sizes:
+            raise ValueError("No H.264 SPS, PPS or frames found")
+
+        end = self.fileobj.tell()
+        self.fileobj.seek(self.mdat_position + 8)
+        self.fileobj.write(struct.pack('>Q', self.mdat_size))
+        self.fileobj.seek(end)
+
+        sample_count = len(self.sample_sizes)
+        duration = sample_count * self.sample_delta
+        movie_duration = duration * 1000 // TIMESCALE
+        first_offset = self.mdat_position + 16
+        stts = full_box(b'stts', 0, 0, struct.pack('>III', 1, sample_count, self.sample_delta))
+        stsc = full_box(b'stsc', 0, 0, struct.pack('>IIII', 1, 1, sample_count, 1))
+        stsz = full_box(b'stsz', 0, 0, struct.pack('>II', 0, sample_count), struct.pack(f'>{sample_count}I', *self.sample_sizes))
+        if first_offset < 0x100000000:
+            stco = full_box(b'stco', 0, 0, struct.pack('>II', 1, first_offset))
+        else:
+            stco = full_box(b'co64', 0, 0, struct.pack('>IQ', 1, first_offset))
+        tables = [stts, stsc, stsz, stco]
+        # No stss box means every sample is a sync sample
+        if len(self.sync_samples) != sample_count:
+            tables.insert(1, full_box(b'stss', 0, 0, struct.pack('>I', len(self.sync_samples)), struct.pack(f'>{len(self.sync_samples)}I', *self.sync_samples)))
+        trak = track_boxes(sps, pps, duration, movie_duration, tables, self.creation_time)
+        self.fileobj.write(box(b'moov', mvhd(self.creation_time, movie_duration), trak))
+
+
+class Fmp4_writer:
+    """ A class to write an Annex-B H.264 stream as a fragmented MP4 file as it arrives
+
+        It can be used as a picamera output, each GOP is written as a moof/mdat fragment
+        as soon as the next IDR frame arrives, so the file can be played up to the last
+        complete fragment even if it is never closed
+        Only the samples of the current GOP are held in memory
+    """
+    def __init__(self, fileobj, framerate=25, index=None):
+        """
+        Initialise the fragmented MP4 writer class
+
+        Keyword arguments:
+        fileobj -- A new file object opened for binary writing, it does not need to be seekable
+
+        framerate -- The constant framerate of the video
+
+        index -- A Keyframe_index to add the samples to or None
+        """
+        self.fileobj = fileobj
+        self.index = index
+        # Bytes written so far, the offset of the next box in the file
+        self.position = 0
+        self.sample_delta = round(TIMESCALE / float(framerate))
+        self.nal_reader = Nal_reader()
+        self.access_units = Access_unit_builder()
+        self.creation_time = int(time.time()) + MP4_EPOCH_OFFSET
+        # Samples of the current fragment
+        self.samples = []
+        self.sequence_number = 0
+        self.decode_time = 0
+        self.initialised = False
+
+    def write(self, data):
+        """ Add Annex-B H.264 data """
+        for nal in self.nal_reader.feed(data):
+            finished = self.access_units.add(nal)
+            if finished is not None:
+                self.add_sample(*finished)
+        return len(data)
+
+    def add_sample(self, sample, sync):
+        """ Add a sample that is already in AVCC (length prefixed) format """
+        if sync:
+            self.write_fragment()
+        if not self.samples and not sync:
+            # Fragments have to start with a sync sample
+            return
+        self.samples.append(sample)
+
+    def write_init_segment(self):
+        """ Write the ftyp and moov boxes, the moov box has empty sample tables and a mvex box """
+        sps = self.access_units.sps
+        pps = self.access_units.pps
+        if sps is None or pps is None:
+            raise ValueError("No H.264 SPS or PPS before the first frame")
+        tables = [full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+                  full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+                  full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+                  full_box(b'stco', 0, 0, struct.pack('>I', 0))]
+        trak = track_boxes(sps, pps, 0, 0, tables, self.creation_time)
+        # Samples default to non sync, the first sample of each fragment is flagged as sync
+        trex = full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, self.sample_delta, 0, 0x01010000))
+        init_segment = ftyp() + box(b'moov', mvhd(self.creation_time, 0), trak, box(b'mvex', trex))
+        self.fileobj.write(init_segment)
+        self.position += len(init_segment)
+        self.initialised = True
+
+    def write_fragment(self):
+        """ Write the samples held as a moof/mdat fragment """
+        if not self.samples:
+            return
+        if not self.initialised:
+            self.write_init_segment()
+        self.sequence_number += 1
+        sample_count = len(self.samples)
+        mfhd = full_box(b'mfhd', 0, 0, struct.pack('>I', self.sequence_number))
+        # default-base-is-moof so the data offset is from the start of the moof box
+        tfhd = full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+        tfdt = full_box(b'tfdt', 1, 0, struct.pack('>Q', self.decode_time))
+        # data-offset, first-sample-flags and sample-size are present
+        trun_size = 8 + 4 + 4 + 4 + 4 + 4 * sample_count
+        moof_size = 8 + len(mfhd) + 8 + len(tfhd) + len(tfdt) + trun_size
+        trun = full_box(b'trun', 0, 0x000205, struct.pack('>IiI', sample_count, moof_size + 8, 0x02000000), struct.pack(f'>{sample_count}I', *(len(sample) for sample in self.samples)))
+        moof = box(b'moof', mfhd, box(b'traf', tfhd, tfdt, trun))
+        mdat_size = 8 + sum(len(sample) for sample in self.samples)
+        self.fileobj.write(moof + struct.pack('>I4s', mdat_size, b'mdat'))
+        self.position += len(moof) + 8
+        for sample in self.samples:
+            if self.index is not None:
+                self.index.add_sample(self.position, len(sample), sample is self.samples[0])
+            self.fileobj.write(sample)
+            self.position += len(sample)
+        self.fileobj.flush()
+        self.decode_time += sample_count * self.sample_delta
+        self.samples = []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Write the last fragment """
+        for nal in self.nal_reader.flush():
+            finished = self.access_units.add(nal)
+            if finished is not None:
+                self.add_sample(*finished)
+        finished = self.access_units.finish()
+        if finished is not None:
+            self.add_sample(*finished)
+        self.write_fragment()
+        if not self.initialised:
+            raise ValueError("No H.264 frames found")
+
+
+def convert(input_path, output_path, framerate=25, chunk_size=1024*1024, key_frame_index_path=None):
+    """
+    Convert a raw Annex-B H.264 file to MP4 in one streaming pass
+
+    Keyword arguments:
+    input_path -- The full path of the h264 file
+
+    output_path -- The full path of the mp4 file to write
+
+    framerate -- The constant framerate of the video
+
+    chunk_size -- The number of bytes read at a time
+
+    key_frame_index_path -- The full path to save a Keyframe_index of the mp4 file to or None
+    """
+    index = Keyframe_index() if key_frame_index_path is not None else None
+    with open(input_path, 'rb') as input_fp, open(output_path, 'wb') as output_fp:
+        writer = Mp4_writer(output_fp, framerate, index)
+        while True:
+            data = input_fp.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+        # The h264 file was last written when the last frame arrived
+        end_time = os.fstat(input_fp.fileno()).st_mtime
+    if index is not None:
+        index.save(key_frame_index_path, writer.access_units.sps, writer.access_units.pps, framerate, end_time - index.sample_count / float(framerate))
+
+
+def read_boxes(fileobj, end=None, depth=0):
+    """
+    Return a list of (depth, type, size, offset) for the boxes in a MP4 file, used to check the muxer output
+
+    Keyword arguments:
+    fileobj -- A file object opened for binary reading, positioned at the first box
+
+    end -- The file offset the boxes end at, None reads to the end of the file
+    """
+    boxes = []
+    while end is None or fileobj.tell() < end:
+        offset = fileobj.tell()
+        header = fileobj.read(8)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', fileobj.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            fileobj.seek(0, 2)
+            size = fileobj.tell() - offset
+        if size < header_size:
+            raise ValueError(f"Bad box size {size} at offset {offset}")
+        boxes.append((depth, box_type.decode('latin-1'), size, offset))
+        if box_type in CONTAINER_BOXES:
+            fileobj.seek(offset + header_size)
+            boxes.extend(read_boxes(fileobj, offset + size, depth + 1))
+        fileobj.seek(offset + size)
+    return boxes
+
+
+if __name__ == '__main__':
+    # Usage
+    # python3 mp4_mux.py input.h264 output.mp4 [framerate]
+    # python3 mp4_mux.py --dump file.mp4
+    if len(sys.argv) == 3 and sys.argv[1] == '--dump':
+        with open(sys.argv[2], 'rb') as fp:
+            for depth, box_type, size, offset in read_boxes(fp):
+                print(f"{'  ' * depth}{box_type} size={size} offset={offset}")
+    elif len(sys.argv) in (3, 4):
+        convert(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) == 4 else 25)
+    else:
+        print("Usage: mp4_mux.py input.h264 output.mp4 [framerate] | mp4_mux.py --dump file.mp4")
@@ -17,16 +17,19 @@ __version__ = "0.1"
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import multiprocessing
-import time
-import logging
-import logging.handlers
 import os
 
+import unit
+import fake_gpio
+
 try:
     import RPi.GPIO as GPIO
 except RuntimeError:
     print("Error importing RPi.GPIO!  This is probably because you need superuser privileges.  You can achieve this by using 'sudo' to run your script")
+    GPIO = None
+except ImportError:
+    # Not on a Raspberry Pi, only gpio=fake in the SIMULATION section can be used
+    GPIO = None
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -34,75 +37,82 @@ except RuntimeError:
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Pir(multiprocessing.Process):
+class Pir(unit.Unit):
     """ A class to handle all pir based actions
         Adds a message to the record input queue to trigger it to generate an image
     """
-    def __init__(self, *, config, log_queue, output_queue):
+    def __init__(self, *, config, log_queue, output_queue, metrics_queue=None):
         """
         Initialise the pir class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object to send log messages to
 
         output_queue -- A queue object containing a message for the record class to generate a image when the pir sensor is triggered
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
         """
-        super(Pir, self).__init__()
-        self.config = config
-        self.log_queue = log_queue
+        super(Pir, self).__init__(config=config, log_queue=log_queue, unit_name='Pir', config_section='PIR', metrics_queue=metrics_queue)
         self.output_queue = output_queue
-
-        self.stoprequest = multiprocessing.Event()
-
-        # Setup logging
-        h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
-        self.queue_logger = logging.getLogger(name='Pir')
-        self.queue_logger.addHandler(h)
-        # apply this unit's logging level
-        log_level = {'CRITICAL': logging.CRITICAL, 'ERROR': logging.ERROR, 'WARNING': logging.WARNING, 'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
-        self.queue_logger.setLevel(log_level[self.config['PIR']['log_level']])
     
     def run(self):
         self.queue_logger.info("PIR started")
         print("PIR started\n")
         
+        # The PIR input is played back from a trace when simulating
+        if self.config['SIMULATION']['gpio'] == 'fake':
+            try:
+                edges = fake_gpio.load_trace(self.config['SIMULATION']['pir_trace']) if self.config['SIMULATION']['pir_trace'] else []
+            except (OSError, ValueError) as e:
+                self.queue_logger.error(f"Cannot load the PIR trace {e}")
+                return
+            self.GPIO = fake_gpio.Fake_gpio(edges, speed=self.config['SIMULATION']['speed'], edge_log=self.config['SIMULATION']['edge_log'])
+        elif GPIO is None:
+            self.queue_logger.error("RPi.GPIO cannot be imported, set gpio=fake in the SIMULATION section to run without it")
+            return
+        else:
+            self.GPIO = GPIO
+
         # Setup GPIO
-        GPIO.setmode(GPIO.BOARD)
-        self.PIR = int(self.config['PIR']['pin'])
-        GPIO.setup(self.PIR, GPIO.IN, GPIO.PUD_DOWN)
+        self.GPIO.setmode(self.GPIO.BOARD)
+        self.PIR = self.config['PIR']['pin']
+        self.GPIO.setup(self.PIR, self.GPIO.IN, self.GPIO.PUD_DOWN)
 
-        # Loop until PIR indicates nothing is happening
-        while GPIO.input(self.PIR)==1:
-            pass
+        # Wait until PIR indicates nothing is happening
+        while self.GPIO.input(self.PIR)==1 and not self.stoprequest.is_set():
+            self.GPIO.wait_for_edge(self.PIR, self.GPIO.FALLING, timeout=1000)
         self.queue_logger.info("PIR Sensor Ready")
         
         # add rising edge detection on a channel but only once per minute detection
-        GPIO.add_event_detect(self.PIR, GPIO.RISING, bouncetime=int(self.config['PIR']['min_trigger_seconds'])*1000)  
+        # The callback is run in a RPi.GPIO thread as soon as the edge happens
+        self.GPIO.add_event_detect(self.PIR, self.GPIO.RISING, callback=self.triggered, bouncetime=self.config['PIR']['min_trigger_seconds']*1000)
 
-        # Loop while not asked to exit
+        # Block until asked to exit
         while not self.stoprequest.is_set():
-            # Check if PIR was triggered
-            if GPIO.event_detected(self.PIR):
-                self.queue_logger.info("PIR Sensor Triggered")
-                if not os.path.isfile(self.config['PIR']['disable']):
-                    # Add message to the output queue
-                    self.output_queue.put("generate_notify_file")
-                else:
-                    self.queue_logger.info("PIR Sensor real time disabled")
-
-
-
-            # Go to sleep for a bit so not a tight loop
-            time.sleep(0.1)
+            self.get_message()
 
         # Asked to exit so do GPIO cleanup
-        GPIO.cleanup()
-
-
-
-    def join(self, timeout=None):
-        self.queue_logger.info("PIR asked to exit")
-        self.stoprequest.set()
-        super(Pir, self).join(timeout)
\ No newline at end of file
+        self.GPIO.cleanup()
+
+    def reload(self, config):
+        bouncetime_changed = config['PIR']['min_trigger_seconds'] != self.config['PIR']['min_trigger_seconds']
+        super(Pir, self).reload(config)
+        if bouncetime_changed:
+            # The edge detection has to be added again to change its bouncetime
+            self.GPIO.remove_event_detect(self.PIR)
+            self.GPIO.add_event_detect(self.PIR, self.GPIO.RISING, callback=self.triggered, bouncetime=self.config['PIR']['min_trigger_seconds']*1000)
+
+    def triggered(self, channel):
+        """ Callback for the PIR rising edge """
+        self.queue_logger.info("PIR Sensor Triggered")
+        if not os.path.isfile(self.config['PIR']['disable']):
+            # Add message to the output queue
+            self.output_queue.put("generate_notify_file")
+            self.metrics.inc('pir_triggers')
+        else:
+            self.queue_logger.info("PIR Sensor real time disabled")
+            self.metrics.inc('pir_triggers_disabled')
+        # Triggers are rare and the main loop is blocked so send them now
+        self.metrics.flush(force=True)
\ No newline at end of file
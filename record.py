@@ -17,13 +17,28 @@ __version__ = "0.1"
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import picamera
-import multiprocessing
 import queue
 import datetime as dt
 import os
-import logging
-import logging.handlers
+import io
+import time
+import threading
+
+import frame_ring
+import mp4_mux
+import motion
+import live_view
+import migrate
+import timeline
+import unit
+import fake_camera
+import segment_writer
+
+try:
+    import picamera
+except ImportError:
+    # Not on a Raspberry Pi, only camera=fake in the SIMULATION section can be used
+    picamera = None
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -31,7 +46,124 @@ import logging.handlers
 #set_trace(term_size=(80, 24))
 # Then telnet to the port shown on screen
 
-class Record(multiprocessing.Process):
+class Segment_stats:
+    """ A class to track encoder frames so each segment can report dropped frames
+        and the gap between it and the previous segment
+
+        Frame indexes and timestamps come from camera.frame, the timestamps are in microseconds
+    """
+    def __init__(self, framerate):
+        """
+        Initialise the segment stats class
+
+        Keyword arguments:
+        framerate -- The camera framerate used to work out the expected frame interval
+        """
+        self.frame_interval = 1000000 / float(framerate)
+        self.first = None
+        self.last = None
+        self.previous_last = None
+        self.continuous = False
+
+    def update(self, frame):
+        """ Record the most recent frame written by the encoder """
+        # SPS headers and incomplete frames have no timestamp
+        if frame is None or frame.timestamp is None:
+            return
+        if self.first is None:
+            self.first = (frame.index, frame.timestamp)
+        self.last = (frame.index, frame.timestamp)
+
+    def new_segment(self, continuous):
+        """
+        Finish the current segment and return a dictionary of its stats
+
+        Keyword arguments:
+        continuous -- True if the encoder keeps running into the next segment (split_recording)
+        so frame indexes carry on rather than restarting at 0
+        """
+        stats = {'frames': 0, 'dropped': 0, 'gap_ms': None}
+        if self.first is not None and self.last is not None:
+            stats['frames'] = self.last[0] - self.first[0] + 1
+            expected = round((self.last[1] - self.first[1]) / self.frame_interval) + 1
+            stats['dropped'] = max(0, expected - stats['frames'])
+            # Work out the join to the previous segment from its last frame and this segment's first frame
+            if self.previous_last is not None:
+                if self.continuous:
+                    frames_between = self.first[0] - self.previous_last[0]
+                else:
+                    frames_between = self.first[0] + 1
+                gap = (self.first[1] - self.previous_last[1]) - (frames_between * self.frame_interval)
+                # Timestamps jitter by a little each frame so only a gap of half a frame or more is lost footage
+                stats['gap_ms'] = gap / 1000 if gap >= self.frame_interval / 2 else 0.0
+        self.previous_last = self.last
+        self.continuous = continuous
+        self.first = None
+        self.last = None
+        return stats
+
+
+class Segment_output:
+    """ A file like output for the encoder that writes each segment to disk
+        and also into the pre event ring buffer if there is one
+        This means the ring buffer needs no extra encoder
+
+        The segment is written in large blocks by a segment_writer.Segment_writer, which is told where each GOP starts
+        so it can sync the file to storage per GOP if the STORAGE fsync setting asks for it
+
+        If a framerate is given the segment is written as fragmented MP4 rather than raw h264
+        with a key frame index saved next to it when it is closed
+    """
+    def __init__(self, path, ring, framerate, pool, config):
+        """
+        Initialise the segment output class
+
+        Keyword arguments:
+        path -- The full path of the segment file to write
+
+        ring -- A PiCameraCircularIO on the recording splitter port or None
+
+        framerate -- The framerate for fragmented MP4 output or None for raw h264
+
+        pool -- The segment_writer.Buffer_pool the file is written through
+
+        config -- A settings.Settings object with the STORAGE write settings
+        """
+        self.path = path
+        self.ring = ring
+        self.start_time = time.time()
+        self.file = segment_writer.open_segment(path, pool, config)
+        self.framerate = framerate
+        if framerate is not None:
+            self.index = mp4_mux.Keyframe_index()
+            self.muxer = mp4_mux.Fmp4_writer(self.file, framerate, self.index)
+        else:
+            self.muxer = None
+
+    def write(self, data):
+        # Each GOP starts with the SPS header, everything before it can be synced
+        if data[:4] == b'\x00\x00\x00\x01' and len(data) > 4 and data[4] & 0x1f == mp4_mux.NAL_SPS:
+            self.file.sync()
+        if self.ring is not None:
+            self.ring.write(data)
+        if self.muxer is not None:
+            return self.muxer.write(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        try:
+            if self.muxer is not None:
+                self.muxer.close()
+        finally:
+            self.file.close()
+        if self.muxer is not None:
+            self.index.save(mp4_mux.index_path(self.path), self.muxer.access_units.sps, self.muxer.access_units.pps, self.framerate, self.start_time)
+
+
+class Record(unit.Unit):
     """ A class to handle all camera based recording actions
         Video files are 1 minute long and grouped by hour and by date in ISO format date
         e.g
@@ -39,61 +171,163 @@ class Record(multiprocessing.Process):
         2019-01-01/01/02.h264
         etc
 
+        With container=mp4 the video files are written as fragmented MP4 (01.mp4) and need no conversion
+
+        If motion detection is enabled the encoder motion vectors are analysed as well and a notification
+        is generated from PIR and motion triggers by the fusion policy
+
+        A reloaded config takes effect straight away apart from the camera and encoder settings, these are
+        applied at the next segment boundary
+
+        Record always runs in its own process, it is the unit that must keep running and the motion
+        analysis needs a core of its own
+
         Note this rquiores Raspian buster for Python 3.7 or higher for fix for Python Issue29519
     """
-    def __init__(self, *, config, log_queue, input_queue, notification_output_queue, video_output_queue):
+    ISOLATE = True
+
+    def __init__(self, *, config, log_queue, input_queue, notification_output_queue, video_output_queue, metrics_queue=None):
         """
         Initialise the record class
 
         Keyword arguments:
-        config -- A ConfigParser object
+        config -- A settings.Settings object
 
         log_queue -- A queue object to send log messages to
 
         input_queue -- A queue object containing command message strings
         e.g generate_notify_file (this will be a still image or short video)
+        motion_detected is put on it by the motion analysis
 
         notification_output_queue -- A queue object containing the full path of generated notification files
         e.g  /tmp/notify.jpg
+        or a list of paths with the best frame first if notification_frames is more than 1
 
-        video_output_queue -- A queue object containing the full path of generated video files
+        video_output_queue -- A queue object containing the full path of generated video files and event clips
         e.g  /tmp/2019-01-01/02/03.h264
+        or None if nothing needs to be told about them
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
         """
-        super(Record, self).__init__()
-        self.config = config
-        self.log_queue = log_queue
-        self.input_queue = input_queue
+        super(Record, self).__init__(config=config, log_queue=log_queue, unit_name='Record', config_section='RECORD', input_queue=input_queue, metrics_queue=metrics_queue)
         self.notification_output_queue = notification_output_queue
         self.video_output_queue = video_output_queue
-
-        self.stoprequest = multiprocessing.Event()
-
-        # Setup logging
-        h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
-        self.queue_logger = logging.getLogger(name='Record')
-        self.queue_logger.addHandler(h)
-        # apply this unit's logging level
-        log_level = {'CRITICAL': logging.CRITICAL, 'ERROR': logging.ERROR, 'WARNING': logging.WARNING, 'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
-        self.queue_logger.setLevel(log_level[self.config['RECORD']['log_level']])
     
     def run(self):
         self.queue_logger.info("Recording started")
         print("Recording started\n")
 
-        # Check video_out_path exists and if not check that it can be created
-        if not os.path.isdir(self.config['RECORD']['video_out_path']):
+        # Synthetic frames from the fake camera when simulating, it is used through the same calls as picamera
+        if self.config['SIMULATION']['camera'] == 'fake':
+            self.camera_module = fake_camera
+            resolution = self.config['SIMULATION']['resolution'] or '1640x1232'
+        elif picamera is None:
+            self.queue_logger.error("picamera cannot be imported, set camera=fake in the SIMULATION section to run without it")
+            return
+        else:
+            self.camera_module = picamera
+            resolution = '1640x1232'
+
+        # Segments are written to the staging path if there is one so the encoder never waits on network storage
+        segment_path = migrate.local_path(self.config)
+        # Check segment_path exists and if not check that it can be created
+        if not os.path.isdir(segment_path):
             # Create all the directories needed
-            os.makedirs(self.config['RECORD']['video_out_path'], exist_ok=True)
+            os.makedirs(segment_path, exist_ok=True)
         
         # Check notification_out_path exists and if not check that it can be created
         if not os.path.isdir(self.config['RECORD']['notification_out_path']):
             # Create all the directories needed
             os.makedirs(self.config['RECORD']['notification_out_path'], exist_ok=True)
 
-        camera = picamera.PiCamera(sensor_mode=4, resolution='1640x1232', framerate=25)
-        camera.hflip=bool(self.config['RECORD']['hflip'])
-        camera.vflip=bool(self.config['RECORD']['vflip'])
+        # Index of the segments and events, written from a thread so a locked or slow database does not hold up the
+        # recording, None if not enabled
+        if timeline.timeline_path(self.config) is not None:
+            self.timeline_queue = queue.Queue()
+            # A daemon thread so a stuck database cannot stop the process exiting if the recording fails
+            timeline_writer = threading.Thread(target=self.write_timeline, args=(self.timeline_queue,), daemon=True)
+            timeline_writer.start()
+        else:
+            self.timeline_queue = None
+        segment_status = timeline.STATUS_MP4 if self.config['RECORD']['container'] == 'mp4' else timeline.STATUS_H264
+
+        camera = self.camera_module.PiCamera(sensor_mode=4, resolution=resolution, framerate=self.config['RECORD']['framerate'])
+        camera.hflip = self.config['RECORD']['hflip']
+        camera.vflip = self.config['RECORD']['vflip']
+        # The config the camera settings were last applied from, a reloaded config is applied at the next segment
+        camera_config = self.config
+        segment_stats = Segment_stats(camera.framerate)
+
+        # Motion detection on the motion vectors the encoder produces anyway, fused with the PIR triggers
+        motion_enabled = self.config['MOTION']['enabled']
+        if motion_enabled and motion.np is None:
+            self.queue_logger.error("NumPy is not installed, motion detection is disabled")
+            motion_enabled = False
+        if motion_enabled:
+            motion_output = motion.Motion_output(motion.detector_from_config(self.config, camera.resolution), self.motion_detected,
+                                                 frame_budget=self.config['MOTION']['frame_budget_ms']/1000,
+                                                 min_trigger_seconds=self.config['MOTION']['min_trigger_seconds'])
+            fusion = motion.Trigger_fusion(self.config['MOTION']['fusion'], self.config['MOTION']['fusion_window_seconds'])
+        else:
+            motion_output = None
+            fusion = motion.Trigger_fusion('pir')
+        recording_options = self.recording_options(motion_output)
+        # Write raw h264 that needs converting or fragmented MP4 that can be played straight away
+        if self.config['RECORD']['container'] == 'mp4':
+            segment_framerate = camera.framerate
+            segment_extension = '.mp4'
+        else:
+            segment_framerate = None
+            segment_extension = '.h264'
+        # Blocks the segments are written through, shared so the last segment can finish writing after a split
+        write_pool = segment_writer.Buffer_pool(self.config['STORAGE']['write_buffers'], self.config['STORAGE']['write_block_kb']*1024)
+
+        # Keep the last few seconds of the encoder output in memory so an event clip can include pre trigger footage
+        if self.config['RECORD']['pre_event_seconds'] + self.config['RECORD']['post_event_seconds'] > 0:
+            ring = self.camera_module.PiCameraCircularIO(camera, size=self.config['RECORD']['event_buffer_mb']*1024*1024, splitter_port=1)
+        else:
+            ring = None
+        # Time the current event clip should be saved and its file name
+        event_clip_time = None
+        event_clip_path = None
+
+        # Keep the last few low resolution MJPEG frames from a splitter port so a notification still can be
+        # picked from the frames around the trigger without a blocking capture
+        # The live view serves the same frames so it needs no encoder of its own
+        still_ring_frames = self.config['RECORD']['still_ring_frames']
+        live_view_enabled = self.config['LIVE_VIEW']['enabled']
+        if still_ring_frames > 0 or live_view_enabled:
+            still_resolution = self.config['RECORD']['still_resolution']
+            # Half a byte per pixel is far larger than any JPEG the encoder will produce
+            mjpeg_ring = frame_ring.Frame_ring(max(still_ring_frames, 2), still_resolution[0] * still_resolution[1] // 2)
+            camera.start_recording(mjpeg_ring, format='mjpeg', splitter_port=2, resize=still_resolution, bitrate=0, quality=self.config['RECORD']['image_quality'])
+        else:
+            mjpeg_ring = None
+        still_ring = mjpeg_ring if still_ring_frames > 0 else None
+        if live_view_enabled:
+            try:
+                viewer = live_view.Live_view(mjpeg_ring, self.queue_logger,
+                                             bind=self.config['LIVE_VIEW']['bind'],
+                                             port=self.config['LIVE_VIEW']['port'],
+                                             max_clients=self.config['LIVE_VIEW']['max_clients'],
+                                             max_fps=self.config['LIVE_VIEW']['max_fps'])
+                viewer.start()
+            except OSError as e:
+                self.queue_logger.error(f"Cannot start the live view {e}")
+                viewer = None
+        else:
+            viewer = None
+        # Pending notification stills as (trigger time, output path)
+        pending_stills = []
+        # The time in the name of the last still so a second trigger in the same second does not overwrite it
+        last_still_stamp = None
+        # Stills are written from a thread so the recording loop is not held up by slow storage
+        still_writer_queue = queue.Queue()
+        still_writer = threading.Thread(target=self.write_stills, args=(still_writer_queue,))
+        still_writer.start()
+
         input_queue_message = ""
+        segment_output = None
         while not self.stoprequest.is_set():
             # Get the current number of seconds so the recording can be aligned to the start of the minute
             date_time = dt.datetime.now()
@@ -101,40 +335,282 @@ class Record(multiprocessing.Process):
             self.queue_logger.info(f"current_minute={current_minute}")
             
             # Make right right directories
-            current_hour_path = os.path.join(self.config['RECORD']['video_out_path'], date_time.strftime('%Y-%m-%d/%H'))
+            current_hour_path = os.path.join(segment_path, date_time.strftime('%Y-%m-%d/%H'))
             os.makedirs(current_hour_path, exist_ok=True)
-            h264_video_output_path = os.path.join(current_hour_path, date_time.strftime('%M.h264'))
-            camera.start_recording(h264_video_output_path, bitrate=0, quality=int(self.config['RECORD']['video_quality']))
+            next_segment_output = Segment_output(os.path.join(current_hour_path, date_time.strftime('%M') + segment_extension), ring, segment_framerate,
+                                                 write_pool, self.config)
+            if segment_output is None:
+                camera.start_recording(next_segment_output, format='h264', **recording_options)
+            else:
+                # Ask for an IDR frame now so the split happens on the next frame rather than waiting for the intra period
+                camera.request_key_frame()
+                camera.split_recording(next_segment_output)
+                self.finish_segment(segment_stats, segment_output, segment_status, continuous=True)
+            segment_output = next_segment_output
+            if still_ring is not None:
+                self.metrics.set('still_ring_dropped', still_ring.dropped)
+            if viewer is not None:
+                clients = viewer.client_stats()
+                self.metrics.set('live_view_clients', len(clients))
+                self.metrics.set('live_view_worst_lag_seconds', max((client['worst_lag_ms'] for client in clients), default=0) / 1000)
 
-            # Loop to the end of a minute
+            # Loop to the end of a minute or until asked to exit, get_message returns straight away once asked
+            # so the segment is closed within a frame or two
             # Covers not starting on second 00 and if the wait_recording drifts a bit
-            while dt.datetime.now().minute == current_minute:
-                camera.annotate_background = picamera.Color('black')
+            while dt.datetime.now().minute == current_minute and not self.stoprequest.is_set():
+                camera.annotate_background = self.camera_module.Color('black')
                 camera.annotate_text = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                # Handle if an image capture is requested
-                try:
-                    input_queue_message = self.input_queue.get(block=False)
-                except queue.Empty:
-                    pass
+                # Wait for a message so an image capture is handled as soon as it is requested
+                input_queue_message = self.get_message(timeout=0.1)
+                # Raise any error from the encoder
+                camera.wait_recording(0)
+                segment_stats.update(camera.frame)
+
                 if input_queue_message == "generate_notify_file":
-                    output_path = os.path.join(self.config['RECORD']['notification_out_path'], dt.datetime.now().strftime('%Y-%m-%d-%H-%M-%S.jpg'))
-                    camera.capture(output_path, use_video_port=True, quality=int(self.config['RECORD']['image_quality']))
-                    input_queue_message = ""
+                    trigger_source = fusion.add('pir')
+                elif input_queue_message == "motion_detected":
+                    trigger_source = fusion.add('motion')
+                else:
+                    trigger_source = None
+
+                if trigger_source is not None:
+                    trigger_time = time.monotonic()
+                    self.metrics.inc('notify_requests')
+                    now = dt.datetime.now()
+                    still_stamp = now.strftime('%Y-%m-%d-%H-%M-%S')
+                    if still_stamp == last_still_stamp:
+                        output_name = f"{still_stamp}_{now.microsecond // 1000:03d}.jpg"
+                    else:
+                        output_name = f"{still_stamp}.jpg"
+                    last_still_stamp = still_stamp
+                    output_path = os.path.join(self.config['RECORD']['notification_out_path'], output_name)
+                    if still_ring is not None:
+                        pending_stills.append((trigger_time, output_path))
+                    else:
+                        camera.capture(output_path, use_video_port=True, quality=self.config['RECORD']['image_quality'])
+                        # Add to notification_output_queue
+                        self.notification_output_queue.put(output_path)
+
+                    # Start an event clip unless one is already waiting for its post trigger footage
+                    if ring is not None and event_clip_time is None:
+                        event_clip_time = trigger_time + self.config['RECORD']['post_event_seconds']
+                        event_clip_path = os.path.splitext(output_path)[0] + segment_extension
+                    if self.timeline_queue is not None:
+                        # A trigger during an event clip is covered by that clip
+                        self.timeline_queue.put(('event', time.time(), trigger_source, output_path, event_clip_path))
+
+                # Pick the best frame for each still once the frames after the trigger are in the ring
+                still_before_seconds = self.config['RECORD']['still_before_seconds']
+                still_after_seconds = self.config['RECORD']['still_after_seconds']
+                while pending_stills and time.monotonic() >= pending_stills[0][0] + still_after_seconds:
+                    trigger_time, output_path = pending_stills.pop(0)
+                    # More than one frame lets the render unit make a contact sheet
+                    notification_frames = self.config['RECORD']['notification_frames']
+                    if notification_frames > 1:
+                        jpegs = still_ring.frames(trigger_time - still_before_seconds, trigger_time + still_after_seconds, notification_frames)
+                    else:
+                        best_frame = still_ring.best_frame(trigger_time - still_before_seconds, trigger_time + still_after_seconds)
+                        jpegs = [best_frame[0]] if best_frame is not None else []
+                    if not jpegs:
+                        self.queue_logger.warning(f"No frame in the still ring for {output_path}")
+                        continue
+                    still_writer_queue.put((jpegs, output_path, trigger_time))
+
+                # Save the event clip once the post trigger footage is in the ring buffer
+                if event_clip_time is not None and time.monotonic() >= event_clip_time:
+                    self.save_event_clip(ring, event_clip_path, self.config['RECORD']['pre_event_seconds'] + self.config['RECORD']['post_event_seconds'])
+                    event_clip_time = None
+                    self.metrics.inc('event_clips')
+
+            # Apply the camera settings of a reloaded config at the segment boundary
+            if self.config is not camera_config:
+                camera.hflip = self.config['RECORD']['hflip']
+                camera.vflip = self.config['RECORD']['vflip']
+                if mjpeg_ring is not None and self.config['RECORD']['image_quality'] != camera_config['RECORD']['image_quality']:
+                    # Only the MJPEG encoder restarts, the ring and the live view clients carry on
+                    camera.stop_recording(splitter_port=2)
+                    camera.start_recording(mjpeg_ring, format='mjpeg', splitter_port=2, resize=still_resolution, bitrate=0, quality=self.config['RECORD']['image_quality'])
+                if motion_output is not None:
+                    motion_output.detector = motion.detector_from_config(self.config, camera.resolution)
+                    motion_output.frame_budget = self.config['MOTION']['frame_budget_ms']/1000
+                    motion_output.min_trigger_seconds = self.config['MOTION']['min_trigger_seconds']
+                    if (self.config['MOTION']['fusion'], self.config['MOTION']['fusion_window_seconds']) != (camera_config['MOTION']['fusion'], camera_config['MOTION']['fusion_window_seconds']):
+                        fusion = motion.Trigger_fusion(self.config['MOTION']['fusion'], self.config['MOTION']['fusion_window_seconds'])
+                camera_config = self.config
+            # rollover_mode split keeps the encoder running and switches file on the next key frame, restart stops and
+            # starts it at each minute, the encoder options can only change when it starts so a change restarts it too
+            next_recording_options = self.recording_options(motion_output)
+            if self.config['RECORD']['rollover_mode'] == 'restart' or next_recording_options != recording_options or self.stoprequest.is_set():
+                # Stop recording so ready for next minute
+                camera.stop_recording()
+                self.finish_segment(segment_stats, segment_output, segment_status, continuous=False)
+                segment_output = None
+            recording_options = next_recording_options
+
+        # Save any event clip still waiting for its post trigger footage
+        if event_clip_time is not None:
+            self.save_event_clip(ring, event_clip_path, self.config['RECORD']['pre_event_seconds'] + self.config['RECORD']['post_event_seconds'])
+        if viewer is not None:
+            viewer.stop()
+        if mjpeg_ring is not None:
+            camera.stop_recording(splitter_port=2)
+            self.queue_logger.info(f"Still ring dropped {mjpeg_ring.dropped} frames that were too large")
+        if motion_output is not None:
+            self.queue_logger.info(f"Motion analysis {motion_output.stats()}")
+        # Tell the still writer to finish
+        still_writer_queue.put(None)
+        still_writer.join()
+        camera.close()
+        if self.timeline_queue is not None:
+            self.timeline_queue.put(None)
+            timeline_writer.join()
+
+    def recording_options(self, motion_output):
+        """ Return the H.264 encoder options from the config, with the Motion_output if there is one """
+        # Inline headers are needed so each segment starts with SPS/PPS and can be split on
+        options = {'bitrate': 0, 'quality': self.config['RECORD']['video_quality'], 'inline_headers': True, 'intra_period': self.config['RECORD']['intra_period']}
+        if motion_output is not None:
+            options['motion_output'] = motion_output
+        return options
+
+    def finish_segment(self, segment_stats, segment_output, segment_status, *, continuous):
+        """
+        Report the stats of a finished segment, close it and pass it on for conversion
+
+        Keyword arguments:
+        segment_stats -- The Segment_stats object tracking the recording
+
+        segment_output -- The Segment_output of the finished segment
 
-                    # Add to notification_output_queue
-                    self.notification_output_queue.put(output_path)
+        segment_status -- The timeline status of the segment
 
-                # Wait
-                camera.wait_recording(0.1)
+        continuous -- True if the encoder carries on into the next segment
+        """
+        try:
+            segment_output.close()
+        except (ValueError, OSError) as e:
+            self.queue_logger.error(f"Cannot close segment {segment_output.path} {e}")
+        stats = segment_stats.new_segment(continuous)
+        write_stats = segment_output.file.stats()
+        self.queue_logger.info(f"Segment {segment_output.path} frames={stats['frames']} dropped={stats['dropped']} gap_ms={stats['gap_ms']} "
+                               + ' '.join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}" for key, value in write_stats.items()))
+        if stats['dropped'] or stats['gap_ms']:
+            self.queue_logger.warning(f"Segment {segment_output.path} is missing footage dropped={stats['dropped']} gap_ms={stats['gap_ms']}")
+        if write_stats['worst_stall_ms'] > 1000 / self.config['RECORD']['framerate']:
+            self.queue_logger.warning(f"Segment {segment_output.path} storage too slow, the encoder waited {write_stats['worst_stall_ms']:.0f}ms for a write buffer")
+        self.metrics.inc('segments')
+        self.metrics.inc('segment_write_syscalls', write_stats['writes'])
+        self.metrics.inc('segment_fsyncs', write_stats['fsyncs'])
+        self.metrics.inc('segment_bytes_written', write_stats['bytes_written'])
+        self.metrics.set('segment_write_mbps', write_stats['throughput_mbps'])
+        self.metrics.observe('segment_worst_write_seconds', write_stats['worst_write_ms'] / 1000)
+        self.metrics.observe('segment_write_stall_seconds', write_stats['worst_stall_ms'] / 1000)
+        if self.timeline_queue is not None:
+            self.timeline_queue.put(('segment', segment_output.path, segment_output.start_time, time.time(), segment_status))
+        self.metrics.inc('frames', stats['frames'])
+        self.metrics.inc('frames_dropped', stats['dropped'])
+        self.metrics.inc('gap_seconds', (stats['gap_ms'] or 0) / 1000)
+
+        # Add to video_output_queue so the video gets converted to mp4
+        if self.video_output_queue is not None:
+            self.video_output_queue.put(segment_output.path)
+
+    def motion_detected(self, area):
+        """ Motion_output callback, run in the encoder thread so it only passes the trigger to the recording loop """
+        self.queue_logger.info(f"Motion detected area={area}")
+        self.metrics.inc('motion_triggers')
+        self.input_queue.put("motion_detected")
+
+    def write_stills(self, still_writer_queue):
+        """
+        Write notification stills to disk, run as a thread
+        The best frame is written to the output path and any others to output path with -1, -2 etc added
+
+        Keyword arguments:
+        still_writer_queue -- A queue.Queue of (list of jpeg bytes, output path, trigger time) or None to finish
+        """
+        while True:
+            still = still_writer_queue.get()
+            if still is None:
+                break
+            jpegs, output_path, trigger_time = still
+            base, extension = os.path.splitext(output_path)
+            paths = [output_path] + [f"{base}-{i}{extension}" for i in range(1, len(jpegs))]
+            try:
+                for jpeg, path in zip(jpegs, paths):
+                    with open(path, 'wb') as fp:
+                        fp.write(jpeg)
+            except OSError as e:
+                self.queue_logger.error(f"Cannot write still {output_path} {e}")
+                continue
+            self.queue_logger.info(f"Still {output_path} written {(time.monotonic() - trigger_time)*1000:.1f}ms after trigger")
+            self.metrics.observe('still_latency_seconds', time.monotonic() - trigger_time)
+
+            # Add to notification_output_queue, a list if there is more than one frame
+            self.notification_output_queue.put(output_path if len(paths) == 1 else paths)
+
+    def write_timeline(self, timeline_queue):
+        """
+        Write the segments and events to the timeline, run as a thread
+        The timeline is opened here as an SQLite connection can only be used from the thread that opened it
+
+        Keyword arguments:
+        timeline_queue -- A queue.Queue of ('segment', path, start, end, status), ('event', time, source, still path, clip path)
+        or None to finish
+        """
+        index = timeline.open_timeline(self.config, self.queue_logger)
+        while True:
+            entry = timeline_queue.get()
+            if entry is None:
+                break
+            if index is None:
+                continue
+            if entry[0] == 'segment':
+                path, start, end, status = entry[1:]
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+                index.add_segment(path, start, end, size, status)
+            else:
+                index.add_event(*entry[1:])
+        if index is not None:
+            index.close()
 
-            # Stop recording so ready for next minute
-            camera.stop_recording()
+    def save_event_clip(self, ring, event_clip_path, seconds):
+        """
+        Save the pre and post trigger footage in the ring buffer as an event clip
+
+        The ring buffer is copied to memory, which is quick, so the encoder is not held up
+        Writing the clip to disk is done in a thread so the recording loop is not held up by slow storage
 
-            # Add to video_output_queue so the video gets converted to mp4
-            self.video_output_queue.put(h264_video_output_path)
+        Keyword arguments:
+        ring -- The PiCameraCircularIO holding the recent footage
 
+        event_clip_path -- The full path of the h264 event clip to write
+
+        seconds -- The number of seconds of footage to save
+        """
+        clip = io.BytesIO()
+        # Start from a SPS header so the clip can be decoded on its own
+        ring.copy_to(clip, seconds=seconds, first_frame=self.camera_module.PiVideoFrameType.sps_header)
+        self.queue_logger.info(f"Saving event clip {event_clip_path} bytes={clip.tell()}")
+        threading.Thread(target=self.write_event_clip, args=(clip, event_clip_path)).start()
 
-    def join(self, timeout=None):
-        self.queue_logger.info("Recorder asked to exit")
-        self.stoprequest.set()
-        super(Record, self).join(timeout)
\ No newline at end of file
+    def write_event_clip(self, clip, event_clip_path):
+        try:
+            if event_clip_path.endswith('.mp4'):
+                # The clip is muxed straight to MP4 as it is written so it needs no conversion
+                with open(event_clip_path, 'wb') as fp:
+                    muxer = mp4_mux.Mp4_writer(fp, self.config['RECORD']['framerate'])
+                    muxer.write(clip.getbuffer())
+                    muxer.close()
+            else:
+                with open(event_clip_path, 'wb') as fp:
+                    fp.write(clip.getbuffer())
+        except (ValueError, OSError) as e:
+            self.queue_logger.error(f"Cannot write event clip {event_clip_path} {e}")
+        else:
+            # Add to video_output_queue so the clip gets converted to mp4
+            if self.video_output_queue is not None:
+                self.video_output_queue.put(event_clip_path)
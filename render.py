@@ -0,0 +1,218 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import io
+import math
+import time
+import concurrent.futures
+
+import unit
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+def encode_within(image, target_bytes, min_quality, max_quality):
+    """
+    Return the JPEG bytes of the image at the highest quality and resolution that fits in target_bytes
+    The quality is searched first, then the resolution is stepped down by 3/4 until it fits
+
+    Keyword arguments:
+    image -- A PIL Image
+
+    target_bytes -- The maximum size of the JPEG
+
+    min_quality, max_quality -- The range of JPEG quality to search
+    """
+    while True:
+        best = None
+        low, high = min_quality, max_quality
+        # Binary search for the highest quality that fits
+        while low <= high:
+            quality = (low + high) // 2
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+            if output.tell() <= target_bytes:
+                best = output.getvalue()
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is not None or min(image.size) <= 64:
+            if best is None:
+                # Too small to go further, use the lowest quality
+                output = io.BytesIO()
+                image.save(output, format='JPEG', quality=min_quality, optimize=True)
+                best = output.getvalue()
+            return best
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.BILINEAR)
+
+
+def contact_sheet(images, width):
+    """ Return a single image of the images in a grid, width is the width of the sheet """
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell_width = width // columns
+    cell_height = cell_width * images[0].height // images[0].width
+    sheet = Image.new('RGB', (cell_width * columns, cell_height * rows))
+    for i, image in enumerate(images):
+        sheet.paste(image.resize((cell_width, cell_height), Image.BILINEAR), ((i % columns) * cell_width, (i // columns) * cell_height))
+    return sheet
+
+
+def render(image_paths, output_path, target_bytes, min_quality, max_quality, max_width, sheet):
+    """
+    Render the email attachment for a notification, run in a worker process
+    Returns (output path, bytes, seconds taken)
+
+    Keyword arguments:
+    image_paths -- The full paths of the notification images, the first is the best frame
+
+    output_path -- The full path of the attachment to write
+
+    target_bytes -- The maximum size of the attachment
+
+    min_quality, max_quality -- The range of JPEG quality to search
+
+    max_width -- The maximum width of the attachment
+
+    sheet -- True to make a contact sheet of all the images rather than use the first
+    """
+    start_time = time.monotonic()
+    images = [Image.open(path).convert('RGB') for path in (image_paths if sheet else image_paths[:1])]
+    if len(images) > 1:
+        image = contact_sheet(images, min(max_width, images[0].width * 2))
+    else:
+        image = images[0]
+    if image.width > max_width:
+        image = image.resize((max_width, image.height * max_width // image.width), Image.BILINEAR)
+    jpeg = encode_within(image, target_bytes, min_quality, max_quality)
+    with open(output_path, 'wb') as fp:
+        fp.write(jpeg)
+    return output_path, len(jpeg), time.monotonic() - start_time
+
+
+def render_result(future):
+    """ Return (result, None) for a successful render future or (None, error message) """
+    try:
+        return (future.result(), None)
+    except Exception as err:
+        return (None, f"{err}")
+
+
+class Render(unit.Unit):
+    """ A class to turn notification images into size bounded email attachments
+
+        The JPEG quality and then the resolution are reduced until the attachment is within target_kb
+        If Record sends several frames they can be made into a contact sheet
+        The rendering is done in a pool of worker processes so it is kept off the camera process
+        Needs Pillow, without it the images are passed on unchanged
+    """
+    def __init__(self, *, config, log_queue, input_queue, output_queue, metrics_queue=None):
+        """
+        Initialise the render class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        log_queue -- A queue object to send log messages to
+
+        input_queue -- A queue object containing the full path of a notification image or a list of paths with the best first
+
+        output_queue -- A queue object to send the full path of the rendered attachment to
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
+        """
+        super(Render, self).__init__(config=config, log_queue=log_queue, unit_name='Render', config_section='RENDER', input_queue=input_queue, metrics_queue=metrics_queue)
+        self.output_queue = output_queue
+
+    def run(self):
+        self.queue_logger.info("Render started")
+        print("Render started\n")
+        if Image is None:
+            self.queue_logger.warning("Pillow is not installed, notification images are emailed unchanged")
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.config['RENDER']['workers'])
+        # Totals for the bytes per alert report
+        self.alerts = 0
+        self.total_bytes = 0
+
+        # Loop while not asked to exit
+        while not self.stoprequest.is_set():
+            # Block until a notification arrives or a render finishes
+            input_queue_message = self.get_message()
+            if input_queue_message is None:
+                continue
+
+            if isinstance(input_queue_message, tuple):
+                self.rendered(*input_queue_message[1:])
+                continue
+
+            image_paths = input_queue_message if isinstance(input_queue_message, list) else [input_queue_message]
+            if Image is None:
+                self.output_queue.put(image_paths if len(image_paths) > 1 else image_paths[0])
+                continue
+            output_path = os.path.splitext(image_paths[0])[0] + '-email.jpg'
+            future = executor.submit(render, image_paths, output_path, self.config['RENDER']['target_kb']*1024, self.config['RENDER']['min_quality'],
+                                     self.config['RENDER']['max_quality'], self.config['RENDER']['max_width'], self.config['RENDER']['contact_sheet'])
+            # The result is passed back through the input queue so it wakes up the loop
+            future.add_done_callback(lambda future, image_paths=image_paths: self.input_queue.put(('rendered', image_paths) + render_result(future)))
+
+        # Pass on the renders that finish after being asked to exit and any notifications not yet rendered unchanged
+        executor.shutdown(wait=True)
+        while not self.input_queue.empty():
+            input_queue_message = self.input_queue.get()
+            if isinstance(input_queue_message, tuple):
+                self.rendered(*input_queue_message[1:])
+            elif isinstance(input_queue_message, (str, list)):
+                image_paths = input_queue_message if isinstance(input_queue_message, list) else [input_queue_message]
+                self.output_queue.put(image_paths if len(image_paths) > 1 else image_paths[0])
+
+    def rendered(self, image_paths, result, error):
+        """
+        Handle a finished render
+
+        Keyword arguments:
+        image_paths -- The full paths of the notification images
+
+        result -- The (output path, bytes, seconds taken) of the render
+
+        error -- None or the error message if the render failed
+        """
+        if error is not None:
+            self.queue_logger.error(f"Cannot render {image_paths} error:{error}, emailing the original")
+            self.metrics.inc('render_failures')
+            self.output_queue.put(image_paths[0])
+            return
+        output_path, size, seconds = result
+        self.alerts += 1
+        self.total_bytes += size
+        self.queue_logger.info(f"Rendered {output_path} bytes={size} in {seconds:.2f}s average bytes per alert={self.total_bytes // self.alerts}")
+        self.metrics.inc('renders')
+        self.metrics.inc('rendered_bytes', size)
+        self.metrics.observe('render_seconds', seconds)
+        self.output_queue.put(output_path)
+
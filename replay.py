@@ -0,0 +1,243 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import configparser
+import datetime as dt
+import os
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import settings
+import fake_gpio
+import smtp_sink
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# A queue depth or the outbox size in the stats file
+BACKLOG_LINE = re.compile(r'^pir_security_(queue_depth\{queue="([^"]+)"\}|outbox_emails\{[^}]*\}) (\S+)$')
+# Notification images are named by the time Record handled the trigger
+IMAGE_TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+
+def scripted_trace(path, triggers, *, seconds=24*60*60, high_seconds=5, seed=None):
+    """
+    Write a PIR trace of a day with triggers at random times and return the number written
+
+    Keyword arguments:
+    path -- The full path of the trace file to write
+
+    triggers -- The number of times the PIR goes high
+
+    seconds -- The length of the trace
+
+    high_seconds -- How long the PIR stays high each time
+
+    seed -- The random seed so a trace can be made again or None
+    """
+    generator = random.Random(seed)
+    starts = sorted(generator.uniform(0, seconds - high_seconds) for i in range(triggers))
+    written = 0
+    end = -1
+    with open(path, 'w') as fp:
+        fp.write("# Scripted PIR trace, seconds and level\n0 0\n")
+        for start in starts:
+            # Overlapping triggers would be one long one
+            if start <= end:
+                continue
+            end = start + high_seconds
+            fp.write(f"{start:.3f} 1\n{end:.3f} 0\n")
+            written += 1
+    return written
+
+
+def simulation_config(config_path, work_path, *, trace_path, speed, smtp_port):
+    """
+    Write the security.ini for the replay to work_path and return its path
+
+    The settings are taken from config_path if it exists, with the hardware replaced by the fake camera and GPIO,
+    the email sent to the SMTP sink, the metrics written to a stats file every second and every path in work_path
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    if config_path is not None and os.path.isfile(config_path):
+        parser.read(config_path)
+    overrides = {
+        'LOGGING': {'log_filename': os.path.join(work_path, 'security.log')},
+        'SIMULATION': {'camera': 'fake', 'gpio': 'fake', 'pir_trace': trace_path, 'speed': str(speed), 'edge_log': os.path.join(work_path, 'edges.log')},
+        'EMAILER': {'server': '127.0.0.1', 'port': str(smtp_port), 'starttls': 'False', 'user': '', 'password': '',
+                    'outbox_path': os.path.join(work_path, 'outbox')},
+        'RECORD': {'video_out_path': os.path.join(work_path, 'video'), 'notification_out_path': os.path.join(work_path, 'notify')},
+        'METRICS': {'enabled': 'True', 'port': '0', 'stats_file': os.path.join(work_path, 'stats.prom'), 'stats_seconds': '1', 'flush_seconds': '0.5'},
+        'PIR': {'disable': os.path.join(work_path, 'pir_disable')},
+        'LIVE_VIEW': {'enabled': 'False'},
+        'TIMELINE': {'path': os.path.join(work_path, 'timeline.sqlite')},
+        'MP4_CONVERT': {'journal_path': os.path.join(work_path, 'mp4_convert_journal')},
+        'SHIPPER': {'journal_path': os.path.join(work_path, 'shipper_journal')},
+    }
+    # Staging is only replaced if it is used
+    if parser.get('STORAGE', 'staging_path', fallback=''):
+        overrides['STORAGE'] = {'staging_path': os.path.join(work_path, 'staging')}
+    for section, options in overrides.items():
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for key, value in options.items():
+            parser.set(section, key, value)
+    for key in ('from', 'to'):
+        if not parser.get('EMAILER', key, fallback=''):
+            parser.set('EMAILER', key, 'replay@localhost')
+    path = os.path.join(work_path, 'security.ini')
+    with open(path, 'w') as fp:
+        parser.write(fp)
+    # Fail now rather than in security.py
+    settings.load(path)
+    return path
+
+
+def read_backlogs(stats_path, backlogs):
+    """ Update backlogs, a dictionary of name to the largest depth seen, from the stats file """
+    try:
+        with open(stats_path, 'r') as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        return
+    for line in lines:
+        match = BACKLOG_LINE.match(line)
+        if match is not None:
+            name = match.group(2) or 'outbox_emails'
+            backlogs[name] = max(backlogs.get(name, 0), float(match.group(3)))
+
+
+def read_triggers(edge_log):
+    """ Return the wall clock times of the PIR triggers written to the edge log """
+    try:
+        with open(edge_log, 'r') as fp:
+            return [float(line.split()[0]) for line in fp if line.strip()]
+    except OSError:
+        return []
+
+
+def trigger_latencies(triggers, messages):
+    """
+    Return the seconds from each trigger to the email with its image and the number of triggers with no email
+
+    An image is matched to the first trigger in the second it is named by, or the second before
+
+    Keyword arguments:
+    triggers -- The wall clock times of the triggers
+
+    messages -- The messages received by the SMTP sink
+    """
+    images = []
+    for receive_time, mail_from, recipients, attachments in messages:
+        for attachment in attachments:
+            try:
+                image_time = time.mktime(dt.datetime.strptime(attachment[:19], IMAGE_TIME_FORMAT).timetuple())
+            except ValueError:
+                continue
+            images.append((image_time, receive_time))
+    images.sort()
+    latencies = []
+    unmatched = 0
+    for trigger in sorted(triggers):
+        for i, (image_time, receive_time) in enumerate(images):
+            if image_time - 1 <= trigger < image_time + 1:
+                latencies.append(receive_time - trigger)
+                del images[i]
+                break
+        else:
+            unmatched += 1
+    return latencies, unmatched
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def replay(config_path, work_path, trace_path, speed, drain_seconds):
+    """ Run security.py on the trace and print the trigger to email latency and the queue backlogs """
+    edges = fake_gpio.load_trace(trace_path)
+    duration = edges[-1][0] / speed if edges else 0
+    sink = smtp_sink.Smtp_sink()
+    sink.start()
+    ini_path = simulation_config(config_path, work_path, trace_path=os.path.abspath(trace_path), speed=speed, smtp_port=sink.port)
+    stats_path = os.path.join(work_path, 'stats.prom')
+    edge_log = os.path.join(work_path, 'edges.log')
+    print(f"Replaying {sum(1 for seconds, level in edges if level)} triggers over {edges[-1][0] if edges else 0:.0f}s "
+          f"at {speed}x, about {duration + drain_seconds:.0f}s, settings in {ini_path}")
+
+    # security.py reads security.ini from the directory it is run in
+    security = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'security.py')], cwd=work_path)
+    start_time = time.monotonic()
+    backlogs = {}
+    try:
+        while security.poll() is None and time.monotonic() - start_time < duration + drain_seconds:
+            time.sleep(1)
+            read_backlogs(stats_path, backlogs)
+    finally:
+        if security.poll() is None:
+            security.send_signal(signal.SIGINT)
+            security.wait()
+        sink.stop()
+    read_backlogs(stats_path, backlogs)
+
+    triggers = read_triggers(edge_log)
+    latencies, unmatched = trigger_latencies(triggers, sink.messages)
+    print(f"\nsecurity.py exitcode={security.returncode}")
+    print(f"PIR triggers={len(triggers)} emails={len(sink.messages)} images={sum(len(message[3]) for message in sink.messages)}")
+    if latencies:
+        print(f"Trigger to email latency seconds min={min(latencies):.2f} median={statistics.median(latencies):.2f} "
+              f"p95={percentile(latencies, 0.95):.2f} max={max(latencies):.2f}")
+    print(f"Triggers with no email={unmatched}")
+    for name, depth in sorted(backlogs.items()):
+        print(f"Largest backlog {name}={depth:g}")
+    return 0 if security.returncode == 0 else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a PIR trace through security.py with the fake camera, GPIO and mail server")
+    parser.add_argument('--trace', help="PIR trace file, if not given a day with --triggers random triggers is made")
+    parser.add_argument('--triggers', type=int, default=100, help="Number of triggers in the made up day")
+    parser.add_argument('--seed', type=int, help="Random seed of the made up day")
+    parser.add_argument('--speed', type=float, default=50, help="How many times faster than real time to replay")
+    parser.add_argument('--config', default='security.ini', help="Settings to replay with, the hardware, mail server and paths are replaced")
+    parser.add_argument('--work', help="Directory for the recordings, images and logs, a new temporary one if not given")
+    parser.add_argument('--drain', type=float, default=30, help="Seconds to wait after the trace for the last emails")
+    args = parser.parse_args()
+
+    work_path = os.path.abspath(args.work) if args.work else tempfile.mkdtemp(prefix='replay-')
+    os.makedirs(work_path, exist_ok=True)
+    trace_path = args.trace
+    if trace_path is None:
+        trace_path = os.path.join(work_path, 'trace.txt')
+        scripted_trace(trace_path, args.triggers, seed=args.seed)
+    try:
+        sys.exit(replay(args.config, work_path, trace_path, args.speed, args.drain))
+    except (OSError, ValueError) as e:
+        sys.exit(f"{e}")
@@ -22,8 +22,8 @@ __version__ = "0.1"
 import multiprocessing
 import signal
 import sys
-import configparser
-import time
+import logging
+import logging.handlers
 
 # As a multiprocess Python script is hard to debug, but you can use pudb.remote
 # You will need to import the pudb.remote module and set a breakpoint in code with
@@ -36,67 +36,149 @@ import record
 import pir
 import mp4_convert
 import emailer
+import render
 import log_listener
 import cleanup
+import shipper
+import migrate
+import metrics_collector
+import settings
+import supervisor
+import unit
+
+CONFIG_PATH = 'security.ini'
 
 def signal_handler(sig, frame):
-    # Wait for all units complete
-    pir_unit.join()
-    record_unit.join()
-    emailer_unit.join()
-    cleanup_unit.join()
-    # Give mp4_unit time to convert last video
-    time.sleep(5)
-    mp4_unit.join()
-    # Send a None message to logger as this has a different method to shutdown
-    log_queue.put_nowait(None)
-    logging_unit.join()
-    print("Exited cleanly\n")
-    sys.exit(0)
+    # The supervisor stops the units once this returns
+    unit_supervisor.stop_requested = True
+
+def reload_handler(sig, frame):
+    # Read the config file again, the supervisor sends the new settings to the running units, nothing is restarted
+    global config
+    try:
+        new_config = settings.load(CONFIG_PATH)
+    except settings.Settings_error as e:
+        queue_logger.error(f"Config not reloaded {e}")
+        return
+    for warning in new_config.warnings:
+        queue_logger.warning(warning)
+    config, restart = config.reloaded(new_config)
+    for section, key in restart:
+        queue_logger.warning(f"[{section}] {key} is only changed by a restart")
+    unit_supervisor.reload_config = config
+    queue_logger.info("Config reloaded")
 
 if __name__ == '__main__':
     # Read the config file
-    config = configparser.ConfigParser()
-    config.read('security.ini')
-
-    # Set SIGINT to be ignored before child units are created
+    try:
+        config = settings.load(CONFIG_PATH)
+    except settings.Settings_error as e:
+        sys.exit(f"{e}")
+    for warning in config.warnings:
+        print(f"{warning}\n")
+
+    # Set SIGINT and SIGHUP to be ignored before child units are created
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-    # Create logging queue
+    # Create logging queue, Record always runs in its own process so this is always a multiprocessing queue
     log_queue = multiprocessing.Queue()
     # Create logging unit
     logging_unit = log_listener.Log_listener(config=config, log_queue=log_queue)
     # Start this early to capture all logs
     logging_unit.start()
+    queue_logger = logging.getLogger(name='Security')
+    queue_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    queue_logger.propagate = False
+    queue_logger.setLevel(config['SECURITY']['log_level'])
 
-    # Create input and output queues to communicate to record unit
-    record_input = multiprocessing.Queue()
-    record_notification_output = multiprocessing.Queue()
-    record_video_output = multiprocessing.Queue()
-
-    # Create the record unit
-    record_unit = record.Record(config=config, log_queue=log_queue, input_queue=record_input, notification_output_queue=record_notification_output, video_output_queue=record_video_output)
-
-    # Create the PIR unit
-    pir_unit = pir.Pir(config=config, log_queue=log_queue, output_queue=record_input)
+    # Create the queue the units send their metrics to if metrics are enabled
+    if config['METRICS']['enabled']:
+        metrics_queue = multiprocessing.Queue()
+    else:
+        metrics_queue = None
 
-    # Create the Mp4_convert unit
-    mp4_unit = mp4_convert.Mp4_convert(config=config, log_queue=log_queue, input_queue=record_video_output)
-
-    # Create emailer unit
-    emailer_unit = emailer.Emailer(config=config, log_queue=log_queue, input_queue=record_notification_output)
-
-    # Create cleanup unit
-    cleanup_unit = cleanup.Cleanup(config=config, log_queue=log_queue)
+    # Create input and output queues to communicate to record unit
+    # The queues Record uses are shared with its process, the others are in process queues with runtime=thread
+    record_input = unit.new_queue(config, shared=True)
+    record_notification_output = unit.new_queue(config, shared=True)
+    # Record writes fragmented MP4 segments straight to the next unit's queue
+    segments_shared = config['RECORD']['container'] == 'mp4'
+    # Create the queue telling the cleanup unit about new video files
+    cleanup_input = unit.new_queue(config, shared=segments_shared)
+    # Finished segments go to the shipper unit if they are uploaded, otherwise to the cleanup unit
+    if config['SHIPPER']['enabled']:
+        shipper_input = unit.new_queue(config, shared=segments_shared)
+        segment_output = shipper_input
+    else:
+        shipper_input = None
+        segment_output = cleanup_input
+    # Segments recorded to the staging path are migrated to video_out_path first
+    if migrate.staging_path(config) is not None:
+        migrate_input = unit.new_queue(config, shared=segments_shared)
+        migrate_output = segment_output
+        segment_output = migrate_input
+    else:
+        migrate_input = None
+    # Fragmented MP4 recordings need no conversion so they go straight on
+    if config['RECORD']['container'] == 'mp4':
+        record_video_output = segment_output
+        convert = False
+    else:
+        record_video_output = unit.new_queue(config, shared=True)
+        convert = True
+    # Notification images are resized before emailing if the render unit is enabled
+    if config['RENDER']['enabled']:
+        render_output = unit.new_queue(config)
+    else:
+        render_output = record_notification_output
+
+    # The supervisor creates the units, and creates them again with the same queues if they fail
+    # The queues stay the same so nothing waiting for a failed unit is lost
+    # Units are stopped in stage order so each one is stopped after the units that feed it
+    unit_supervisor = supervisor.Supervisor(config, queue_logger)
+
+    unit_supervisor.add('Pir', lambda config: pir.Pir(config=config, log_queue=log_queue, output_queue=record_input, metrics_queue=metrics_queue), 0)
+    unit_supervisor.add('Record', lambda config: record.Record(config=config, log_queue=log_queue, input_queue=record_input, notification_output_queue=record_notification_output, video_output_queue=record_video_output, metrics_queue=metrics_queue), 0)
+    # Create the Mp4_convert unit if there is anything to convert
+    if convert:
+        unit_supervisor.add('Mp4_convert', lambda config: mp4_convert.Mp4_convert(config=config, log_queue=log_queue, input_queue=record_video_output, output_queue=segment_output, metrics_queue=metrics_queue), 1)
+    # Create the render unit if notification images are to be resized before emailing
+    if render_output is not record_notification_output:
+        unit_supervisor.add('Render', lambda config: render.Render(config=config, log_queue=log_queue, input_queue=record_notification_output, output_queue=render_output, metrics_queue=metrics_queue), 1)
+    # Create the migrate unit if segments are recorded to a staging path
+    if migrate_input is not None:
+        unit_supervisor.add('Migrate', lambda config: migrate.Migrate(config=config, log_queue=log_queue, input_queue=migrate_input, output_queue=migrate_output, metrics_queue=metrics_queue), 2)
+    unit_supervisor.add('Emailer', lambda config: emailer.Emailer(config=config, log_queue=log_queue, input_queue=render_output, metrics_queue=metrics_queue), 2)
+    # Create the shipper unit if segments are uploaded to an ingest server
+    if shipper_input is not None:
+        unit_supervisor.add('Shipper', lambda config: shipper.Shipper(config=config, log_queue=log_queue, input_queue=shipper_input, output_queue=cleanup_input, metrics_queue=metrics_queue), 3)
+    unit_supervisor.add('Cleanup', lambda config: cleanup.Cleanup(config=config, log_queue=log_queue, input_queue=cleanup_input, metrics_queue=metrics_queue), 4)
+
+    # Create the metrics collector, it reports the depth of the queues between the units
+    if metrics_queue is not None:
+        queues = {'record_input': record_input, 'notification': record_notification_output, 'cleanup_input': cleanup_input}
+        if convert:
+            queues['record_video_output'] = record_video_output
+        if render_output is not record_notification_output:
+            queues['render_output'] = render_output
+        if shipper_input is not None:
+            queues['shipper_input'] = shipper_input
+        if migrate_input is not None:
+            queues['migrate_input'] = migrate_input
+        unit_supervisor.add('Metrics_collector', lambda config: metrics_collector.Metrics_collector(config=config, log_queue=log_queue, metrics_queue=metrics_queue, queues=queues), 5)
 
     # Start all units
-    record_unit.start()
-    pir_unit.start()
-    mp4_unit.start()
-    emailer_unit.start()
-    cleanup_unit.start()
+    unit_supervisor.start()
 
-    # Add signal handler back to Handle CTRL C
+    # Add signal handler back to Handle CTRL C, SIGHUP reloads the config
     signal.signal(signal.SIGINT, signal_handler)
-    print("Press Ctrl+C to cleanly exit (this could take up to a minute to happen)\n")
-    signal.pause()
+    signal.signal(signal.SIGHUP, reload_handler)
+    print("Press Ctrl+C to cleanly exit\n")
+    # Watch the units until asked to exit, then stop them
+    unit_supervisor.run()
+
+    # Send a None message to logger as this has a different method to shutdown
+    log_queue.put_nowait(None)
+    logging_unit.join()
+    print("Exited cleanly\n")
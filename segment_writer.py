@@ -0,0 +1,235 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import queue
+import threading
+import time
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Blocks are a multiple of the page size so every full block write covers whole pages and SD erase blocks
+ALIGNMENT = 4096
+# When the file is synced to storage
+FSYNC_POLICIES = ('gop', 'mb', 'segment')
+
+
+class Buffer_pool:
+    """ A class holding preallocated blocks for the Segment_writers so no memory is allocated while recording
+
+        The pool is shared by the segments of a recording, the last segment can still be writing out its
+        blocks after the split while the next one fills new ones
+    """
+    def __init__(self, blocks, block_size):
+        """
+        Initialise the buffer pool class
+
+        Keyword arguments:
+        blocks -- The number of blocks, when all are waiting to be written the encoder waits for one
+
+        block_size -- The size of each block in bytes, rounded up to a multiple of ALIGNMENT
+        """
+        self.block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+        self.free = queue.Queue()
+        for i in range(blocks):
+            self.free.put(bytearray(self.block_size))
+
+    def get(self):
+        return self.free.get()
+
+    def put(self, block):
+        self.free.put(block)
+
+
+def open_segment(path, pool, config):
+    """ Return a Segment_writer for path with the STORAGE fsync and preallocation settings """
+    return Segment_writer(path, pool, fsync=config['STORAGE']['fsync'], fsync_mb=config['STORAGE']['fsync_mb'],
+                          preallocate_mb=config['STORAGE']['preallocate_mb'])
+
+
+class Segment_writer:
+    """ A file like object that writes a segment in large aligned blocks from a thread of its own
+
+        The encoder's small writes are copied into a block from the Buffer_pool, each full block is
+        written with one pwrite at its block aligned offset by the writer thread, so a slow SD card or NFS
+        server holds up the writer thread and not the encoder unless every block is waiting to be written
+
+        The file is synced every GOP (sync is called at each key frame), every fsync_mb or only when it is
+        closed, a sync also writes the part filled block so everything before it is on storage, each write of
+        a block starts from the page the last one got to so only that page is written twice
+        Space for the segment is preallocated so the file system can keep it in one piece, the file is
+        cut to its real length when it is closed
+
+        stats returns the write syscalls, fsyncs, throughput and the worst write, fsync and encoder stall
+    """
+    def __init__(self, path, pool, *, fsync='segment', fsync_mb=16, preallocate_mb=0):
+        """
+        Initialise the segment writer class
+
+        Keyword arguments:
+        path -- The full path of the segment file to write
+
+        pool -- The Buffer_pool to take blocks from
+
+        fsync -- gop, mb or segment, see FSYNC_POLICIES
+
+        fsync_mb -- The MB written between syncs with fsync=mb
+
+        preallocate_mb -- The space to preallocate, 0 for none
+        """
+        self.path = path
+        self.pool = pool
+        self.fsync = fsync
+        self.fsync_bytes = fsync_mb*1024*1024
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.preallocated = False
+        if preallocate_mb and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, preallocate_mb*1024*1024)
+                self.preallocated = True
+            except OSError:
+                # Not supported by the file system, the file just grows as it is written
+                pass
+        # The block being filled, its offset in the file, how much of it is filled and how much of that was
+        # already passed to the writer thread by a sync or flush
+        self.block = None
+        self.block_offset = 0
+        self.filled = 0
+        self.handed = 0
+        self.closed = False
+        # Set by the writer thread if a write fails, raised by the next write or close
+        self.error = None
+        # bytes_written counts a part block written again each time so it is what the storage sees
+        self.counters = {'bytes_written': 0, 'writes': 0, 'fsyncs': 0, 'write_seconds': 0.0, 'worst_write': 0.0, 'worst_fsync': 0.0, 'worst_stall': 0.0}
+        # Work for the writer thread as (offset, data, block to give back to the pool or None, sync after it)
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self.run, name='Segment_writer', daemon=True)
+        self.writer.start()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        view = memoryview(data)
+        while view:
+            if self.block is None:
+                start = time.monotonic()
+                self.block = self.pool.get()
+                self.counters['worst_stall'] = max(self.counters['worst_stall'], time.monotonic() - start)
+            size = min(len(view), self.pool.block_size - self.filled)
+            self.block[self.filled:self.filled + size] = view[:size]
+            self.filled += size
+            view = view[size:]
+            if self.filled == self.pool.block_size:
+                # The rest of the block from the page a sync or flush got to
+                start = self.handed - self.handed % ALIGNMENT
+                self.pending.put((self.block_offset + start, memoryview(self.block)[start:], self.block, False))
+                self.block = None
+                self.block_offset += self.pool.block_size
+                self.filled = 0
+                self.handed = 0
+        return len(data)
+
+    def sync(self):
+        """ Called at each key frame, with fsync=gop everything written so far is synced to storage """
+        if self.fsync == 'gop':
+            self.write_partial(sync=True)
+
+    def flush(self):
+        """ Pass everything written so far to the writer thread """
+        self.write_partial(sync=False)
+
+    def write_partial(self, sync):
+        # Only what was added since the last time, from the page it starts in so the write stays aligned
+        start = self.handed - self.handed % ALIGNMENT
+        if self.filled == self.handed and not sync:
+            return
+        # A copy as the encoder carries on filling the block while it is written
+        data = bytes(self.block[start:self.filled]) if self.block is not None else b''
+        self.pending.put((self.block_offset + start, data, None, sync))
+        self.handed = self.filled
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.write_partial(sync=True)
+        if self.block is not None:
+            self.pool.put(self.block)
+            self.block = None
+        self.pending.put(None)
+        self.writer.join()
+        try:
+            if self.error is None and self.preallocated:
+                # Drop the preallocated space past the end of the segment
+                os.ftruncate(self.fd, self.block_offset + self.filled)
+        finally:
+            os.close(self.fd)
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        unsynced = 0
+        while True:
+            work = self.pending.get()
+            if work is None:
+                break
+            offset, data, block, sync = work
+            try:
+                if self.error is None:
+                    if data:
+                        self.pwrite(offset, data)
+                        unsynced += len(data)
+                    if sync or (self.fsync == 'mb' and unsynced >= self.fsync_bytes):
+                        start = time.monotonic()
+                        os.fsync(self.fd)
+                        seconds = time.monotonic() - start
+                        self.counters['fsyncs'] += 1
+                        self.counters['worst_fsync'] = max(self.counters['worst_fsync'], seconds)
+                        unsynced = 0
+            except OSError as e:
+                self.error = e
+            finally:
+                if block is not None:
+                    self.pool.put(block)
+
+    def pwrite(self, offset, data):
+        """ Write all of data at offset, timing each syscall """
+        view = memoryview(data)
+        while view:
+            start = time.monotonic()
+            written = os.pwrite(self.fd, view, offset)
+            seconds = time.monotonic() - start
+            self.counters['writes'] += 1
+            self.counters['write_seconds'] += seconds
+            self.counters['worst_write'] = max(self.counters['worst_write'], seconds)
+            self.counters['bytes_written'] += written
+            view = view[written:]
+            offset += written
+
+    def stats(self):
+        """ Return a dictionary of the write stats, throughput is MB written per second spent in write syscalls """
+        counters = self.counters
+        return {'bytes': self.block_offset + self.filled, 'bytes_written': counters['bytes_written'], 'writes': counters['writes'], 'fsyncs': counters['fsyncs'],
+                'throughput_mbps': counters['bytes_written'] / 1024 / 1024 / counters['write_seconds'] if counters['write_seconds'] else 0,
+                'worst_write_ms': counters['worst_write'] * 1000, 'worst_fsync_ms': counters['worst_fsync'] * 1000,
+                'worst_stall_ms': counters['worst_stall'] * 1000}
@@ -0,0 +1,365 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import configparser
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG')
+
+
+class Settings_error(ValueError):
+    """ Raised when the config file cannot be read or has values that are not valid, the message lists every problem """
+
+
+def boolean(value):
+    """ Parse True/False (or yes/no, on/off, 1/0), unlike bool() 'False' is False """
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("is not True or False")
+
+
+def resolution(value):
+    """ Parse a WIDTHxHEIGHT resolution to a (width, height) tuple """
+    try:
+        width, height = (int(x) for x in value.lower().split('x'))
+    except ValueError:
+        raise ValueError("is not a WIDTHxHEIGHT resolution")
+    if width <= 0 or height <= 0:
+        raise ValueError("is not a WIDTHxHEIGHT resolution")
+    return (width, height)
+
+
+class Option:
+    """ The type, default and limits of one config value """
+    def __init__(self, parse, default, *, restart=False, minimum=None, maximum=None, choices=None):
+        """
+        Keyword arguments:
+        parse -- A function turning the config string into the value, raising ValueError if it is not valid
+
+        default -- The config string used if the value is not in the config file, None for an optional value
+        that is None when missing or blank
+
+        restart -- True if a change only takes effect when security.py is restarted
+
+        minimum -- The smallest value allowed or None
+
+        maximum -- The largest value allowed or None
+
+        choices -- The values allowed or None
+        """
+        self.parse = parse
+        self.default = default
+        self.restart = restart
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+
+    def value(self, text):
+        """ Return the value of a config string, raising ValueError if it is not valid """
+        if text is None or (self.default is None and text.strip() == ''):
+            return None
+        try:
+            value = self.parse(text.strip())
+        except ValueError:
+            if self.parse in (int, float):
+                raise ValueError(f"is not {'an integer' if self.parse is int else 'a number'}")
+            raise
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(f"is not one of {', '.join(self.choices)}")
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"is less than {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"is more than {self.maximum}")
+        return value
+
+
+def log_level():
+    """ Return the Option of a unit's log_level """
+    return Option(str, 'WARNING', choices=LOG_LEVELS)
+
+
+# Every value security.ini can hold, keys are lower case as ConfigParser reads them
+SCHEMA = {
+    'LOGGING': {
+        'log_filename': Option(str, '/tmp/security.log', restart=True),
+        'backup_count': Option(int, '7', restart=True, minimum=0),
+    },
+    'SECURITY': {
+        'runtime': Option(str, 'process', restart=True, choices=('process', 'thread')),
+        'heartbeat_timeout': Option(float, '120', minimum=10),
+        'restart_seconds': Option(float, '5', minimum=0),
+        'max_restart_seconds': Option(float, '300', minimum=0),
+        'stable_seconds': Option(float, '600', minimum=0),
+        'shutdown_seconds': Option(float, '4', minimum=1),
+        'log_level': log_level(),
+    },
+    'EMAILER': {
+        'server': Option(str, ''),
+        'port': Option(int, '587', minimum=1, maximum=65535),
+        'from': Option(str, ''),
+        'to': Option(str, ''),
+        'user': Option(str, ''),
+        'password': Option(str, ''),
+        'starttls': Option(boolean, 'True'),
+        'timeout': Option(float, '30', minimum=1),
+        'keepalive_seconds': Option(float, '60', minimum=1),
+        'idle_timeout': Option(float, '300', minimum=0),
+        'coalesce_seconds': Option(float, '5', minimum=0),
+        'max_attachments': Option(int, '10', minimum=1),
+        'outbox_path': Option(str, None, restart=True),
+        'max_in_flight': Option(int, '2', restart=True, minimum=1),
+        'backoff_seconds': Option(float, '10', minimum=0),
+        'max_backoff_seconds': Option(float, '600', minimum=0),
+        'max_age_hours': Option(float, '24', minimum=0),
+        'log_level': log_level(),
+    },
+    'RECORD': {
+        'framerate': Option(int, '25', restart=True, minimum=1, maximum=90),
+        'hflip': Option(boolean, 'False'),
+        'vflip': Option(boolean, 'False'),
+        'video_quality': Option(int, '25', minimum=1, maximum=40),
+        'image_quality': Option(int, '65', minimum=1, maximum=100),
+        'container': Option(str, 'h264', restart=True, choices=('h264', 'mp4')),
+        'rollover_mode': Option(str, 'split', choices=('split', 'restart')),
+        'intra_period': Option(int, '25', minimum=1),
+        'pre_event_seconds': Option(int, '10', minimum=0),
+        'post_event_seconds': Option(int, '10', minimum=0),
+        'event_buffer_mb': Option(int, '24', restart=True, minimum=1),
+        'still_ring_frames': Option(int, '25', restart=True, minimum=0),
+        'still_resolution': Option(resolution, '1024x768', restart=True),
+        'still_before_seconds': Option(float, '0.5', minimum=0),
+        'still_after_seconds': Option(float, '0', minimum=0),
+        'notification_frames': Option(int, '1', minimum=1),
+        'video_out_path': Option(str, '/tmp/video', restart=True),
+        'notification_out_path': Option(str, '/tmp/notify', restart=True),
+        'log_level': log_level(),
+    },
+    'RENDER': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'target_kb': Option(int, '150', minimum=1),
+        'min_quality': Option(int, '30', minimum=1, maximum=95),
+        'max_quality': Option(int, '90', minimum=1, maximum=95),
+        'max_width': Option(int, '1640', minimum=16),
+        'contact_sheet': Option(boolean, 'True'),
+        'workers': Option(int, '1', restart=True, minimum=1),
+        'log_level': log_level(),
+    },
+    'METRICS': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'bind': Option(str, '127.0.0.1', restart=True),
+        'port': Option(int, '9464', restart=True, minimum=0, maximum=65535),
+        'stats_file': Option(str, None),
+        'stats_seconds': Option(float, '60', minimum=1),
+        'flush_seconds': Option(float, '5', minimum=0),
+        'log_level': log_level(),
+    },
+    'STORAGE': {
+        'staging_path': Option(str, None, restart=True),
+        'state_path': Option(str, None, restart=True),
+        'staging_max_mb': Option(int, '512', minimum=1),
+        'spill': Option(str, 'drop_oldest', choices=('drop_oldest', 'none')),
+        'copy_chunk_mb': Option(int, '8', minimum=1),
+        'verify': Option(boolean, 'True'),
+        'retry_seconds': Option(float, '5', minimum=0),
+        'max_retry_seconds': Option(float, '300', minimum=0),
+        'write_block_kb': Option(int, '1024', restart=True, minimum=4),
+        'write_buffers': Option(int, '8', restart=True, minimum=2),
+        'fsync': Option(str, 'segment', choices=('gop', 'mb', 'segment')),
+        'fsync_mb': Option(int, '16', minimum=1),
+        'preallocate_mb': Option(int, '32', minimum=0),
+        'log_level': log_level(),
+    },
+    'SHIPPER': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'url': Option(str, 'http://127.0.0.1:8080', restart=True),
+        'camera': Option(str, None, restart=True),
+        'token': Option(str, ''),
+        'chunk_kb': Option(int, '1024', minimum=1),
+        'max_kbps': Option(int, '0', minimum=0),
+        'connections': Option(int, '2', restart=True, minimum=1),
+        'timeout': Option(float, '30', restart=True, minimum=1),
+        'retry_seconds': Option(float, '10', minimum=0),
+        'max_retry_seconds': Option(float, '600', minimum=0),
+        'delete_after_upload': Option(boolean, 'True'),
+        'journal_path': Option(str, None, restart=True),
+        'log_level': log_level(),
+    },
+    'TIMELINE': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'path': Option(str, None, restart=True),
+    },
+    'LIVE_VIEW': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'bind': Option(str, '0.0.0.0', restart=True),
+        'port': Option(int, '8000', restart=True, minimum=1, maximum=65535),
+        'max_clients': Option(int, '4', restart=True, minimum=1),
+        'max_fps': Option(float, '0', restart=True, minimum=0),
+    },
+    'MOTION': {
+        'enabled': Option(boolean, 'False', restart=True),
+        'fusion': Option(str, 'either', choices=('pir', 'motion', 'either', 'both')),
+        'fusion_window_seconds': Option(float, '5', minimum=0),
+        'threshold': Option(float, '10', minimum=0),
+        'regions': Option(str, ''),
+        'min_neighbours': Option(int, '2', minimum=0, maximum=8),
+        'min_area': Option(int, '10', minimum=1),
+        'min_frames': Option(int, '3', minimum=1),
+        'frame_budget_ms': Option(float, '10', minimum=0),
+        'min_trigger_seconds': Option(float, '10', minimum=0),
+    },
+    'PIR': {
+        'pin': Option(int, '7', restart=True, minimum=1, maximum=40),
+        'min_trigger_seconds': Option(int, '60', minimum=0),
+        'disable': Option(str, '/tmp/pir_disable'),
+        'log_level': log_level(),
+    },
+    'MP4_CONVERT': {
+        'converter': Option(str, 'builtin', choices=('builtin', 'mp4box')),
+        'workers': Option(int, None, restart=True, minimum=1),
+        'worker_nice': Option(int, '10', restart=True, minimum=0, maximum=19),
+        'drain_timeout': Option(float, '2', minimum=0),
+        'journal_path': Option(str, None, restart=True),
+        'log_level': log_level(),
+    },
+    'CLEANUP': {
+        'days_to_keep': Option(int, '30', minimum=1),
+        'full_scan_hours': Option(float, '24', minimum=0),
+        'free_space_low_mb': Option(int, '0', minimum=0),
+        'free_space_high_mb': Option(int, '0', minimum=0),
+        'video_max_mb': Option(int, '0', minimum=0),
+        'notification_max_mb': Option(int, '0', minimum=0),
+        'log_level': log_level(),
+    },
+    'SIMULATION': {
+        'camera': Option(str, 'picamera', restart=True, choices=('picamera', 'fake')),
+        'resolution': Option(resolution, None, restart=True),
+        'gpio': Option(str, 'rpi', restart=True, choices=('rpi', 'fake')),
+        'pir_trace': Option(str, None, restart=True),
+        'speed': Option(float, '1', restart=True, minimum=0.001),
+        'edge_log': Option(str, None, restart=True),
+    },
+}
+
+
+class Settings:
+    """ The typed and validated values of the config file
+
+        Values are parsed once when the file is loaded and read as settings['SECTION']['key'], every value
+        in SCHEMA is there with its default if it is not in the file
+        A Settings is picklable so a reloaded copy can be sent to the units on their input queues
+    """
+    def __init__(self, sections, path=None, warnings=()):
+        """
+        Keyword arguments:
+        sections -- A dict of section name to a dict of key to value
+
+        path -- The config file the values were read from or None
+
+        warnings -- Messages about the file that did not stop it loading, such as unknown keys
+        """
+        self.sections = sections
+        self.path = path
+        self.warnings = list(warnings)
+
+    def __getitem__(self, section):
+        return self.sections[section]
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self.sections == other.sections
+
+    def changes(self, other):
+        """ Return the (section, key) of every value that differs in other """
+        return [(section, key) for section, options in SCHEMA.items() for key in options if self[section][key] != other[section][key]]
+
+    def reloaded(self, new):
+        """
+        Return the settings to run with after a reload and the (section, key) of the changes that need a restart
+
+        Values that only take effect at startup keep their current value so every unit agrees on them
+
+        Keyword arguments:
+        new -- The Settings loaded from the changed file
+        """
+        sections = {section: dict(values) for section, values in new.sections.items()}
+        restart = []
+        for section, key in self.changes(new):
+            if SCHEMA[section][key].restart:
+                sections[section][key] = self[section][key]
+                restart.append((section, key))
+        return Settings(sections, new.path, new.warnings), restart
+
+
+def parse(parser, path=None):
+    """
+    Return the Settings of a ConfigParser, raising Settings_error listing every value that is not valid
+
+    Keyword arguments:
+    parser -- The ConfigParser holding the config file
+
+    path -- The config file it was read from or None
+    """
+    sections = {}
+    errors = []
+    warnings = []
+    for section, options in SCHEMA.items():
+        values = parser[section] if parser.has_section(section) else {}
+        sections[section] = {}
+        for key, option in options.items():
+            text = values.get(key, option.default)
+            try:
+                sections[section][key] = option.value(text)
+            except ValueError as e:
+                errors.append(f"[{section}] {key}={text} {e}")
+        for key in values:
+            if key not in options:
+                warnings.append(f"[{section}] {key} is not a known setting")
+    for section in parser.sections():
+        if section not in SCHEMA:
+            warnings.append(f"[{section}] is not a known section")
+
+    if not errors:
+        if sections['RENDER']['min_quality'] > sections['RENDER']['max_quality']:
+            errors.append("[RENDER] min_quality is more than max_quality")
+        if sections['EMAILER']['backoff_seconds'] > sections['EMAILER']['max_backoff_seconds']:
+            errors.append("[EMAILER] backoff_seconds is more than max_backoff_seconds")
+    if errors:
+        raise Settings_error(f"{path or 'config'} has {len(errors)} invalid values: " + '; '.join(errors))
+    return Settings(sections, path, warnings)
+
+
+def load(path):
+    """ Return the Settings of a config file, raising Settings_error if it cannot be read or is not valid """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        if not parser.read(path):
+            raise Settings_error(f"Cannot read {path}")
+    except configparser.Error as e:
+        raise Settings_error(f"Cannot parse {path} {e}")
+    return parse(parser, path)
+
+
+def defaults():
+    """ Return the Settings with every value at its default """
+    return parse(configparser.ConfigParser(interpolation=None))
@@ -0,0 +1,323 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import queue
+import socket
+import threading
+import collections
+import urllib.parse
+import http.client
+import concurrent.futures
+
+import unit
+import mp4_mux
+import mp4_convert
+import timeline
+import ingest_server
+import migrate
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+class Token_bucket:
+    """ A class to limit the bytes per second sent by all the upload threads together """
+    def __init__(self, rate, burst):
+        """
+        Initialise the token bucket class
+
+        Keyword arguments:
+        rate -- Bytes per second, 0 is no limit
+
+        burst -- The most bytes that can be sent at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst):
+        """ Change the limit, used when the config is reloaded """
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def take(self, size):
+        """ Wait until size bytes can be sent """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going into debt makes the next sender wait too, so the rate holds across threads
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Http_pool:
+    """ A class to keep HTTP connections to the ingest server open between uploads """
+    def __init__(self, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.connections = queue.Queue()
+
+    def get(self):
+        try:
+            return self.connections.get(block=False)
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class Upload_error(Exception):
+    pass
+
+
+class Shipper(unit.Unit):
+    """ A class to upload finished segments to an ingest server, see ingest_server.py
+
+        Files are sent in chunks over pooled keep alive connections, an interrupted upload carries on from
+        the offset the server has, the server checks the SHA-256 of the whole file before keeping it
+        and only then is the local copy deleted
+        Queued files are kept in a journal so nothing is missed across a restart, failed uploads are
+        retried with an increasing delay
+        All the upload threads together are kept under max_kbps
+    """
+    def __init__(self, *, config, log_queue, input_queue, output_queue=None, metrics_queue=None):
+        """
+        Initialise the shipper class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        log_queue -- A queue object to send log messages to
+
+        input_queue -- A queue object containing the full path of each finished segment or event clip
+
+        output_queue -- A queue object to send the full path of files kept locally after upload to or None
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
+        """
+        super(Shipper, self).__init__(config=config, log_queue=log_queue, unit_name='Shipper', config_section='SHIPPER', input_queue=input_queue, metrics_queue=metrics_queue)
+        self.output_queue = output_queue
+
+    def run(self):
+        self.queue_logger.info("Shipper started")
+        print("Shipper started\n")
+
+        self.url = self.config['SHIPPER']['url'].rstrip('/')
+        self.camera = self.config['SHIPPER']['camera'] or socket.gethostname()
+        self.chunk_size = self.config['SHIPPER']['chunk_kb']*1024
+        self.bucket = Token_bucket(self.config['SHIPPER']['max_kbps']*1024, self.chunk_size)
+        connections = self.config['SHIPPER']['connections']
+        self.pool = Http_pool(self.url, self.config['SHIPPER']['timeout'])
+        self.timeline = timeline.open_timeline(self.config, self.queue_logger)
+        os.makedirs(migrate.state_path(self.config), exist_ok=True)
+        journal = mp4_convert.Convert_journal(self.config['SHIPPER']['journal_path'] or os.path.join(migrate.state_path(self.config), '.shipper_journal'))
+
+        # Files waiting to be uploaded, oldest first, with the time they can next be tried
+        # Uploads are never marked failed in the journal, they are retried until they get through
+        paths, failed = journal.load()
+        pending = collections.deque((path, 0) for path in paths if os.path.isfile(path))
+        journal.rewrite(path for path, next_attempt in pending)
+        if pending:
+            self.queue_logger.info(f"Uploading backlog of {len(pending)} files")
+        in_flight = set()
+        attempts = {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+        while not self.stoprequest.is_set():
+            # Start the uploads that are due, in order
+            timeout = None
+            while pending and len(in_flight) < connections:
+                path, next_attempt = pending[0]
+                if next_attempt > time.monotonic():
+                    timeout = next_attempt - time.monotonic()
+                    break
+                pending.popleft()
+                in_flight.add(path)
+                future = executor.submit(self.ship, path)
+                # The result is passed back through the input queue so it wakes up the loop
+                future.add_done_callback(lambda future, path=path: self.input_queue.put(('shipped', path) + future.result()))
+            self.metrics.set('ship_backlog', len(pending) + len(in_flight))
+
+            input_queue_message = self.get_message(timeout=timeout)
+            if isinstance(input_queue_message, tuple):
+                path, seconds, size, error = input_queue_message[1:]
+                in_flight.discard(path)
+                if error is None:
+                    self.queue_logger.info(f"Uploaded {path} {size} bytes in {seconds:.2f}s")
+                    self.metrics.inc('files_shipped')
+                    self.metrics.inc('bytes_shipped', size)
+                    self.metrics.observe('ship_seconds', seconds)
+                    attempts.pop(path, None)
+                    journal.done(path)
+                    if self.config['SHIPPER']['delete_after_upload']:
+                        self.delete(path)
+                    elif self.output_queue is not None:
+                        self.output_queue.put(path)
+                else:
+                    attempts[path] = attempts.get(path, 0) + 1
+                    delay = min(self.config['SHIPPER']['max_retry_seconds'], self.config['SHIPPER']['retry_seconds'] * 2 ** (attempts[path] - 1))
+                    self.queue_logger.error(f"Cannot upload {path} error:{error}, retrying in {delay:.0f}s")
+                    self.metrics.inc('ship_failures')
+                    # Keep the order so the oldest footage is sent first
+                    pending.appendleft((path, time.monotonic() + delay))
+            elif input_queue_message is not None:
+                journal.add(input_queue_message)
+                pending.append((input_queue_message, 0))
+
+        # Journal anything that arrived after exit was asked for so it is uploaded at the next start
+        while True:
+            try:
+                input_queue_message = self.input_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if isinstance(input_queue_message, str):
+                journal.add(input_queue_message)
+        # Uploads in progress carry on from their offset at the next start
+        executor.shutdown(wait=True)
+        self.pool.close()
+        if self.timeline is not None:
+            self.timeline.close()
+
+    def reload(self, config):
+        super(Shipper, self).reload(config)
+        # Uploads in progress use the new cap and chunk size from their next chunk
+        self.chunk_size = self.config['SHIPPER']['chunk_kb']*1024
+        self.bucket.set_rate(self.config['SHIPPER']['max_kbps']*1024, self.chunk_size)
+
+    def remote_path(self, path):
+        """ Return the upload URL path of a local file, the path under the camera follows the local layout """
+        for name, top in (('video', self.config['RECORD']['video_out_path']), ('notify', self.config['RECORD']['notification_out_path'])):
+            if path.startswith(os.path.join(top, '')):
+                relative = os.path.relpath(path, top).replace(os.sep, '/')
+                return f"/upload/{self.camera}/{name}/{relative}"
+        return f"/upload/{self.camera}/other/{os.path.basename(path)}"
+
+    def ship(self, path):
+        """
+        Upload a file and its key frame index if it has one, run in a worker thread
+        Returns (seconds, bytes, None) or (None, None, error message)
+
+        Keyword arguments:
+        path -- The full path of the file to upload
+        """
+        start_time = time.monotonic()
+        size = 0
+        try:
+            for file_path in (path, mp4_mux.index_path(path)):
+                if file_path != path and not os.path.isfile(file_path):
+                    continue
+                size += self.upload(file_path)
+        except (OSError, http.client.HTTPException, Upload_error, ValueError) as e:
+            return (None, None, f"{e}")
+        return (time.monotonic() - start_time, size, None)
+
+    def upload(self, path):
+        """ Upload one file, carrying on from what the server already has, returns the bytes sent """
+        url_path = self.remote_path(path)
+        size = os.path.getsize(path)
+        sha256 = ingest_server.file_sha256(path)
+        sent = 0
+        connection = self.pool.get()
+        try:
+            status, headers = self.request(connection, 'HEAD', url_path)
+            if status == 200 and headers.get('Upload-Complete'):
+                if headers.get('Upload-Sha256') != sha256:
+                    raise Upload_error(f"A different {url_path} is already on the server")
+                return 0
+            offset = int(headers.get('Upload-Offset', '0')) if status == 200 else 0
+            if status not in (200, 404):
+                raise Upload_error(f"HEAD {url_path} status {status}")
+
+            resent = False
+            with open(path, 'rb') as fp:
+                while True:
+                    while offset < size:
+                        fp.seek(offset)
+                        data = fp.read(self.chunk_size)
+                        self.bucket.take(len(data))
+                        status, headers = self.request(connection, 'PUT', url_path, data, {'Upload-Offset': str(offset)})
+                        if status not in (204, 409):
+                            raise Upload_error(f"PUT {url_path} status {status}")
+                        if status == 204:
+                            sent += len(data)
+                        # A 409 gives the offset the server has, carry on from there
+                        offset = int(headers['Upload-Offset'])
+
+                    status, headers = self.request(connection, 'POST', url_path, None, {'Upload-Length': str(size), 'Upload-Sha256': sha256})
+                    if status == 201:
+                        return sent
+                    if status != 422:
+                        raise Upload_error(f"POST {url_path} status {status}")
+                    # The server did not get the same file, it has thrown it away so send it all again once
+                    if resent:
+                        raise Upload_error(f"{url_path} failed verification")
+                    self.queue_logger.warning(f"{url_path} failed verification, sending it again")
+                    resent = True
+                    offset = 0
+        except Exception:
+            # The connection may be part way through a request so do not reuse it
+            connection.close()
+            raise
+        finally:
+            self.pool.put(connection)
+
+    def request(self, connection, method, url_path, body=None, headers=None):
+        """ Send a request and return (status, response headers) """
+        headers = dict(headers or {})
+        if self.config['SHIPPER']['token']:
+            headers['Authorization'] = f"Bearer {self.config['SHIPPER']['token']}"
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        connection.request(method, url_path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status, response.headers
+
+    def delete(self, path):
+        """ Delete a file and its key frame index once they are on the server """
+        for file_path in (path, mp4_mux.index_path(path)):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self.queue_logger.warning(f"Cannot Delete={file_path}")
+        if self.timeline is not None:
+            self.timeline.remove(path)
@@ -0,0 +1,151 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import socketserver
+import threading
+import email
+import email.policy
+import time
+import os
+import sys
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Largest message accepted, a day of notification stills is far smaller
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+
+class Smtp_handler(socketserver.StreamRequestHandler):
+    """ Talk enough SMTP to one client for smtplib to send messages, there is no TLS or login """
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 smtp_sink ready')
+        mail_from = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply(f'250-smtp_sink\r\n250-SIZE {MAX_MESSAGE_BYTES}\r\n250 8BITMIME')
+            elif verb == 'HELO':
+                self.reply('250 smtp_sink')
+            elif verb == 'MAIL':
+                # Drop parameters such as SIZE= after the address
+                mail_from = command[10:].strip().split(' ')[0]
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    # Remove the dot stuffing
+                    lines.append(line[1:] if line.startswith(b'.') else line)
+                self.server.sink.received(mail_from, recipients, b''.join(lines))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                if verb == 'RSET':
+                    mail_from = None
+                    recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class Smtp_server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Smtp_sink:
+    """ A local SMTP server that keeps the messages it receives instead of sending them on
+
+        It stands in for the mail server so the Emailer can be run and timed on a development machine
+        Each message is kept as (receive time, mail from, recipients, attachment file names)
+        and written to a directory as a .eml file if one is given
+    """
+    def __init__(self, bind='127.0.0.1', port=0, save_path=None):
+        """
+        Initialise the SMTP sink class
+
+        Keyword arguments:
+        bind -- The address to listen on
+
+        port -- The port to listen on, 0 picks a free one
+
+        save_path -- A directory to write each message to or None
+        """
+        self.server = Smtp_server((bind, port), Smtp_handler)
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+        self.save_path = save_path
+        if save_path is not None:
+            os.makedirs(save_path, exist_ok=True)
+        self.messages = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def received(self, mail_from, recipients, data):
+        receive_time = time.time()
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        attachments = [part.get_filename() for part in message.iter_attachments()]
+        with self.lock:
+            self.messages.append((receive_time, mail_from, recipients, attachments))
+        if self.save_path is not None:
+            with open(os.path.join(self.save_path, f"{time.time_ns()}.eml"), 'wb') as fp:
+                fp.write(data)
+
+
+if __name__ == '__main__':
+    # Usage: python3 smtp_sink.py [port] [directory to save messages to]
+    sink = Smtp_sink(port=int(sys.argv[1]) if len(sys.argv) > 1 else 2525, save_path=sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"Listening on 127.0.0.1:{sink.port}")
+    try:
+        sink.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server.server_close()
+    for receive_time, mail_from, recipients, attachments in sink.messages:
+        print(f"{time.strftime('%H:%M:%S', time.localtime(receive_time))} {mail_from} {', '.join(recipients)} {' '.join(attachments)}")
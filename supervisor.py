@@ -0,0 +1,262 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import signal
+import os
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# Seconds between checks of the units
+CHECK_SECONDS = 0.5
+# Seconds a stale unit is given to exit when asked before it is killed
+STALE_EXIT_SECONDS = 2
+
+
+def process_memory(pid):
+    """ Return the (rss, pss) of a process in bytes, pss is None if the kernel does not report it, None if the process has gone """
+    values = {}
+    for name, key in (('status', 'VmRSS:'), ('smaps_rollup', 'Pss:')):
+        try:
+            with open(f"/proc/{pid}/{name}", 'r') as fp:
+                for line in fp:
+                    if line.startswith(key):
+                        values[key] = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError):
+            pass
+    if 'VmRSS:' not in values:
+        return None
+    return (values['VmRSS:'], values.get('Pss:'))
+
+
+def process_tree(pid):
+    """ Return the process ids of a process and all its descendants """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as fp:
+                # The command name can hold spaces so the fields are counted from the closing bracket
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(parents.get(parent, []))
+    return tree
+
+
+def memory_report(pid=None):
+    """
+    Return (processes, rss, pss) in bytes for a process and its descendants
+
+    pss shares the pages the processes have in common out between them so it is the better total,
+    it is None if the kernel does not report it
+
+    Keyword arguments:
+    pid -- The top process, defaults to this one
+    """
+    processes = 0
+    rss = 0
+    pss = 0
+    for child in process_tree(pid or os.getpid()):
+        memory = process_memory(child)
+        if memory is None:
+            continue
+        processes += 1
+        rss += memory[0]
+        pss = None if pss is None or memory[1] is None else pss + memory[1]
+    return (processes, rss, pss)
+
+
+class Supervised:
+    """ A unit run by the supervisor and how to create it again """
+    def __init__(self, name, factory, stage):
+        """
+        Keyword arguments:
+        name -- The name used in log messages
+
+        factory -- A function taking a settings.Settings object and returning a new unit, it is called again to
+        restart the unit so it must pass the same queues each time
+
+        stage -- Units are stopped in stage order, lowest first, the units in a stage are stopped together
+        """
+        self.name = name
+        self.factory = factory
+        self.stage = stage
+        self.unit = None
+        self.started = None
+        # Restarts since the unit was last stable and when it can next be started
+        self.restarts = 0
+        self.next_start = None
+        # When a stale unit was asked to exit, None if it has not been
+        self.stale_since = None
+
+
+class Supervisor:
+    """ A class to run the units, restart any that fail and stop them all quickly
+
+        A unit has failed if its process exits or its heartbeat is older than heartbeat_timeout
+        Failed units are restarted after restart_seconds, doubling for each restart up to max_restart_seconds
+        until the unit has run for stable_seconds
+        A stale unit is asked to exit and killed if it has not after STALE_EXIT_SECONDS, without holding up the
+        checks of the other units, a thread cannot be killed so it is not restarted until it exits
+        The queues between the units are created once by security.py and passed to each new unit by its factory,
+        so messages waiting for a failed unit are handled by its replacement
+
+        Shutdown asks every unit in a stage to exit at once and waits for them together, then the next stage,
+        so a unit that drains its input is stopped after the units feeding it
+        Anything still running after shutdown_seconds is killed
+    """
+    def __init__(self, config, queue_logger):
+        """
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        queue_logger -- The logger of security.py
+        """
+        self.config = config
+        self.queue_logger = queue_logger
+        self.supervised = []
+        # Set by the signal handlers, acted on by run
+        self.stop_requested = False
+        self.reload_config = None
+        # Time start was called, None once the startup has been reported
+        self.start_time = None
+
+    def add(self, name, factory, stage):
+        """ Add a unit, see Supervised for the arguments """
+        self.supervised.append(Supervised(name, factory, stage))
+
+    def start(self):
+        """ Create and start all the units """
+        self.start_time = time.monotonic()
+        for supervised in self.supervised:
+            self.start_unit(supervised)
+
+    def start_unit(self, supervised):
+        supervised.unit = supervised.factory(self.config)
+        # The unit's process must ignore SIGINT and SIGHUP, only security.py handles them
+        handlers = {sig: signal.signal(sig, signal.SIG_IGN) for sig in (signal.SIGINT, signal.SIGHUP)}
+        try:
+            supervised.unit.start()
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        supervised.started = time.monotonic()
+        supervised.next_start = None
+        supervised.stale_since = None
+
+    def units(self):
+        """ Return the running units """
+        return [supervised.unit for supervised in self.supervised if supervised.next_start is None]
+
+    def reload(self, config):
+        """ Send a reloaded config to the running units, restarted units are created with it """
+        self.config = config
+        for running_unit in self.units():
+            running_unit.input_queue.put(config)
+
+    def run(self):
+        """ Watch the units until stop_requested is set, then stop them """
+        while not self.stop_requested:
+            if self.reload_config is not None:
+                config, self.reload_config = self.reload_config, None
+                self.reload(config)
+            self.check()
+            # The signal handlers run while this sleeps and the sleep carries on afterwards
+            time.sleep(CHECK_SECONDS)
+        self.shutdown()
+
+    def check(self):
+        """ Restart the units that have exited or stopped beating once their backoff is over """
+        now = time.monotonic()
+        # A unit is ready once it has beaten since it started
+        if self.start_time is not None and all(supervised.next_start is None and supervised.unit.heartbeat.value > supervised.started for supervised in self.supervised):
+            self.report_startup(now - self.start_time)
+            self.start_time = None
+        heartbeat_timeout = self.config['SECURITY']['heartbeat_timeout']
+        for supervised in self.supervised:
+            if supervised.next_start is not None:
+                if now < supervised.next_start:
+                    continue
+                if supervised.unit.is_alive():
+                    # A second copy would take the messages from the same input queue
+                    self.queue_logger.error(f"{supervised.name} is still running, not restarting it until it exits")
+                    supervised.next_start = now + self.config['SECURITY']['max_restart_seconds']
+                    continue
+                self.queue_logger.warning(f"Restarting {supervised.name} restart={supervised.restarts}")
+                self.start_unit(supervised)
+                continue
+
+            running_unit = supervised.unit
+            if running_unit.exitcode is not None:
+                reason = f"exited with exitcode={running_unit.exitcode}"
+            elif now - running_unit.heartbeat.value > heartbeat_timeout:
+                if supervised.stale_since is None:
+                    # Ask nicely first, a killed unit could leave a queue it was writing to unusable
+                    supervised.stale_since = now
+                    running_unit.stop()
+                    continue
+                if running_unit.is_alive():
+                    if now - supervised.stale_since < STALE_EXIT_SECONDS:
+                        continue
+                    running_unit.kill()
+                reason = f"has not beaten for {supervised.stale_since - running_unit.heartbeat.value:.0f}s"
+            else:
+                continue
+
+            if now - supervised.started >= self.config['SECURITY']['stable_seconds']:
+                supervised.restarts = 0
+            supervised.restarts += 1
+            delay = min(self.config['SECURITY']['max_restart_seconds'], self.config['SECURITY']['restart_seconds'] * 2 ** (supervised.restarts - 1))
+            self.queue_logger.error(f"{supervised.name} {reason}, restarting in {delay:.1f}s")
+            supervised.next_start = time.monotonic() + delay
+
+    def report_startup(self, seconds):
+        """ Report the time the units took to be ready and the memory they use """
+        processes, rss, pss = memory_report()
+        message = (f"{len(self.supervised)} units ready in {seconds:.2f}s runtime={self.config['SECURITY']['runtime']} "
+                   f"processes={processes} rss={rss / 1024 / 1024:.1f}MB pss={'-' if pss is None else f'{pss / 1024 / 1024:.1f}MB'}")
+        print(f"{message}\n")
+        self.queue_logger.info(message)
+
+    def shutdown(self):
+        """ Stop the units stage by stage, killing any still running after shutdown_seconds """
+        start = time.monotonic()
+        deadline = start + self.config['SECURITY']['shutdown_seconds']
+        for stage in sorted(set(supervised.stage for supervised in self.supervised)):
+            stage_units = [supervised.unit for supervised in self.supervised if supervised.stage == stage and supervised.next_start is None]
+            for running_unit in stage_units:
+                running_unit.stop()
+            for running_unit in stage_units:
+                running_unit.join(max(0, deadline - time.monotonic()))
+        for running_unit in self.units():
+            if running_unit.is_alive():
+                self.queue_logger.error(f"{running_unit.unit_name} did not exit within {self.config['SECURITY']['shutdown_seconds']}s, killing it")
+                running_unit.kill()
+                running_unit.join(STALE_EXIT_SECONDS)
+        self.queue_logger.info(f"Units stopped in {time.monotonic() - start:.2f}s")
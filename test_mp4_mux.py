@@ -0,0 +1,184 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import mp4_mux
+import fake_camera
+
+# A small synthetic stream, 3 GOPs of 10 frames at 25 fps
+WIDTH = 64
+HEIGHT = 48
+FRAMERATE = 25
+GOP = 10
+FRAMES = 30
+SAMPLE_DELTA = mp4_mux.TIMESCALE // FRAMERATE
+
+
+def corpus():
+    """ Return the Annex-B frames of the synthetic stream, with the SPS and PPS before each key frame as inline_headers does """
+    return [fake_camera.h264_frame(WIDTH, HEIGHT, index, index % GOP == 0, index % GOP == 0) for index in range(FRAMES)]
+
+
+def sample_size(frame):
+    """ Return the size of a frame once muxed, its slice NAL unit with a 4 byte length instead of a start code """
+    return len(frame.rsplit(fake_camera.START_CODE, 1)[1]) + 4
+
+
+def boxes_of(data):
+    """ Return the read_boxes list of MP4 data """
+    return mp4_mux.read_boxes(io.BytesIO(data))
+
+
+def payload(data, found_box):
+    """ Return the payload of a box from read_boxes, after its header and any version and flags """
+    depth, box_type, size, offset = found_box
+    start = offset + 8
+    if box_type in ('mdhd', 'stts', 'stss', 'stsz', 'stco', 'tfhd', 'tfdt', 'trun', 'mfhd', 'trex'):
+        start += 4
+    return data[start:offset + size]
+
+
+class Test_mp4_writer(unittest.TestCase):
+    """ Mux the fake camera stream with Mp4_writer and check the boxes, sample tables and key frame index """
+    def setUp(self):
+        self.frames = corpus()
+        output = io.BytesIO()
+        self.index = mp4_mux.Keyframe_index()
+        writer = mp4_mux.Mp4_writer(output, FRAMERATE, self.index)
+        for frame in self.frames:
+            writer.write(frame)
+        writer.close()
+        self.data = output.getvalue()
+        self.boxes = boxes_of(self.data)
+        self.by_type = {found_box[1]: found_box for found_box in self.boxes}
+
+    def test_structure(self):
+        self.assertEqual([box_type for depth, box_type, size, offset in self.boxes if depth == 0], ['ftyp', 'mdat', 'moov'])
+        for box_type in ('trak', 'mdia', 'minf', 'stbl', 'stsd', 'stts', 'stss', 'stsc', 'stsz', 'stco', 'mvhd', 'tkhd', 'mdhd'):
+            self.assertIn(box_type, self.by_type)
+        # The top level boxes fill the file
+        self.assertEqual(sum(size for depth, box_type, size, offset in self.boxes if depth == 0), len(self.data))
+
+    def test_samples(self):
+        sample_count, sample_delta_count, sample_delta = struct.unpack('>III', payload(self.data, self.by_type['stts']))
+        self.assertEqual((sample_count, sample_delta_count, sample_delta), (1, FRAMES, SAMPLE_DELTA))
+        stsz = payload(self.data, self.by_type['stsz'])
+        default_size, count = struct.unpack('>II', stsz[:8])
+        self.assertEqual((default_size, count), (0, FRAMES))
+        self.assertEqual(list(struct.unpack(f'>{count}I', stsz[8:])), [sample_size(frame) for frame in self.frames])
+        stss = payload(self.data, self.by_type['stss'])
+        self.assertEqual(list(struct.unpack(f'>{struct.unpack(">I", stss[:4])[0]}I', stss[4:])), [1, 11, 21])
+        # Version 0 mdhd is creation, modification, timescale then duration
+        timescale, duration = struct.unpack('>II', payload(self.data, self.by_type['mdhd'])[8:16])
+        self.assertEqual((timescale, duration), (mp4_mux.TIMESCALE, FRAMES * SAMPLE_DELTA))
+        # The samples are one after the other from the first offset to the end of the mdat box
+        depth, box_type, mdat_size, mdat_offset = self.by_type['mdat']
+        chunk_count, first_offset = struct.unpack('>II', payload(self.data, self.by_type['stco']))
+        self.assertEqual(first_offset, mdat_offset + 16)
+        self.assertEqual(first_offset + sum(sample_size(frame) for frame in self.frames), mdat_offset + mdat_size)
+
+    def test_index(self):
+        self.assertEqual(self.index.sample_count, FRAMES)
+        self.assertEqual([gop[0] for gop in self.index.gops], [0, 10, 20])
+        for first_sample, offset, sizes in self.index.gops:
+            self.assertEqual(sizes, [sample_size(frame) for frame in self.frames[first_sample:first_sample + GOP]])
+            # Each GOP starts with the length of an IDR slice
+            self.assertEqual(struct.unpack('>I', self.data[offset:offset + 4])[0], sizes[0] - 4)
+            self.assertEqual(self.data[offset + 4] & 0x1f, mp4_mux.NAL_IDR)
+
+
+class Test_fmp4_writer(unittest.TestCase):
+    """ Mux the fake camera stream with Fmp4_writer and check there is one fragment for each GOP """
+    def setUp(self):
+        self.frames = corpus()
+        output = io.BytesIO()
+        self.index = mp4_mux.Keyframe_index()
+        writer = mp4_mux.Fmp4_writer(output, FRAMERATE, self.index)
+        for frame in self.frames:
+            writer.write(frame)
+        writer.close()
+        self.data = output.getvalue()
+        self.boxes = boxes_of(self.data)
+
+    def of_type(self, box_type):
+        return [found_box for found_box in self.boxes if found_box[1] == box_type]
+
+    def test_structure(self):
+        self.assertEqual([box_type for depth, box_type, size, offset in self.boxes if depth == 0], ['ftyp', 'moov'] + ['moof', 'mdat'] * (FRAMES // GOP))
+        self.assertEqual(len(self.of_type('mvex')), 1)
+        for traf in self.of_type('traf'):
+            children = [box_type for depth, box_type, size, offset in self.boxes if depth == traf[0] + 1 and traf[3] < offset < traf[3] + traf[2]]
+            self.assertEqual(children, ['tfhd', 'tfdt', 'trun'])
+        self.assertEqual(sum(size for depth, box_type, size, offset in self.boxes if depth == 0), len(self.data))
+
+    def test_fragments(self):
+        decode_times = [struct.unpack('>Q', payload(self.data, tfdt))[0] for tfdt in self.of_type('tfdt')]
+        self.assertEqual(decode_times, [fragment * GOP * SAMPLE_DELTA for fragment in range(FRAMES // GOP)])
+        # The default duration of a sample is in the trex box
+        track_id, description_index, default_duration = struct.unpack('>III', payload(self.data, self.of_type('trex')[0])[:12])
+        self.assertEqual(default_duration, SAMPLE_DELTA)
+        for fragment, (moof, trun, mdat) in enumerate(zip(self.of_type('moof'), self.of_type('trun'), self.of_type('mdat'))):
+            trun_payload = payload(self.data, trun)
+            sample_count, data_offset, first_flags = struct.unpack('>IiI', trun_payload[:12])
+            sizes = list(struct.unpack(f'>{sample_count}I', trun_payload[12:]))
+            frames = self.frames[fragment * GOP:(fragment + 1) * GOP]
+            self.assertEqual(sample_count, GOP)
+            self.assertEqual(sizes, [sample_size(frame) for frame in frames])
+            # The data offset is from the start of the moof box to the first sample in the mdat box
+            self.assertEqual(moof[3] + data_offset, mdat[3] + 8)
+            self.assertEqual(mdat[2], 8 + sum(sizes))
+
+    def test_index(self):
+        self.assertEqual(self.index.sample_count, FRAMES)
+        self.assertEqual([gop[0] for gop in self.index.gops], [0, 10, 20])
+        for (first_sample, offset, sizes), mdat in zip(self.index.gops, self.of_type('mdat')):
+            self.assertEqual(offset, mdat[3] + 8)
+            self.assertEqual(self.data[offset + 4] & 0x1f, mp4_mux.NAL_IDR)
+
+
+class Test_convert(unittest.TestCase):
+    """ Convert a h264 file and check the saved key frame index points at the key frames """
+    def test_convert(self):
+        with tempfile.TemporaryDirectory() as directory:
+            h264_path = os.path.join(directory, '00.h264')
+            mp4_path = os.path.join(directory, '00.mp4')
+            frames = corpus()
+            with open(h264_path, 'wb') as fp:
+                fp.write(b''.join(frames))
+            mp4_mux.convert(h264_path, mp4_path, FRAMERATE, chunk_size=1000, key_frame_index_path=mp4_mux.index_path(mp4_path))
+            index = mp4_mux.load_index(mp4_mux.index_path(mp4_path))
+            with open(mp4_path, 'rb') as fp:
+                data = fp.read()
+        self.assertEqual(index['samples'], FRAMES)
+        self.assertEqual(index['framerate'], FRAMERATE)
+        self.assertEqual(bytes.fromhex(index['sps']), fake_camera.sps(WIDTH, HEIGHT))
+        self.assertEqual(bytes.fromhex(index['pps']), fake_camera.PPS)
+        self.assertEqual([gop[0] for gop in index['gops']], [0, 10, 20])
+        for first_sample, offset, sizes in index['gops']:
+            self.assertEqual(struct.unpack('>I', data[offset:offset + 4])[0], sizes[0] - 4)
+            self.assertEqual(data[offset + 4] & 0x1f, mp4_mux.NAL_IDR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import datetime as dt
+import sqlite3
+import argparse
+
+import cleanup
+import migrate
+import settings
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    path TEXT PRIMARY KEY,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    bytes INTEGER NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_start ON segments (start);
+CREATE INDEX IF NOT EXISTS segments_end ON segments (end);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    source TEXT NOT NULL,
+    still_path TEXT,
+    clip_path TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+"""
+
+# Extensions of the segment files, the video directories also hold key frame indexes
+SEGMENT_EXTENSIONS = ('.h264', '.mp4')
+
+# Segment status values, h264 segments are waiting for conversion
+STATUS_H264 = 'h264'
+STATUS_MP4 = 'mp4'
+STATUS_FAILED = 'failed'
+
+# File systems the WAL journal does not work on as its shared memory index needs every reader on the same host
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs')
+
+
+def filesystem_type(path):
+    """ Return the type of the file system path is on from /proc/mounts or None if it cannot be read """
+    path = os.path.realpath(path)
+    best = ('', None)
+    try:
+        with open('/proc/mounts', 'r') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are escaped as \040
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(os.path.join(mount_point, ''))) and len(mount_point) >= len(best[0]):
+                    best = (mount_point, fields[2])
+    except OSError:
+        pass
+    return best[1]
+
+
+class Timeline:
+    """ A class to keep an SQLite index of the recorded segments and the PIR events
+
+        Record adds the segments and events, Mp4_convert updates a segment once it is converted and
+        Cleanup removes what it deletes, so footage can be found by time without walking the directories
+        Each process opens its own Timeline as an SQLite connection cannot be shared across a fork
+
+        The index only mirrors what is on disk so an error updating it is logged and otherwise ignored,
+        rebuild recreates it from the files
+    """
+    def __init__(self, path, logger=None):
+        """
+        Initialise the timeline class
+
+        Keyword arguments:
+        path -- The full path of the SQLite database file
+
+        logger -- A logger to report errors to or None to raise them
+        """
+        self.path = path
+        self.logger = logger
+        # Autocommit, each change is a single statement
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        # WAL lets the query CLI read while the units write, on network storage the rollback journal has to be used
+        if filesystem_type(os.path.dirname(os.path.abspath(path))) in NETWORK_FILESYSTEMS:
+            self.db.execute("PRAGMA journal_mode=DELETE")
+        else:
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def execute(self, sql, parameters=()):
+        """ Run a change to the index, errors are logged if there is a logger """
+        try:
+            self.db.execute(sql, parameters)
+        except sqlite3.Error as e:
+            if self.logger is None:
+                raise
+            self.logger.warning(f"Cannot update timeline {self.path} {e}")
+
+    def add_segment(self, path, start, end, size, status):
+        """
+        Add or replace a segment
+
+        Keyword arguments:
+        path -- The full path of the segment file
+
+        start -- The time in seconds since the epoch the segment starts
+
+        end -- The time in seconds since the epoch the segment ends
+
+        size -- The size of the file in bytes
+
+        status -- STATUS_H264 if the segment needs converting, STATUS_MP4 if not
+        """
+        self.execute("INSERT OR REPLACE INTO segments (path, start, end, bytes, status) VALUES (?, ?, ?, ?, ?)", (path, start, end, size, status))
+
+    def segment_converted(self, h264_path, mp4_path, size):
+        """ Point a segment or event clip at its converted file """
+        self.execute("UPDATE segments SET path = ?, bytes = ?, status = ? WHERE path = ?", (mp4_path, size, STATUS_MP4, h264_path))
+        self.execute("UPDATE events SET clip_path = ? WHERE clip_path = ?", (mp4_path, h264_path))
+
+    def segment_moved(self, old_path, new_path):
+        """ Point a segment at its new path after it is moved to another storage tier """
+        self.execute("UPDATE segments SET path = ? WHERE path = ?", (new_path, old_path))
+
+    def segment_status(self, path, status):
+        self.execute("UPDATE segments SET status = ? WHERE path = ?", (status, path))
+
+    def add_event(self, event_time, source, still_path=None, clip_path=None):
+        """
+        Add an event
+
+        Keyword arguments:
+        event_time -- The time in seconds since the epoch of the event
+
+        source -- What raised the event e.g pir
+
+        still_path -- The full path of the notification still or None
+
+        clip_path -- The full path of the event clip or None
+        """
+        self.execute("INSERT INTO events (time, source, still_path, clip_path) VALUES (?, ?, ?, ?)", (event_time, source, still_path, clip_path))
+
+    def remove(self, path):
+        """ Remove a deleted file from the index, an event is kept until both its still and clip are gone """
+        self.execute("DELETE FROM segments WHERE path = ?", (path,))
+        self.execute("UPDATE events SET still_path = NULL WHERE still_path = ?", (path,))
+        self.execute("UPDATE events SET clip_path = NULL WHERE clip_path = ?", (path,))
+        self.execute("DELETE FROM events WHERE still_path IS NULL AND clip_path IS NULL")
+
+    def remove_tree(self, directory):
+        """ Remove every segment under a deleted directory """
+        # Escape the LIKE wildcards that are valid in a path
+        prefix = os.path.join(directory, '').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        self.execute("DELETE FROM segments WHERE path LIKE ? ESCAPE '\\'", (prefix + '%',))
+
+    def segments(self, start, end):
+        """ Return (path, start, end, bytes, status) of the segments overlapping start to end, in time order """
+        return self.db.execute("SELECT path, start, end, bytes, status FROM segments WHERE start <= ? AND end >= ? ORDER BY start", (end, start)).fetchall()
+
+    def events(self, start, end):
+        """ Return (time, source, still path, clip path) of the events from start to end, in time order """
+        return self.db.execute("SELECT time, source, still_path, clip_path FROM events WHERE time >= ? AND time <= ? ORDER BY time", (start, end)).fetchall()
+
+    def rebuild(self, video_out_path, notification_out_path, staging_path=None):
+        """
+        Replace the index with what is on disk, returns the number of (segments, events) found
+        A segment's start comes from its path and its end from its modification time
+
+        Keyword arguments:
+        video_out_path -- The path segments are migrated to or Record writes segments to
+
+        notification_out_path -- The path Record writes notification stills and event clips to
+
+        staging_path -- The path Record writes segments to before they are migrated or None
+        """
+        segments = []
+        for top in (staging_path, video_out_path):
+            if top is None:
+                continue
+            for root, dirs, files in os.walk(top):
+                for f in files:
+                    extension = os.path.splitext(f)[1]
+                    if extension not in SEGMENT_EXTENSIONS or f.endswith('.part.mp4'):
+                        continue
+                    full_f = os.path.join(root, f)
+                    try:
+                        stat = os.stat(full_f)
+                    except OSError:
+                        continue
+                    start = cleanup.file_time_from_path(full_f)
+                    if start is None:
+                        start = stat.st_mtime - 60
+                    status = STATUS_H264 if extension == '.h264' else STATUS_MP4
+                    segments.append((full_f, start, max(start, stat.st_mtime), stat.st_size, status))
+
+        events = []
+        try:
+            names = set(os.listdir(notification_out_path))
+        except OSError:
+            names = set()
+        for name in names:
+            base, extension = os.path.splitext(name)
+            if extension != '.jpg':
+                continue
+            # Extra frames and rendered images have a suffix so do not parse as a time
+            event_time = cleanup.parse_still_time(base)
+            if event_time is None:
+                continue
+            clip = next((base + clip_extension for clip_extension in ('.mp4', '.h264') if base + clip_extension in names), None)
+            events.append((event_time, 'pir', os.path.join(notification_out_path, name), os.path.join(notification_out_path, clip) if clip else None))
+
+        # Replace everything in one transaction so a query never sees a half built index
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM segments")
+            self.db.execute("DELETE FROM events")
+            self.db.executemany("INSERT OR REPLACE INTO segments (path, start, end, bytes, status) VALUES (?, ?, ?, ?, ?)", segments)
+            self.db.executemany("INSERT INTO events (time, source, still_path, clip_path) VALUES (?, ?, ?, ?)", events)
+        return (len(segments), len(events))
+
+    def close(self):
+        self.db.close()
+
+
+def timeline_path(config):
+    """ Return the path of the timeline database from the config or None if the timeline is not enabled """
+    if not config['TIMELINE']['enabled']:
+        return None
+    return config['TIMELINE']['path'] or os.path.join(migrate.state_path(config), '.timeline.db')
+
+
+def open_timeline(config, logger):
+    """
+    Return a Timeline for a unit to update or None if the timeline is not enabled or cannot be opened
+
+    Keyword arguments:
+    config -- A settings.Settings object
+
+    logger -- The unit's logger
+    """
+    path = timeline_path(config)
+    if path is None:
+        return None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return Timeline(path, logger)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Cannot open timeline {path} {e}")
+        return None
+
+
+def parse_cli_time(text):
+    """ Return seconds since the epoch for a local date and time such as 2019-01-01 14:32:10, 2019-01-01T14:32 or 2019-01-01 """
+    return dt.datetime.fromisoformat(text).timestamp()
+
+
+def format_time(seconds):
+    return dt.datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query or rebuild the segment and event timeline")
+    parser.add_argument('--config', default='security.ini', help="The config file (default security.ini)")
+    commands = parser.add_subparsers(dest='command')
+    segments_parser = commands.add_parser('segments', help="List the segments covering a time range")
+    segments_parser.add_argument('start', help="Local start time e.g 2019-01-01T14:32:10")
+    segments_parser.add_argument('end', nargs='?', help="Local end time, defaults to the start time")
+    events_parser = commands.add_parser('events', help="List the events in a time range")
+    events_parser.add_argument('start', help="Local start time e.g 2019-01-01")
+    events_parser.add_argument('end', nargs='?', help="Local end time, defaults to now")
+    commands.add_parser('rebuild', help="Recreate the timeline from the files on disk")
+    args = parser.parse_args()
+
+    try:
+        config = settings.load(args.config)
+    except settings.Settings_error as e:
+        sys.exit(f"{e}")
+    path = timeline_path(config)
+    if path is None:
+        sys.exit(f"The timeline is not enabled in {args.config}")
+    timeline = Timeline(path)
+
+    if args.command == 'segments':
+        start = parse_cli_time(args.start)
+        end = parse_cli_time(args.end) if args.end else start
+        for segment_path, segment_start, segment_end, size, status in timeline.segments(start, end):
+            print(f"{format_time(segment_start)} {format_time(segment_end)} {size:>10} {status:<6} {segment_path}")
+    elif args.command == 'events':
+        start = parse_cli_time(args.start)
+        end = parse_cli_time(args.end) if args.end else time.time()
+        for event_time, source, still_path, clip_path in timeline.events(start, end):
+            print(f"{format_time(event_time)} {source} {still_path or '-'} {clip_path or '-'}")
+    elif args.command == 'rebuild':
+        start_time = time.monotonic()
+        segments, events = timeline.rebuild(config['RECORD']['video_out_path'], config['RECORD']['notification_out_path'], migrate.staging_path(config))
+        print(f"Indexed {segments} segments and {events} events in {time.monotonic() - start_time:.2f}s")
+    else:
+        parser.print_help()
+    timeline.close()
@@ -0,0 +1,228 @@
+__author__ = "Andrew Beck"
+__copyright__ = "Copyright (C) 2019 Andrew Beck"
+__license__ = "GNU General Public License v3"
+__version__ = "0.1"
+
+
+# This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import threading
+import queue
+import time
+import os
+import logging
+import logging.handlers
+
+import metrics
+import settings
+
+# As a multiprocess Python script is hard to debug, but you can use pudb.remote
+# You will need to import the pudb.remote module and set a breakpoint in code with
+#from pudb.remote import set_trace
+#set_trace(term_size=(80, 24))
+# Then telnet to the port shown on screen
+
+# The longest a unit waits for a message before updating its heartbeat
+HEARTBEAT_SECONDS = 5
+
+
+def new_queue(config, shared=False):
+    """
+    Return a queue for messages between units
+
+    Keyword arguments:
+    config -- A settings.Settings object
+
+    shared -- True if a unit that always runs in its own process reads or writes the queue
+    """
+    if shared or config['SECURITY']['runtime'] == 'process':
+        return multiprocessing.Queue()
+    # Threads in the same process need no pickling or feeder thread
+    return queue.Queue()
+
+
+class Unit:
+    """ A base class for the units, it handles the logging setup and asking the unit to exit
+
+        With runtime=process in the SECURITY section each unit runs in its own process, with runtime=thread
+        the units run as threads of security.py sharing one interpreter, apart from units with ISOLATE set
+        which always get their own process
+
+        Units block in get_message until a message arrives or they are asked to exit,
+        so an idle unit does not wake up and a message or exit request is handled straight away
+        stop puts a None sentinel on the input queue to wake a unit blocked waiting for a message,
+        join waits for it to exit so several units can be stopped at once
+        The heartbeat is the time.monotonic() the unit was last known to be working, updated by get_message
+        and beat, the supervisor restarts a unit whose heartbeat stops
+        A Settings object on the input queue is a reloaded config, get_message applies it with reload
+    """
+    # Set by units that need their own process for CPU parallelism or to keep a crash away from the rest
+    ISOLATE = False
+
+    def __init__(self, *, config, log_queue, unit_name, config_section, input_queue=None, metrics_queue=None):
+        """
+        Initialise the unit class
+
+        Keyword arguments:
+        config -- A settings.Settings object
+
+        log_queue -- A queue object to send log messages to
+
+        unit_name -- The name used for the unit's logger and log messages
+
+        config_section -- The config section holding the unit's log_level
+
+        input_queue -- A queue object the unit receives messages on, if None the unit gets its own
+        queue so it can still be woken up to exit
+
+        metrics_queue -- A queue object to send metrics snapshots to or None
+        """
+        self.config = config
+        self.log_queue = log_queue
+        self.unit_name = unit_name
+        self.config_section = config_section
+        self.runtime = 'process' if self.ISOLATE else self.config['SECURITY']['runtime']
+        self.input_queue = input_queue if input_queue is not None else new_queue(config, shared=self.runtime == 'process')
+
+        if self.runtime == 'process':
+            self.stoprequest = multiprocessing.Event()
+        else:
+            self.stoprequest = threading.Event()
+        # Shared with the supervisor, set to now so a unit is not stale while it starts up
+        self.heartbeat = multiprocessing.Value('d', time.monotonic(), lock=False)
+        # The process or thread running the unit and the exit code of a thread
+        self.worker = None
+        self.thread_exitcode = None
+
+        # Setup logging
+        self.queue_logger = logging.getLogger(name=unit_name)
+        # A restarted unit uses the logger of the one it replaces
+        if not self.queue_logger.handlers:
+            h = logging.handlers.QueueHandler(self.log_queue)  # Just the one handler needed
+            self.queue_logger.addHandler(h)
+        # Threads share the root logger with the log listener, the queue handler is the only way out
+        self.queue_logger.propagate = False
+        # apply this unit's logging level
+        self.queue_logger.setLevel(self.config[config_section]['log_level'])
+
+        # Setup metrics, the unit updates self.metrics and get_message sends them on
+        self.metrics = metrics.Metrics(metrics_queue, unit_name, self.config['METRICS']['flush_seconds'])
+
+    def get_message(self, timeout=None):
+        """
+        Block until a message arrives, the unit is asked to exit or the timeout expires
+
+        Returns the message or None if there was no message
+        A reloaded config is applied here and None returned so the units do not need to handle it
+
+        Keyword arguments:
+        timeout -- The maximum number of seconds to wait, None waits until a message arrives or the unit is asked to exit
+        """
+        if self.stoprequest.is_set():
+            return None
+        self.beat()
+        # Send any metrics now if this could block for a long time
+        self.metrics.flush(force=timeout is None)
+        try:
+            # A None message is the sentinel sent by stop to wake the unit
+            # Wake up at least every HEARTBEAT_SECONDS to show the unit is still alive
+            message = self.input_queue.get(timeout=HEARTBEAT_SECONDS if timeout is None else min(timeout, HEARTBEAT_SECONDS))
+        except queue.Empty:
+            return None
+        if isinstance(message, settings.Settings):
+            self.reload(message)
+            return None
+        return message
+
+    def reload(self, config):
+        """
+        Apply a reloaded config, units that keep state derived from the config extend this
+        Values read from self.config when they are used take effect straight away
+
+        Keyword arguments:
+        config -- The reloaded settings.Settings object
+        """
+        changes = self.config.changes(config)
+        self.config = config
+        self.queue_logger.setLevel(self.config[self.config_section]['log_level'])
+        self.metrics.flush_seconds = self.config['METRICS']['flush_seconds']
+        if changes:
+            self.queue_logger.info(f"{self.unit_name} reloaded config changes={', '.join(f'{section}.{key}' for section, key in changes)}")
+
+    def start(self):
+        """ Start running the unit in a process or thread """
+        if self.runtime == 'process':
+            self.worker = multiprocessing.Process(target=self.run, name=self.unit_name)
+        else:
+            # A daemon thread so one that will not exit cannot hold up the shutdown
+            self.worker = threading.Thread(target=self.run_thread, name=self.unit_name, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        """ The unit's work, overridden by each unit """
+        raise NotImplementedError
+
+    def run_thread(self):
+        """ Run the unit in a thread, keeping the exit code a process would have so a failure can be seen """
+        try:
+            self.run()
+        except Exception:
+            self.queue_logger.exception(f"{self.unit_name} failed")
+            self.thread_exitcode = 1
+        else:
+            self.thread_exitcode = 0
+
+    @property
+    def exitcode(self):
+        """ None while the unit is running or has not started, otherwise its exit code """
+        if self.worker is None:
+            return None
+        return self.worker.exitcode if self.runtime == 'process' else self.thread_exitcode
+
+    @property
+    def pid(self):
+        """ The process id of the process running the unit """
+        if self.runtime == 'process':
+            return self.worker.pid if self.worker is not None else None
+        return os.getpid()
+
+    def is_alive(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def kill(self):
+        """ Kill the unit's process, a thread cannot be killed so it is left to finish on its own """
+        if self.runtime == 'process':
+            self.worker.kill()
+        else:
+            self.queue_logger.error(f"{self.unit_name} is a thread and cannot be killed, leaving it running")
+
+    def beat(self):
+        """ Update the heartbeat, units call this in any loop that can run for longer than HEARTBEAT_SECONDS """
+        self.heartbeat.value = time.monotonic()
+
+    def stop(self):
+        """ Ask the unit to exit without waiting for it """
+        if self.stoprequest.is_set():
+            return
+        self.queue_logger.info(f"{self.unit_name} asked to exit")
+        self.stoprequest.set()
+        # Wake the unit if it is waiting for a message
+        self.input_queue.put(None)
+
+    def join(self, timeout=None):
+        """ Ask the unit to exit if it has not been already and wait for it """
+        self.stop()
+        if self.worker is not None:
+            self.worker.join(timeout)